@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""time the checkout/checkin throughput of many clients on a task DB file versus the
+same clients going through a broker
+
+    python benchmarks/broker.py -p 16 -n 4000
+
+Each of the p client processes checks out and checks in tasks one at a time until the
+DB is empty. With the broker only one process touches the DB file and the requests of
+all of the clients are batched."""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+from cake import SQLiteTaskDB, RemoteTaskDB, TaskBroker, TASK_STATES
+
+
+def _client(args):
+    cls, conf = args
+    num = 0
+    with cls(**conf) as db:
+        while True:
+            task, id = db.checkout()
+            if task is None:
+                break
+            db.checkin(id, TASK_STATES.SUCCEEDED)
+            num += 1
+    return num
+
+
+def _run_clients(cls, conf, num_procs):
+    pool = multiprocessing.Pool(num_procs)
+    stime = time.perf_counter()
+    num = sum(pool.map(_client, [(cls, conf)] * num_procs))
+    dt = time.perf_counter() - stime
+    pool.close()
+    pool.join()
+    return num, dt
+
+
+def bench(tmpdir, use_broker, num_procs, num_tasks):
+    conf = {'name': os.path.join(tmpdir, 'bench-%d.db' % use_broker), 'timeout': 600.0}
+    with SQLiteTaskDB(**conf) as db:
+        db.add_multiple(['echo %d' % i for i in range(num_tasks)], return_ids=False)
+
+    if not use_broker:
+        num, dt = _run_clients(SQLiteTaskDB, conf, num_procs)
+    else:
+        sock = os.path.join(tmpdir, 'broker.sock')
+        started = threading.Event()
+        brokers = []
+
+        def _serve():
+            with SQLiteTaskDB(**conf) as db:
+                brokers.append(TaskBroker(db, sock))
+                started.set()
+                brokers[0].serve()
+
+        thread = threading.Thread(target=_serve)
+        thread.start()
+        started.wait()
+        try:
+            num, dt = _run_clients(RemoteTaskDB, {'address': sock}, num_procs)
+        finally:
+            brokers[0].stop()
+            thread.join()
+
+    assert num == num_tasks, "Not every task was run!"
+    return num / dt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time the throughput of a task DB with and without a broker")
+    parser.add_argument('-p', type=int, default=8, help="number of client processes")
+    parser.add_argument('-n', type=int, default=2000, help="number of tasks")
+    parser.add_argument('--dir', default=None, help="directory to put the task DBs in (e.g., on Lustre)")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        for use_broker in [False, True]:
+            rate = bench(tmpdir, use_broker, args.p, args.n)
+            print("%-10s %3d clients: %10.1f tasks/s" % ('broker' if use_broker else 'direct', args.p, rate))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
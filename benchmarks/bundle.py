@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""time how many tiny tasks per second a worker runs with and without bundling
+
+    python benchmarks/bundle.py -t 2000 -n 4 --bundle 1 16 64
+
+Each task is `test <i> -ge 0`, so nearly all of the time is the overhead of cake."""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from cake import SQLiteTaskDB, SerialWorker, PMPWorker, TASK_STATES
+
+
+def bench(tmpdir, num, bundle, num_tasks):
+    conf = {'name': os.path.join(tmpdir, 'bench-%d.db' % bundle), 'timeout': 600.0}
+    with SQLiteTaskDB(**conf) as db:
+        db.add_multiple(['test %d -ge 0' % i for i in range(num_tasks)], return_ids=False)
+
+    workerconf = {'taskdb_class': SQLiteTaskDB, 'taskdb_conf': conf, 'bundle': bundle}
+    stime = time.perf_counter()
+    if num is None:
+        with SerialWorker(**workerconf) as w:
+            w.run(silent=True)
+    else:
+        with PMPWorker(n=num, **workerconf) as w:
+            w.run(silent=True)
+    dt = time.perf_counter() - stime
+
+    with SQLiteTaskDB(**conf) as db:
+        assert db.status(as_dict=True)['states'][TASK_STATES.SUCCEEDED] == num_tasks, "Not every task was run!"
+    return num_tasks / dt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time bundling tiny tasks")
+    parser.add_argument('-n', type=int, default=None, help="number of pool processes (serial if not given)")
+    parser.add_argument('-t', type=int, default=2000, help="number of tasks")
+    parser.add_argument('--bundle', type=int, nargs='+', default=[1, 16, 64], help="bundle sizes to time")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for bundle in args.bundle:
+            rate = bench(tmpdir, args.n, bundle, args.t)
+            print("n=%-4s bundle=%-4d %10.1f tasks/s" % (args.n or '-', bundle, rate))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""time how many tasks per second each launcher starts and waits on
+
+    python benchmarks/launch.py -t 2000 --ballast 2000
+
+The tasks are run one after the other from this process, which first allocates and
+touches --ballast MB of memory to look like a large worker (e.g., one holding a task DB
+in memory). The command is run as is (`true` needs no shell) and behind shell syntax."""
+import time
+import argparse
+
+from cake.launcher import get_launcher, LAUNCHERS
+
+
+def bench(kind, tsk, num_tasks):
+    launcher = get_launcher(kind)
+    try:
+        launcher(tsk)
+        stime = time.perf_counter()
+        for i in range(num_tasks):
+            assert launcher(tsk) == 0, "The task failed!"
+        dt = time.perf_counter() - stime
+    finally:
+        launcher.close()
+    return num_tasks / dt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time the task launchers")
+    parser.add_argument('-t', type=int, default=1000, help="number of tasks")
+    parser.add_argument('--ballast', type=int, default=0, help="MB of memory to hold while launching")
+    parser.add_argument('--cmd', default='true', help="command to run for each task")
+    args = parser.parse_args()
+
+    ballast = bytearray(args.ballast * 1024 * 1024)
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+
+    for tsk in [args.cmd, args.cmd + ' && true']:
+        for kind in ['shell'] + [k for k in LAUNCHERS if k != 'shell']:
+            rate = bench(kind, tsk, args.t)
+            print("%-11s %-16s %10.1f tasks/s" % (kind, repr(tsk), rate))
+
+
+if __name__ == '__main__':
+    main()
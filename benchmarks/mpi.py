@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""time how many tasks per second the MPI master hands out, with and without sub-masters
+
+    mpirun -np 64 python benchmarks/mpi.py -t 20000 --group-size 16 --worker-prefetch 8
+
+Each task is a python function call (see cake.pycall) that does nothing, so nearly all of
+the time is spent getting tasks to the ranks and their results back to the task DB."""
+import os
+import time
+import argparse
+
+from mpi4py import MPI
+
+from cake import SQLiteTaskDB, TASK_STATES, pycall
+from cake.workers.mpiworker import MPIWorker
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time the MPI worker")
+    parser.add_argument('-t', type=int, default=10000, help="number of tasks")
+    parser.add_argument('--group-size', type=int, default=None,
+                        help="number of ranks per sub-master (no sub-masters if not given)")
+    parser.add_argument('--worker-prefetch', type=int, default=1,
+                        help="number of tasks each rank keeps queued besides the one it runs")
+    parser.add_argument('--dir', default='.', help="directory to put the task DB in")
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    conf = {'name': os.path.join(args.dir, 'bench-mpi.db'), 'timeout': 600.0}
+    if comm.Get_rank() == 0:
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(conf['name'] + suffix):
+                os.remove(conf['name'] + suffix)
+        with SQLiteTaskDB(**conf) as db:
+            db.add_multiple([pycall('os:getpid')] * args.t, return_ids=False)
+    comm.Barrier()
+
+    stime = time.perf_counter()
+    with MPIWorker(taskdb_class=SQLiteTaskDB, taskdb_conf=conf, sub_masters=args.group_size is not None,
+                   group_size=args.group_size, worker_prefetch=args.worker_prefetch) as w:
+        w.run(silent=True)
+    comm.Barrier()
+    dt = time.perf_counter() - stime
+
+    if comm.Get_rank() == 0:
+        with SQLiteTaskDB(**conf) as db:
+            assert db.status(as_dict=True)['states'][TASK_STATES.SUCCEEDED] == args.t, "Not every task was run!"
+        print("%d ranks, group size %s, worker prefetch %d: %10.1f tasks/s" %
+              (comm.Get_size(), args.group_size, args.worker_prefetch, args.t / dt))
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(conf['name'] + suffix):
+                os.remove(conf['name'] + suffix)
+
+
+if __name__ == '__main__':
+    main()
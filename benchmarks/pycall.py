@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""time python tasks run as shell commands versus called in the pool processes
+
+    python benchmarks/pycall.py -n 4 -t 200
+
+Each task makes a small numpy array, so nearly all of the time of the shell command is
+starting python and importing numpy."""
+import os
+import sys
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+
+from cake import SQLiteTaskDB, PMPWorker, TASK_STATES, pycall
+
+
+def bench(tmpdir, name, tsk, num, num_tasks):
+    conf = {'name': os.path.join(tmpdir, 'bench-%s.db' % name), 'timeout': 600.0}
+    with SQLiteTaskDB(**conf) as db:
+        db.add_multiple([tsk] * num_tasks, return_ids=False)
+
+    stime = time.perf_counter()
+    with PMPWorker(taskdb_class=SQLiteTaskDB, taskdb_conf=conf, n=num) as w:
+        w.run(silent=True)
+    dt = time.perf_counter() - stime
+
+    with SQLiteTaskDB(**conf) as db:
+        assert db.status(as_dict=True)['states'][TASK_STATES.SUCCEEDED] == num_tasks, "Not every task was run!"
+    return num_tasks / dt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time python function tasks")
+    parser.add_argument('-n', type=int, default=4, help="number of pool processes")
+    parser.add_argument('-t', type=int, default=200, help="number of tasks")
+    args = parser.parse_args()
+
+    tasks = [('shell', '%s -c %s' % (shlex.quote(sys.executable), shlex.quote('import numpy; numpy.ones(10)'))),
+             ('pycall', pycall('numpy:ones', 10))]
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, tsk in tasks:
+            rate = bench(tmpdir, name, tsk, args.n, args.t)
+            print("%-7s n=%-4d %10.1f tasks/s" % (name, args.n, rate))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""time the checkout/checkin throughput of many clients on one task DB file
+versus a task DB sharded over several files
+
+    python benchmarks/shards.py -p 16 -n 4000 -s 1 4 16
+
+Each of the p client processes checks out and checks in tasks one at a time until
+the DB is empty, so the rate is bound by how long the clients wait on the writer
+locks. A shard count of 1 uses a plain SQLiteTaskDB."""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+from cake import SQLiteTaskDB, ShardedSQLiteTaskDB, TASK_STATES
+
+
+def _client(args):
+    cls, conf = args
+    num = 0
+    with cls(**conf) as db:
+        while True:
+            task, id = db.checkout()
+            if task is None:
+                break
+            db.checkin(id, TASK_STATES.SUCCEEDED)
+            num += 1
+    return num
+
+
+def bench(tmpdir, num_shards, num_procs, num_tasks):
+    name = os.path.join(tmpdir, 'bench-%d' % num_shards)
+    conf = {'name': name, 'timeout': 600.0}
+    if num_shards == 1:
+        cls = SQLiteTaskDB
+        name += '.db'
+        conf['name'] = name
+    else:
+        cls = ShardedSQLiteTaskDB
+        conf['num_shards'] = num_shards
+
+    with cls(**conf) as db:
+        db.add_multiple(['echo %d' % i for i in range(num_tasks)])
+    conf.pop('num_shards', None)
+
+    pool = multiprocessing.Pool(num_procs)
+    stime = time.perf_counter()
+    num = sum(pool.map(_client, [(cls, conf)] * num_procs))
+    dt = time.perf_counter() - stime
+    pool.close()
+    pool.join()
+
+    assert num == num_tasks, "Not every task was run!"
+    return num / dt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time the throughput of sharded task DBs")
+    parser.add_argument('-p', type=int, default=8, help="number of client processes")
+    parser.add_argument('-n', type=int, default=2000, help="number of tasks")
+    parser.add_argument('-s', type=int, nargs='+', default=[1, 4, 16], help="numbers of shards to try")
+    parser.add_argument('--dir', default=None, help="directory to put the task DBs in (e.g., on Lustre)")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        for num_shards in args.s:
+            rate = bench(tmpdir, num_shards, args.p, args.n)
+            print("%3d shards, %3d clients: %10.1f tasks/s" % (num_shards, args.p, rate))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""time the per-operation cost of the SQLite task DB
+
+Run it from checkouts of two versions of cake to compare them, e.g.
+
+    python benchmarks/taskdb_ops.py -n 2000
+
+With --memory the same operations are timed on a MemoryTaskDB loaded from the file.
+
+The raw statement timings at the end show the cost of building SQL with
+string formatting (a new statement for every task ID) versus reusing one
+prepared statement with bound parameters."""
+import os
+import time
+import sqlite3
+import argparse
+import tempfile
+
+from cake import SQLiteTaskDB, MemoryTaskDB, TASK_STATES
+
+
+def _time(func, num):
+    stime = time.perf_counter()
+    for i in range(num):
+        func(i)
+    return (time.perf_counter() - stime) / num * 1e6
+
+
+def bench_taskdb(name, num, cls=SQLiteTaskDB):
+    timings = []
+    with cls(name=name) as db:
+        ids = []
+        timings.append(('add', _time(lambda i: ids.append(db.add('echo %d' % i, priority=i % 7)), num)))
+        timings.append(('update', _time(lambda i: db.update(ids[i], priority=i % 5), num)))
+
+        tasks = []
+        timings.append(('checkout', _time(lambda i: tasks.append(db.checkout()), num)))
+        timings.append(('checkin', _time(lambda i: db.checkin(tasks[i][1], TASK_STATES.SUCCEEDED), num)))
+
+        timings.append(('add_multiple (per task)',
+                        _time(lambda i: db.add_multiple(['echo %d' % j for j in range(num)]), 1) / num))
+
+        tasks = db.checkout_many(num)
+        timings.append(('checkin_many (per task)',
+                        _time(lambda i: db.checkin_many([(id, TASK_STATES.SUCCEEDED, '') for _, id in tasks]), 1)
+                        / num))
+    return timings
+
+
+def bench_raw(name, num):
+    conn = sqlite3.connect(name, isolation_level=None)
+    conn.execute("CREATE TABLE TASKS(TASK_ID TEXT PRIMARY KEY NOT NULL, STATE TEXT)")
+    conn.executemany("INSERT INTO TASKS VALUES (?, ?)", [('%d' % i, 'QUEUED_NO_DEP') for i in range(num)])
+
+    def _formatted(i):
+        conn.execute("UPDATE TASKS SET STATE = '%s' WHERE TASK_ID = '%s'" % ('RUNNING', '%d' % i))
+
+    def _bound(i):
+        conn.execute("UPDATE TASKS SET STATE = ? WHERE TASK_ID = ?", ('RUNNING', '%d' % i))
+
+    conn.execute('BEGIN')
+    timings = [('raw update, formatted', _time(_formatted, num)),
+               ('raw update, parameterized', _time(_bound, num))]
+    conn.execute('ROLLBACK')
+    conn.close()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time the per-operation cost of the SQLite task DB")
+    parser.add_argument('-n', type=int, default=1000, help="number of operations of each kind")
+    parser.add_argument('--memory', action='store_true', help="time a MemoryTaskDB instead")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        timings = bench_taskdb(os.path.join(tmpdir, 'bench.db'), args.n,
+                               cls=MemoryTaskDB if args.memory else SQLiteTaskDB)
+        timings += bench_raw(os.path.join(tmpdir, 'raw.db'), args.n)
+    finally:
+        for fname in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, fname))
+        os.rmdir(tmpdir)
+
+    for op, usec in timings:
+        print("%-28s %10.1f us/op" % (op, usec))
+
+
+if __name__ == '__main__':
+    main()
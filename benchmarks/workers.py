@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""time how long the multiprocessing and asyncio workers take to run many sleeping tasks
+
+    python benchmarks/workers.py -n 256 -t 2048 --sleep 0.5
+
+With both workers running n tasks at once, the ideal time is t / n * sleep."""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from cake import SQLiteTaskDB, PMPWorker, AsyncWorker, TASK_STATES
+
+
+def bench(tmpdir, cls, num, num_tasks, sleep):
+    conf = {'name': os.path.join(tmpdir, 'bench-%s.db' % cls.__name__), 'timeout': 600.0}
+    with SQLiteTaskDB(**conf) as db:
+        db.add_multiple(['sleep %s' % sleep] * num_tasks, return_ids=False)
+
+    stime = time.perf_counter()
+    with cls(taskdb_class=SQLiteTaskDB, taskdb_conf=conf, n=num) as w:
+        w.run(silent=True)
+    dt = time.perf_counter() - stime
+
+    with SQLiteTaskDB(**conf) as db:
+        assert db.status(as_dict=True)['states'][TASK_STATES.SUCCEEDED] == num_tasks, "Not every task was run!"
+    return dt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time the multiprocessing and asyncio workers")
+    parser.add_argument('-n', type=int, default=128, help="number of tasks to run at once")
+    parser.add_argument('-t', type=int, default=1024, help="number of tasks")
+    parser.add_argument('--sleep', type=float, default=0.5, help="how long each task sleeps")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print("ideal: %8.2f s" % (args.t / args.n * args.sleep))
+        for cls in [PMPWorker, AsyncWorker]:
+            dt = bench(tmpdir, cls, args.n, args.t, args.sleep)
+            print("%-12s n=%-4d %8.2f s" % (cls.__name__, args.n, dt))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
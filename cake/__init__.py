@@ -2,6 +2,8 @@
 from . import taskdbs, defaults, utils, workers
 from .workers import *
 from .taskdbs import *
+from .broker import TaskBroker
+from .pycall import pycall
 from .defaults import (TASK_STATES,
                        LIST_OF_TASK_STATES,
                        TASK_LOG_ACTIONS,
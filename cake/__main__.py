@@ -1,11 +1,26 @@
 from __future__ import print_function
+import os
 import sys
+import json
+import time
+import socket
 
 import click
 import numpy as np
 
-from cake import SQLiteTaskDB, SerialWorker, PMPWorker, TASK_STATES
+from cake import SQLiteTaskDB, ShardedSQLiteTaskDB, MemoryTaskDB, RemoteTaskDB, TaskBroker
+from cake import SerialWorker, PMPWorker, AsyncWorker, TASK_STATES
 from cake.defaults import DEF_TASKDB_CONF
+from cake.taskdbs.remote import parse_address
+from cake.launcher import LAUNCHERS
+from cake.utils import read_tasks
+
+
+def _taskdb_class(database):
+    """task DBs that are directories are sharded over the files in them"""
+    if os.path.isdir(database):
+        return ShardedSQLiteTaskDB
+    return SQLiteTaskDB
 
 
 def _get_state(state):
@@ -22,7 +37,7 @@ def cli():
 
 
 @cli.command()
-@click.argument('database')
+@click.argument('database', required=False)
 @click.option('--state', default=None, help="only select from tasks with this state")
 @click.option('--runtime', default=np.inf, type=float, help="maximum runtime in seconds")
 @click.option('--timeout', default=DEF_TASKDB_CONF['timeout'], type=float,
@@ -34,17 +49,45 @@ def cli():
 @click.option('-n', default=None, type=int,
               help="number of tasks to run in parallel with python multiprocessing")
 @click.option('--silent', is_flag=True, help="suppress cake log messages in stderr")
+@click.option('--async', 'use_async', is_flag=True,
+              help="run the -n tasks at once with asyncio subprocesses from this one process")
+@click.option('--launcher', default='spawn', type=click.Choice(LAUNCHERS),
+              help="how to start tasks: spawn them directly (with a shell only if needed), from a small "
+              "helper process (forkserver, not used with --async) or always with a shell")
+@click.option('--bundle', default=1, type=int,
+              help="number of tasks to check out at once and run one after the other in one shell session")
+@click.option('--max-tasks-per-child', default=None, type=int,
+              help="replace each -n process after it runs this many tasks (or bundles)")
 @click.option('--mpi', is_flag=True, help="run tasks with a set of MPI workers")
 @click.option('--spawn-master', is_flag=True,
               help="spawn the master MPI task dynamically (may not be supported on all systems)")
+@click.option('--sub-masters', is_flag=True,
+              help="with --mpi, have one rank per node (or per --group-size ranks) pass tasks from the master "
+              "to the other ranks")
+@click.option('--group-size', default=None, type=int, help="number of MPI ranks run by each sub-master")
+@click.option('--worker-prefetch', default=None, type=int,
+              help="with --mpi, number of tasks each rank keeps queued besides the one it runs (default 1)")
 @click.option('--stoptime', default=5.0 * 60.0, type=float,
               help="time in seconds of the runtime to allow the code to exit nicely")
+@click.option('--checkin-batch', default=1, type=int,
+              help="number of task results to buffer before checking them into the task DB together")
+@click.option('--checkin-interval', default=0.0, type=float,
+              help="maximum time in seconds to buffer task results before checking them in")
 @click.option('--master', is_flag=True,
               help="used with --spawn-master internally by the code to spawn the master task "
               "(for internal use only, never set by hand!)")
-def run(database, state, runtime, timeout, task_checkout_delay, task_checkout_num_tries, n, silent,
-        mpi, spawn_master, stoptime, master):
+@click.option('--memory', is_flag=True,
+              help="hold the tasks in memory, writing them back to DATABASE periodically and on exit")
+@click.option('--connect', default=None,
+              help="run tasks from the broker started by cake serve at this host:port or unix socket path")
+@click.option('--authkey', default=None, envvar='CAKE_AUTHKEY', help="key the broker was started with")
+def run(database, state, runtime, timeout, task_checkout_delay, task_checkout_num_tries, n, silent, use_async,
+        launcher, bundle, max_tasks_per_child, mpi, spawn_master, sub_masters, group_size, worker_prefetch, stoptime,
+        checkin_batch, checkin_interval, master, memory, connect, authkey):
     """run tasks in DATABASE"""
+    if (database is None) == (connect is None):
+        raise click.UsageError("give either DATABASE or --connect")
+
     conf = {'name': database}
     conf.update(DEF_TASKDB_CONF)
     conf['timeout'] = timeout
@@ -53,22 +96,59 @@ def run(database, state, runtime, timeout, task_checkout_delay, task_checkout_nu
     conf['intent'] = 'run'
     state = _get_state(state)
 
+    if connect is not None:
+        if memory:
+            raise click.UsageError("--memory is set for the DB by cake serve, not by the workers")
+        conf['name'] = connect
+        conf['address'] = connect
+        conf['authkey'] = authkey
+        taskdb_class = RemoteTaskDB
+    elif memory:
+        if os.path.isdir(database):
+            raise click.UsageError("--memory cannot be used with a sharded task DB")
+        taskdb_class = MemoryTaskDB
+    else:
+        taskdb_class = _taskdb_class(database)
+
     workerconf = {'taskdb_conf': conf,
-                  'taskdb_class': SQLiteTaskDB,
-                  'runtime': runtime}
+                  'taskdb_class': taskdb_class,
+                  'runtime': runtime,
+                  'checkin_batch': checkin_batch,
+                  'checkin_interval': checkin_interval,
+                  'launcher': launcher,
+                  'bundle': bundle}
+
+    if bundle > 1 and (mpi or use_async):
+        raise click.UsageError("--bundle can only be used without --mpi and --async")
+    if max_tasks_per_child is not None and (n is None or mpi or use_async):
+        raise click.UsageError("--max-tasks-per-child can only be used with -n and without --mpi and --async")
+    if worker_prefetch is not None and not mpi:
+        raise click.UsageError("--worker-prefetch can only be used with --mpi")
 
     if mpi:
         from cake.workers.mpiworker import MPIWorker
         workerconf.update({
            'spawn_master': spawn_master,
+           'sub_masters': sub_masters or group_size is not None,
+           'group_size': group_size,
+           'worker_prefetch': 1 if worker_prefetch is None else worker_prefetch,
            'master': master,
            'stoptime': stoptime})
         with MPIWorker(**workerconf) as w:
             w.run(state=state, silent=silent)
-    elif n is not None:
+    elif use_async:
+        if n is None:
+            raise click.UsageError("--async needs the number of tasks to run at once (-n)")
         workerconf.update({
            'stoptime': stoptime,
            'n': n})
+        with AsyncWorker(**workerconf) as w:
+            w.run(state=state, silent=silent)
+    elif n is not None:
+        workerconf.update({
+           'stoptime': stoptime,
+           'n': n,
+           'max_tasks_per_child': max_tasks_per_child})
         with PMPWorker(**workerconf) as w:
             w.run(state=state, silent=silent)
     else:
@@ -78,7 +158,7 @@ def run(database, state, runtime, timeout, task_checkout_delay, task_checkout_nu
 
 @cli.command()
 @click.pass_context
-@click.argument('database')
+@click.argument('database', required=False)
 @click.option('--runtime', default=np.inf, type=float, help="maximum runtime in seconds")
 @click.option('--timeout', default=DEF_TASKDB_CONF['timeout'], type=float,
               help="timeout for locking task DB in seconds")
@@ -89,20 +169,78 @@ def run(database, state, runtime, timeout, task_checkout_delay, task_checkout_nu
 @click.option('-n', default=None, type=int,
               help="number of tasks to run in parallel with python multiprocessing")
 @click.option('--silent', is_flag=True, help="suppress cake log messages in stderr")
+@click.option('--async', 'use_async', is_flag=True,
+              help="run the -n tasks at once with asyncio subprocesses from this one process")
+@click.option('--launcher', default='spawn', type=click.Choice(LAUNCHERS),
+              help="how to start tasks: spawn them directly (with a shell only if needed), from a small "
+              "helper process (forkserver, not used with --async) or always with a shell")
+@click.option('--bundle', default=1, type=int,
+              help="number of tasks to check out at once and run one after the other in one shell session")
+@click.option('--max-tasks-per-child', default=None, type=int,
+              help="replace each -n process after it runs this many tasks (or bundles)")
 @click.option('--mpi', is_flag=True, help="run tasks with a set of MPI workers")
 @click.option('--spawn-master', is_flag=True,
               help="spawn the master MPI task dynamically (may not be supported on all systems)")
+@click.option('--sub-masters', is_flag=True,
+              help="with --mpi, have one rank per node (or per --group-size ranks) pass tasks from the master "
+              "to the other ranks")
+@click.option('--group-size', default=None, type=int, help="number of MPI ranks run by each sub-master")
+@click.option('--worker-prefetch', default=None, type=int,
+              help="with --mpi, number of tasks each rank keeps queued besides the one it runs (default 1)")
 @click.option('--stoptime', default=5.0 * 60.0, type=float,
               help="time in seconds of the runtime to allow the code to exit nicely")
+@click.option('--checkin-batch', default=1, type=int,
+              help="number of task results to buffer before checking them into the task DB together")
+@click.option('--checkin-interval', default=0.0, type=float,
+              help="maximum time in seconds to buffer task results before checking them in")
 @click.option('--master', is_flag=True,
               help="used with --spawn-master internally by the code to spawn the master task "
               "(for internal use only, never set by hand!)")
-def retry(ctx, database, runtime, timeout, task_checkout_delay, task_checkout_num_tries, n, silent,
-          mpi, spawn_master, stoptime, master):
+@click.option('--memory', is_flag=True,
+              help="hold the tasks in memory, writing them back to DATABASE periodically and on exit")
+@click.option('--connect', default=None,
+              help="run tasks from the broker started by cake serve at this host:port or unix socket path")
+@click.option('--authkey', default=None, envvar='CAKE_AUTHKEY', help="key the broker was started with")
+def retry(ctx, database, runtime, timeout, task_checkout_delay, task_checkout_num_tries, n, silent, use_async,
+          launcher, bundle, max_tasks_per_child, mpi, spawn_master, sub_masters, group_size, worker_prefetch,
+          stoptime, checkin_batch, checkin_interval, master, memory, connect, authkey):
     """rerun failed tasks in DATABASE"""
     ctx.forward(run, state='failed')
 
 
+@cli.command()
+@click.argument('database')
+@click.option('--address', default=None,
+              help="host:port (use 0.0.0.0 to listen on every interface, needs --authkey) or unix socket path "
+              "to serve on [default: DATABASE.sock]")
+@click.option('--authkey', default=None, envvar='CAKE_AUTHKEY', help="key clients have to prove they have")
+@click.option('--timeout', default=DEF_TASKDB_CONF['timeout'], type=float,
+              help="timeout for locking task DB in seconds")
+@click.option('--memory', is_flag=True,
+              help="hold the tasks in memory, writing them back to DATABASE periodically and on exit")
+def serve(database, address, authkey, timeout, memory):
+    """serve DATABASE to workers started with cake run --connect"""
+    conf = {'name': database}
+    conf.update(DEF_TASKDB_CONF)
+    conf['timeout'] = timeout
+    conf['intent'] = 'run'
+
+    if address is None:
+        address = database.rstrip('/') + '.sock'
+    if parse_address(address)[0] != socket.AF_UNIX and authkey is None:
+        raise click.UsageError("--authkey is needed to serve on TCP")
+
+    if memory:
+        taskdb_class = MemoryTaskDB
+    else:
+        taskdb_class = _taskdb_class(database)
+
+    with taskdb_class(**conf) as taskdb:
+        broker = TaskBroker(taskdb, address, authkey=authkey)
+        click.echo("serving %s at %s" % (database, broker.address), err=True)
+        broker.serve()
+
+
 @cli.command()
 @click.argument('database')
 @click.option('--state', default=None, help="only select from tasks with this state")
@@ -111,9 +249,9 @@ def list(database, state, with_runtime):
     """list tasks in DATABASE"""
     conf = {'name': database}
     conf.update(DEF_TASKDB_CONF)
-    conf['intent'] = 'examine'
+    conf['intent'] = 'read'
     state = _get_state(state)
-    with SQLiteTaskDB(**conf) as taskdb:
+    with _taskdb_class(database)(**conf) as taskdb:
         taskdb.list(state=state, with_runtime=with_runtime)
 
 
@@ -127,7 +265,7 @@ def delete(database, taskid, remove):
     conf = {'name': database}
     conf.update(DEF_TASKDB_CONF)
     conf['intent'] = 'examine'
-    with SQLiteTaskDB(**conf) as taskdb:
+    with _taskdb_class(database)(**conf) as taskdb:
         taskdb.delete(taskid, remove=remove)
 
 
@@ -143,7 +281,7 @@ def update(database, taskid, state, task, priority):
     conf.update(DEF_TASKDB_CONF)
     conf['intent'] = 'examine'
     state = _get_state(state)
-    with SQLiteTaskDB(**conf) as taskdb:
+    with _taskdb_class(database)(**conf) as taskdb:
         taskdb.update(taskid, state=state, priority=priority, task=task)
 
 
@@ -153,38 +291,66 @@ def update(database, taskid, state, task, priority):
 @click.option('--file', 'filename', default=None, help="file with tasks")
 @click.option('--task-id', default=None, help="id of task to add")
 @click.option('--priority', default=None, type=int, help="priority to set for task")
-def add(database, args, filename, task_id, priority):
+@click.option('--group', default=None, help="group to add the tasks to")
+@click.option('--format', 'fmt', default='lines', type=click.Choice(['lines', 'csv', 'jsonl']),
+              help="format of the tasks in the file or stdin")
+@click.option('--chunksize', default=10000, type=int, help="number of tasks to add to DATABASE at a time")
+@click.option('--atomic/--no-atomic', default=True,
+              help="add all tasks in one transaction or commit each chunk so running workers can go on")
+@click.option('--progress', is_flag=True, help="report the number of tasks added and rate to stderr")
+@click.option('--quiet', is_flag=True, help="do not print the ids of the added tasks")
+@click.option('--shards', default=None, type=int,
+              help="make DATABASE as a directory of this many task DB files if it does not exist")
+def add(database, args, filename, task_id, priority, group, fmt, chunksize, atomic, progress, quiet, shards):
     """add tasks to DATABASE"""
     conf = {'name': database}
     conf.update(DEF_TASKDB_CONF)
     conf['intent'] = 'examine'
-    with SQLiteTaskDB(**conf) as taskdb:
+    if shards is not None:
+        conf['num_shards'] = shards
+        taskdb_class = ShardedSQLiteTaskDB
+    else:
+        taskdb_class = _taskdb_class(database)
+
+    def _add_tasks(taskdb, fp):
+        stime = time.time()
+
+        def _callback(num_added, taskids):
+            if not quiet:
+                for taskid in taskids:
+                    click.echo(taskid)
+            if progress:
+                dt = time.time() - stime
+                click.echo("added %d tasks (%.0f tasks/s)" % (num_added, num_added / max(dt, 1e-6)), err=True)
+
+        # tasks are read and added a chunk at a time so the file is never held in memory
+        taskdb.add_multiple(read_tasks(fp, fmt=fmt), priority=priority, chunksize=chunksize,
+                            atomic=atomic, callback=_callback, return_ids=False, group=group)
+
+    with taskdb_class(**conf) as taskdb:
         if len(args) > 0:
-            taskid = taskdb.add(" ".join(args[2:]), id=task_id, priority=priority)
+            taskid = taskdb.add(" ".join(args), id=task_id, priority=priority, group=group)
             click.echo(taskid)
 
         if filename:
-            tsks = []
             with open(filename, 'r') as fp:
-                for line in fp:
-                    tsk = line.strip()
-                    if len(tsk) > 0:
-                        tsks.append(tsk)
-            taskids = taskdb.add_multiple(tsks, priority=priority)
-            for taskid in taskids:
-                click.echo(taskid)
-
-        if not sys.stdin.isatty():
-            lines = sys.stdin.readlines()
-            tsks = []
-            for line in lines:
-                tsk = line.strip()
-                if len(tsk) > 0:
-                    tsks.append(tsk)
-
-        taskids = taskdb.add_multiple(tsks, priority=priority)
-        for taskid in taskids:
-            click.echo(taskid)
+                _add_tasks(taskdb, fp)
+        elif len(args) == 0 and not sys.stdin.isatty():
+            _add_tasks(taskdb, sys.stdin)
+
+
+@cli.command()
+@click.argument('database')
+@click.argument('name')
+@click.option('--weight', default=None, type=float, help="share of the tasks checked out to give the group")
+@click.option('--aging', default=None, type=float, help="priority the tasks of the group gain per hour waiting")
+def group(database, name, weight, aging):
+    """set the weight or priority aging of task group NAME in DATABASE"""
+    conf = {'name': database}
+    conf.update(DEF_TASKDB_CONF)
+    conf['intent'] = 'examine'
+    with _taskdb_class(database)(**conf) as taskdb:
+        taskdb.set_group(name, weight=weight, aging=aging)
 
 
 @cli.command()
@@ -194,21 +360,25 @@ def log(database, taskid):
     """print logs for task TASKID in DATABASE"""
     conf = {'name': database}
     conf.update(DEF_TASKDB_CONF)
-    conf['intent'] = 'examine'
-    with SQLiteTaskDB(**conf) as taskdb:
+    conf['intent'] = 'read'
+    with _taskdb_class(database)(**conf) as taskdb:
         taskdb.log(taskid)
 
 
 @cli.command()
 @click.argument('database')
-def status(database):
+@click.option('--json', 'as_json', is_flag=True, help="print the status as JSON")
+def status(database, as_json):
     """print status of all tasks in DATABASE"""
     conf = {'name': database}
     conf.update(DEF_TASKDB_CONF)
-    conf['intent'] = 'examine'
+    conf['intent'] = 'read'
 
-    with SQLiteTaskDB(**conf) as taskdb:
-        taskdb.status()
+    with _taskdb_class(database)(**conf) as taskdb:
+        if as_json:
+            click.echo(json.dumps(taskdb.status(as_dict=True), indent=4))
+        else:
+            taskdb.status()
 
 
 @cli.command()
@@ -218,7 +388,7 @@ def reset(database):
     conf = {'name': database}
     conf.update(DEF_TASKDB_CONF)
     conf['intent'] = 'examine'
-    with SQLiteTaskDB(**conf) as taskdb:
+    with _taskdb_class(database)(**conf) as taskdb:
         taskdb.reset()
 
 
@@ -228,8 +398,8 @@ def runtime(database):
     """print runtime of all tasks in DATABASE"""
     conf = {'name': database}
     conf.update(DEF_TASKDB_CONF)
-    conf['intent'] = 'examine'
-    with SQLiteTaskDB(**conf) as taskdb:
+    conf['intent'] = 'read'
+    with _taskdb_class(database)(**conf) as taskdb:
         taskdb.runtime()
 
 
@@ -239,8 +409,8 @@ def state(database):
     """print the state of DATABASE"""
     conf = {'name': database}
     conf.update(DEF_TASKDB_CONF)
-    conf['intent'] = 'examine'
-    with SQLiteTaskDB(**conf) as taskdb:
+    conf['intent'] = 'read'
+    with _taskdb_class(database)(**conf) as taskdb:
         print(taskdb.state())
 
 
@@ -251,16 +421,47 @@ def pause(database):
     conf = {'name': database}
     conf.update(DEF_TASKDB_CONF)
     conf['intent'] = 'examine'
-    with SQLiteTaskDB(**conf) as taskdb:
+    with _taskdb_class(database)(**conf) as taskdb:
         taskdb.pause()
 
 
 @cli.command()
 @click.argument('database')
-def cleanup(database):
+@click.option('--expired', is_flag=True,
+              help="only reclaim the tasks of dead workers, whose leases have expired")
+def cleanup(database, expired):
     """cleanup the DATABASE after poorly exited run"""
     conf = {'name': database}
     conf.update(DEF_TASKDB_CONF)
     conf['intent'] = 'examine'
-    with SQLiteTaskDB(**conf) as taskdb:
-        taskdb.cleanup()
+    with _taskdb_class(database)(**conf) as taskdb:
+        if expired:
+            num_reclaimed = taskdb.cleanup(expired_only=True)
+            click.echo("reclaimed %d tasks" % num_reclaimed)
+        else:
+            taskdb.cleanup()
+
+
+@cli.command()
+@click.argument('database')
+@click.option('--no-compress', is_flag=True, help="store the logs of archived tasks uncompressed")
+def compact(database, no_compress):
+    """move finished tasks in DATABASE to its archive"""
+    conf = {'name': database}
+    conf.update(DEF_TASKDB_CONF)
+    conf['intent'] = 'examine'
+    with _taskdb_class(database)(**conf) as taskdb:
+        num_archived = taskdb.archive(compress=not no_compress)
+        click.echo("archived %d tasks" % num_archived)
+
+
+@cli.command()
+@click.argument('database')
+def migrate(database):
+    """upgrade DATABASE made by an older version of cake"""
+    conf = {'name': database}
+    conf.update(DEF_TASKDB_CONF)
+    conf['intent'] = 'migrate'
+    # opening the DB for migration upgrades it
+    with _taskdb_class(database)(**conf):
+        pass
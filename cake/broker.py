@@ -0,0 +1,266 @@
+from __future__ import print_function
+import io
+import os
+import sys
+import hmac
+import queue
+import signal
+import socket
+import threading
+import contextlib
+import socketserver
+
+from .defaults import TASK_STATES
+from .taskdbs.remote import parse_address, send_msg, recv_msg, auth_digest
+
+# the longest message taken in from a client before it is accepted
+HELLO_MAX_SIZE = 4096
+
+# the task DB methods clients can call through the broker
+BROKER_OPS = ['checkout_many', 'checkin_many', 'add', 'add_multiple', 'update', 'delete', 'reset', 'set_group',
+              'list', 'log', 'query', 'status', 'state', 'pause', 'run', 'cleanup', 'archive', 'runtime']
+
+
+class _Request(object):
+    __slots__ = ['client', 'msg', 'reply', 'done']
+
+    def __init__(self, client, msg):
+        self.client = client
+        self.msg = msg
+        self.reply = None
+        self.done = threading.Event()
+
+
+class _ClientHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        if self.request.family != socket.AF_UNIX:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # the tasks checked out by this client and not checked in yet
+        self.task_ids = set()
+
+        # the client proves it has the key by sending back the HMAC of a random challenge,
+        # in a message small enough that clients without the key cannot make the broker
+        # take in much of anything
+        challenge = os.urandom(32).hex()
+        send_msg(self.request, {'challenge': challenge})
+        try:
+            msg = recv_msg(self.request, max_size=HELLO_MAX_SIZE)
+        except ValueError as e:
+            msg = {}
+        if msg is None:
+            return
+        if (not isinstance(msg, dict) or msg.get('op') != 'hello' or not isinstance(msg.get('kwargs'), dict) or
+                not broker._check_digest(challenge, msg['kwargs'].get('digest'))):
+            send_msg(self.request, {'error': "The task broker did not accept the client!"})
+            return
+        send_msg(self.request, {'result': None})
+
+        try:
+            while True:
+                msg = recv_msg(self.request)
+                if msg is None:
+                    break
+                reply = broker._submit(self, msg)
+                try:
+                    send_msg(self.request, reply)
+                except (TypeError, ValueError) as e:
+                    # e.g., BLOBs returned by a query, which JSON cannot hold
+                    send_msg(self.request, {'error': "The task broker could not send the result of '%s'! - %s"
+                                                     % (msg.get('op'), e)})
+        except OSError as e:
+            pass
+        finally:
+            broker._submit(self, {'op': 'disconnect'})
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class TaskBroker(object):
+    """serve a task DB to RemoteTaskDB clients over a TCP or unix socket
+
+    The connections are read by one thread each, but only the thread calling serve uses
+    the task DB. It takes all of the requests waiting at once (up to max_batch) and runs
+    the checkins of all of the clients as one checkin_many and their checkouts as one
+    checkout_many per state, so that the DB is locked once per batch instead of once
+    per request. The tasks held by a client that disconnects are checked in as KILLED.
+
+    A broker on TCP needs an authkey, which clients prove they have by answering an HMAC
+    challenge. A unix socket can only be used by the user running the broker, so the
+    key is optional there. Queries are only run read-only."""
+
+    def __init__(self, taskdb, address, authkey=None, max_batch=256):
+        self._taskdb = taskdb
+        self._address = address
+        self._authkey = authkey
+        self._max_batch = max_batch
+        self._requests = queue.Queue()
+        self._stop = threading.Event()
+
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.remove(addr)
+            # only the user running the broker can connect to its unix socket
+            umask = os.umask(0o177)
+            try:
+                self._server = _UnixServer(addr, _ClientHandler)
+            finally:
+                os.umask(umask)
+        else:
+            # anyone who can reach the port could run any command on the workers
+            if authkey is None:
+                raise ValueError("A task broker listening on TCP needs an authkey!")
+            self._server = _TCPServer(addr, _ClientHandler)
+        self._server.broker = self
+
+    @property
+    def address(self):
+        """the address the broker listens on, with the port filled in if port 0 was asked for"""
+        if self._server.address_family == socket.AF_UNIX:
+            return self._server.server_address
+        return '%s:%d' % self._server.server_address[:2]
+
+    def _check_digest(self, challenge, digest):
+        if self._authkey is None:
+            return True
+        return isinstance(digest, str) and hmac.compare_digest(auth_digest(self._authkey, challenge), digest)
+
+    def _submit(self, client, msg):
+        """hand the request msg of client to the thread serving the DB and wait for the reply"""
+        request = _Request(client, msg)
+        self._requests.put(request)
+        while not request.done.wait(0.5):
+            if self._stop.is_set():
+                return {'error': "The task broker is shutting down!"}
+        return request.reply
+
+    def serve(self):
+        """serve the task DB until stop is called or the process gets SIGINT or SIGTERM"""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+        thread = threading.Thread(target=self._server.serve_forever, name='cake-broker')
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while not self._stop.is_set():
+                try:
+                    batch = [self._requests.get(timeout=0.5)]
+                except queue.Empty:
+                    continue
+
+                while len(batch) < self._max_batch:
+                    try:
+                        batch.append(self._requests.get_nowait())
+                    except queue.Empty:
+                        break
+
+                self._run_batch(batch)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop.set()
+            self._server.shutdown()
+            self._server.server_close()
+            if self._server.address_family == socket.AF_UNIX and os.path.exists(self._server.server_address):
+                os.remove(self._server.server_address)
+
+    def stop(self):
+        """stop serving the task DB"""
+        self._stop.set()
+
+    def _finish(self, request, reply):
+        request.reply = reply
+        request.done.set()
+
+    def _run_batch(self, batch):
+        checkins = []
+        checkouts = {}
+        for request in batch:
+            op = request.msg.get('op')
+            if op == 'checkin_many':
+                checkins.append(request)
+            elif op == 'checkout_many':
+                kwargs = request.msg.get('kwargs', {})
+                checkouts.setdefault(kwargs.get('state'), []).append(request)
+            elif op == 'disconnect':
+                self._disconnect(request)
+            else:
+                self._run_op(request)
+
+        if len(checkins) > 0:
+            self._checkin(checkins)
+        for state, requests in checkouts.items():
+            self._checkout(state, requests)
+
+    def _run_op(self, request):
+        op = request.msg.get('op')
+        if op not in BROKER_OPS:
+            self._finish(request, {'error': "The task broker does not support '%s'!" % op})
+            return
+
+        # anything the op prints is sent back to be printed by the client
+        output = io.StringIO()
+        try:
+            kwargs = request.msg.get('kwargs', {})
+            if op == 'query':
+                # clients can read the DB but not write to it (or to any other file) with SQL
+                kwargs['read_only'] = True
+            with contextlib.redirect_stdout(output):
+                result = getattr(self._taskdb, op)(*request.msg.get('args', []), **kwargs)
+            reply = {'result': result}
+        except Exception as e:
+            reply = {'error': str(e)}
+        reply['output'] = output.getvalue()
+        self._finish(request, reply)
+
+    def _checkin(self, requests):
+        results = [tuple(result) for request in requests for result in request.msg['args'][0]]
+        try:
+            self._taskdb.checkin_many(results)
+        except Exception as e:
+            # run them one client at a time so that only the bad checkins fail
+            for request in requests:
+                self._run_op(request)
+                if 'error' not in request.reply:
+                    request.client.task_ids.difference_update(r[0] for r in request.msg['args'][0])
+            return
+
+        for request in requests:
+            request.client.task_ids.difference_update(r[0] for r in request.msg['args'][0])
+            self._finish(request, {'result': None})
+
+    def _checkout(self, state, requests):
+        num = sum(request.msg['args'][0] for request in requests)
+        try:
+            tasks = self._taskdb.checkout_many(num, state=state)
+        except Exception as e:
+            for request in requests:
+                self._finish(request, {'error': str(e)})
+            return
+
+        for request in requests:
+            n = request.msg['args'][0]
+            request.client.task_ids.update(id for _, id in tasks[:n])
+            self._finish(request, {'result': tasks[:n]})
+            tasks = tasks[n:]
+
+    def _disconnect(self, request):
+        task_ids = request.client.task_ids
+        if len(task_ids) > 0:
+            try:
+                self._taskdb.checkin_many([(id, TASK_STATES.KILLED, 'client disconnected') for id in task_ids])
+            except Exception as e:
+                print("CAKE: could not checkin the tasks of a disconnected client - %s" % e, file=sys.stderr)
+            task_ids.clear()
+        self._finish(request, {'result': None})
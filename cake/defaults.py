@@ -2,11 +2,29 @@
 
 DEF_TASKDB_CONF = {'timeout': 10.0,  # seconds
                    'task_checkout_delay': 1.0,  # seconds
-                   'task_checkout_num_tries': 10}
+                   'task_checkout_num_tries': 10,
+                   'journal_mode': 'auto',  # WAL unless the DB is on a network filesystem
+                   'synchronous': None,  # NORMAL in WAL mode and FULL otherwise
+                   'cache_size': -16384,  # pages, or KiB if negative
+                   'mmap_size': 0,  # bytes
+                   'busy_timeout': 0.1,  # seconds
+                   'cached_statements': 256,
+                   'lock_backoff_min': 0.001,  # seconds
+                   'lock_backoff_max': 0.25,  # seconds
+                   'lease_time': 30.0,  # seconds, or None to turn off leases
+                   'heartbeat_interval': None,  # seconds, a third of the lease time if None
+                   'snapshot_interval': 10.0,  # seconds between writes of a MemoryTaskDB to its file
+                   'journal_sync_interval': 1.0}  # seconds between fsyncs of a MemoryTaskDB journal, or None
+
+# filesystems that WAL mode cannot be used on since their clients do not share memory
+NETWORK_FILESYSTEMS = ['nfs', 'nfs4', 'lustre', 'gpfs', 'cifs', 'smbfs', 'smb3', 'afs', 'ceph',
+                       'glusterfs', 'fuse.glusterfs', 'fuse.sshfs', 'beegfs', 'panfs', 'pvfs2',
+                       'ocfs2', 'gfs2']
 
 
 class TASK_STATES(object):
     QUEUED_NO_DEP = 'QUEUED_NO_DEP'
+    QUEUED_WITH_DEP = 'QUEUED_WITH_DEP'
     RUNNING = 'RUNNING'
     FAILED = 'FAILED'
     SUCCEEDED = 'SUCCEEDED'
@@ -16,6 +34,7 @@ class TASK_STATES(object):
 
 
 LIST_OF_TASK_STATES = [TASK_STATES.QUEUED_NO_DEP,
+                       TASK_STATES.QUEUED_WITH_DEP,
                        TASK_STATES.RUNNING,
                        TASK_STATES.FAILED,
                        TASK_STATES.SUCCEEDED,
@@ -23,6 +42,15 @@ LIST_OF_TASK_STATES = [TASK_STATES.QUEUED_NO_DEP,
                        TASK_STATES.DELETED,
                        TASK_STATES.KILLED]
 
+# tasks in these states are run by checkout when no state is given
+CHECKOUT_TASK_STATES = [TASK_STATES.QUEUED_NO_DEP,
+                        TASK_STATES.CHECKPOINTED,
+                        TASK_STATES.KILLED]
+
+# tasks in these states are finished for good and can be moved to the archive
+ARCHIVE_TASK_STATES = [TASK_STATES.SUCCEEDED,
+                       TASK_STATES.DELETED]
+
 
 class TASK_LOG_ACTIONS(object):
     ADDED = 'ADDED'
@@ -36,14 +64,32 @@ class TASK_LOG_ACTIONS(object):
     KILLED = 'KILLED'
     UPDATED = 'UPDATED'
     CLEANED = 'CLEANED'
+    EXPIRED = 'EXPIRED'
 
 
+LIST_OF_TASK_LOG_ACTIONS = [TASK_LOG_ACTIONS.ADDED,
+                            TASK_LOG_ACTIONS.RAN,
+                            TASK_LOG_ACTIONS.RAN_FROM_CHECKPOINT,
+                            TASK_LOG_ACTIONS.DELETED,
+                            TASK_LOG_ACTIONS.RESET,
+                            TASK_LOG_ACTIONS.FAILED,
+                            TASK_LOG_ACTIONS.SUCCEEDED,
+                            TASK_LOG_ACTIONS.CHECKPOINTED,
+                            TASK_LOG_ACTIONS.KILLED,
+                            TASK_LOG_ACTIONS.UPDATED,
+                            TASK_LOG_ACTIONS.CLEANED,
+                            TASK_LOG_ACTIONS.EXPIRED]
+
 VALID_LOG_CHECKIN_ACTIONS = [TASK_LOG_ACTIONS.FAILED,
                              TASK_LOG_ACTIONS.SUCCEEDED,
                              TASK_LOG_ACTIONS.CHECKPOINTED,
                              TASK_LOG_ACTIONS.KILLED]
 
 
+# number of files a sharded task DB is split into when it is made
+DEF_NUM_SHARDS = 8
+
+
 class TASKDB_STATES(object):
     RUNNING = 'RUNNING'
     PAUSED = 'PAUSED'
@@ -0,0 +1,299 @@
+"""launch the commands of tasks
+
+Running a task with subprocess.run(tsk, shell=True) forks the worker, which may be a large
+python process, and then execs /bin/sh to parse the command. Commands without any shell
+syntax (e.g., `prog arg arg`) are instead run directly with posix_spawn here, and the rest
+with /bin/sh -c, also with posix_spawn. A ForkServer goes one step further and launches the
+commands from a small helper process started once, so the worker itself never forks.
+
+This module only uses the standard library so that the helper process can run it as a
+script without importing the rest of cake."""
+import os
+import sys
+import json
+import shlex
+import signal
+import select
+import socket
+import shutil
+import time
+import tempfile
+import threading
+import subprocess
+
+# characters that need a shell to mean what they mean in a command
+SHELL_CHARS = set('|&;<>()$`\\*?[]#~{}!\n')
+
+# shell keywords and builtins that cannot be exec'ed
+SHELL_WORDS = set(['.', ':', 'alias', 'bg', 'break', 'case', 'cd', 'command', 'continue', 'declare', 'do',
+                   'done', 'elif', 'else', 'esac', 'eval', 'exec', 'exit', 'export', 'fg', 'fi', 'for',
+                   'function', 'getopts', 'hash', 'if', 'jobs', 'local', 'read', 'readonly', 'return', 'select',
+                   'set', 'shift', 'source', 'then', 'time', 'times', 'trap', 'type', 'typeset', 'ulimit',
+                   'umask', 'unalias', 'unset', 'until', 'wait', 'while'])
+
+LAUNCHERS = ['spawn', 'forkserver', 'shell']
+
+# python ignores SIGPIPE and SIGXFSZ, and the fork server SIGINT, so they are set back to
+# the default in the tasks like subprocess does with restore_signals
+DEFAULT_SIGNALS = [getattr(signal, name) for name in ['SIGPIPE', 'SIGXFSZ', 'SIGINT'] if hasattr(signal, name)]
+
+
+def split_command(tsk):
+    """split tsk into the arguments to exec if it can be run without a shell, otherwise None"""
+    if any(c in SHELL_CHARS for c in tsk):
+        return None
+
+    try:
+        argv = shlex.split(tsk)
+    except ValueError as e:
+        return None
+
+    # variable assignments before the command need a shell too
+    if len(argv) == 0 or argv[0] in SHELL_WORDS or '=' in argv[0]:
+        return None
+    return argv
+
+
+def spawn(tsk, setsid=False):
+    """start the command tsk, returning its pid"""
+    argv = split_command(tsk)
+    if argv is not None:
+        try:
+            return os.posix_spawnp(argv[0], argv, os.environ, setsid=setsid, setsigdef=DEFAULT_SIGNALS)
+        except OSError as e:
+            # leave reporting a missing or bad program to the shell, as if there were no shortcut
+            pass
+    return os.posix_spawn('/bin/sh', ['/bin/sh', '-c', tsk], os.environ, setsid=setsid, setsigdef=DEFAULT_SIGNALS)
+
+
+def wait(pid):
+    """wait for the process pid to end, returning its exit code like subprocess does"""
+    return os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+
+
+def run_bundle(tsks, started=None, ended=None):
+    """run the commands tsks one after the other in one shell session
+
+    Each command runs in a subshell of the session, so that `exit` or `cd` in one does not
+    touch the others, and the session reports when each starts and ends with its exit code
+    on fd 3. started(i, stime) and ended(i, code, stime, etime) are called for the i-th
+    command as the reports come in. Commands the session never got to (e.g., after one that
+    is not valid shell syntax) are run on their own. Returns the exit code and the start and
+    end times of each command."""
+    script = []
+    for i, tsk in enumerate(tsks):
+        script.append("printf 's %d\\n' >&3\n( " % i + tsk + "\n) 3>&-\nprintf 'e %d %%d\\n' $? >&3\n" % i)
+
+    r, w = os.pipe()
+    if w == 3:
+        # posix_spawn may keep close-on-exec set when dup'ing a fd onto itself
+        w, _w = os.dup(w), w
+        os.close(_w)
+    try:
+        pid = os.posix_spawn('/bin/sh', ['/bin/sh', '-c', ''.join(script)], os.environ,
+                             file_actions=[(os.POSIX_SPAWN_DUP2, w, 3)], setsigdef=DEFAULT_SIGNALS)
+    finally:
+        os.close(w)
+
+    results = [None] * len(tsks)
+    stimes = {}
+
+    def _start(i, stime):
+        stimes[i] = stime
+        if started is not None:
+            started(i, stime)
+
+    def _end(i, code, etime):
+        results[i] = (code, stimes[i], etime)
+        if ended is not None:
+            ended(i, code, stimes[i], etime)
+
+    with os.fdopen(r, 'rb') as fp:
+        for line in fp:
+            items = line.split()
+            if items[0] == b's':
+                _start(int(items[1]), time.time())
+            else:
+                _end(int(items[1]), int(items[2]), time.time())
+    err = wait(pid)
+
+    for i, tsk in enumerate(tsks):
+        if results[i] is not None:
+            continue
+
+        if i in stimes:
+            # the session ended in the middle of the command
+            _end(i, err if err != 0 else 1, time.time())
+        else:
+            _start(i, time.time())
+            _end(i, wait(spawn(tsk)), time.time())
+
+    return results
+
+
+class SpawnLauncher(object):
+    """run commands with posix_spawn from the calling process"""
+
+    def __call__(self, tsk):
+        return wait(spawn(tsk))
+
+    def close(self):
+        pass
+
+
+class ShellLauncher(object):
+    """run commands with subprocess.run(tsk, shell=True)"""
+
+    def __call__(self, tsk):
+        return subprocess.run(tsk, shell=True).returncode
+
+    def close(self):
+        pass
+
+
+class ForkServer(object):
+    """run commands from a small helper process
+
+    The helper is a fresh python interpreter running this module, so starting a task never
+    forks the worker. Each process (and thread) using the fork server gets a connection of
+    its own, so it can be shared with processes forked after it is made. The commands still
+    running when their connection closes are killed, as is everything once the process that
+    made the fork server exits."""
+
+    def __init__(self):
+        if not hasattr(os, 'pidfd_open'):
+            raise ValueError("The fork server needs os.pidfd_open (linux and python 3.9 or later)!")
+
+        self._pid = os.getpid()
+        self._dir = tempfile.mkdtemp(prefix='cake-launcher-')
+        self._address = os.path.join(self._dir, 'launcher.sock')
+        self._local = threading.local()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self._address)
+        listener.listen(128)
+        try:
+            # the helper holds stdin open until this process is gone
+            self._proc = subprocess.Popen([sys.executable, '-I', os.path.abspath(__file__), str(listener.fileno())],
+                                          stdin=subprocess.PIPE, pass_fds=[listener.fileno()])
+        finally:
+            listener.close()
+
+    def __getstate__(self):
+        # processes started by pickling the fork server only connect to it
+        return {'_pid': self._pid, '_dir': self._dir, '_address': self._address}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._proc = None
+
+    def _connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(self._address)
+            self._local.conn = conn
+            self._local.rfile = conn.makefile('rb')
+            self._local.pid = os.getpid()
+        return self._local.conn, self._local.rfile
+
+    def __call__(self, tsk):
+        conn, rfile = self._connection()
+        conn.sendall((json.dumps(tsk) + '\n').encode('utf-8'))
+        line = rfile.readline()
+        if len(line) == 0:
+            raise ValueError("The fork server went away!")
+        return json.loads(line)
+
+    def close(self):
+        if getattr(self._local, 'pid', None) == os.getpid():
+            self._local.rfile.close()
+            self._local.conn.close()
+            self._local.pid = None
+
+        # only the process that started the helper stops it
+        if os.getpid() == self._pid and self._proc.poll() is None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def get_launcher(kind='spawn'):
+    """make the launcher of the given kind ('spawn', 'forkserver' or 'shell')"""
+    if kind == 'spawn':
+        return SpawnLauncher()
+    elif kind == 'forkserver':
+        return ForkServer()
+    elif kind == 'shell':
+        return ShellLauncher()
+    else:
+        raise ValueError("Launcher '%s' is not one of %s!" % (kind, LAUNCHERS))
+
+
+def _kill(pids):
+    for pid in pids:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError as e:
+            pass
+
+
+def _serve(fd):
+    """run the fork server helper on the listening socket fd"""
+    # the process that started the helper decides when tasks are interrupted (the tasks
+    # themselves get the default SIGINT back from spawn)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    lock = threading.Lock()
+    running = set()
+
+    def _wait(conn, pid):
+        """wait for the task pid to end, returning its exit code or None if conn closed first"""
+        with os.fdopen(os.pidfd_open(pid), 'rb', buffering=0) as pidfd:
+            ready, _, _ = select.select([pidfd, conn], [], [])
+            if pidfd not in ready and len(conn.recv(1, socket.MSG_PEEK)) == 0:
+                return None
+        return wait(pid)
+
+    def _handle(conn):
+        with conn, conn.makefile('rb') as rfile:
+            # clients wait on each command before sending the next
+            for line in rfile:
+                # each task gets a session of its own so that all of it can be killed
+                pid = spawn(json.loads(line), setsid=True)
+                with lock:
+                    running.add(pid)
+                code = _wait(conn, pid)
+                with lock:
+                    if code is None:
+                        _kill([pid])
+                    running.discard(pid)
+                if code is None:
+                    wait(pid)
+                    break
+                conn.sendall((json.dumps(code) + '\n').encode('utf-8'))
+
+    def _accept(listener):
+        while True:
+            conn, _ = listener.accept()
+            thread = threading.Thread(target=_handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _stop(signum, frame):
+        with lock:
+            _kill(running)
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, _stop)
+
+    thread = threading.Thread(target=_accept, args=(socket.socket(fileno=fd),))
+    thread.daemon = True
+    thread.start()
+
+    sys.stdin.buffer.read()
+    _stop(None, None)
+
+
+if __name__ == '__main__':
+    _serve(int(sys.argv[1]))
@@ -0,0 +1,87 @@
+"""tasks that call a python function instead of running a shell command
+
+A task of the form
+
+    pycall:package.module:function {"args": [1, 2], "kwargs": {"x": 3}}
+
+calls package.module.function(1, 2, x=3), with the JSON arguments optional. The pool
+processes of PMPWorker and the MPI worker ranks call the function themselves, so the
+modules it imports stay imported from one task to the next. Everywhere else the task is
+run in a fresh python interpreter. The task fails if the function raises an exception or
+calls sys.exit with a non-zero code, and its return value is ignored."""
+import sys
+import json
+import shlex
+import importlib
+import traceback
+
+PYCALL_PREFIX = 'pycall:'
+
+
+def pycall(func, *args, **kwargs):
+    """make the task calling func (a function or 'package.module:function') with args and kwargs"""
+    if callable(func):
+        func = '%s:%s' % (func.__module__, func.__qualname__)
+    tsk = PYCALL_PREFIX + func
+    if len(args) > 0 or len(kwargs) > 0:
+        tsk += ' ' + json.dumps({'args': list(args), 'kwargs': kwargs})
+    return tsk
+
+
+def is_pycall(tsk):
+    """test if the task tsk calls a python function"""
+    return tsk.startswith(PYCALL_PREFIX)
+
+
+def parse_pycall(tsk):
+    """get the function, args and kwargs of the task tsk, importing its module"""
+    parts = tsk[len(PYCALL_PREFIX):].strip().split(None, 1)
+    if len(parts) == 0 or ':' not in parts[0]:
+        raise ValueError("Task '%s' does not name a 'package.module:function'!" % tsk)
+
+    modname, funcname = parts[0].split(':', 1)
+    func = importlib.import_module(modname)
+    for name in funcname.split('.'):
+        func = getattr(func, name)
+
+    args = []
+    kwargs = {}
+    if len(parts) > 1:
+        params = json.loads(parts[1])
+        if not isinstance(params, dict) or len(set(params) - set(['args', 'kwargs'])) > 0:
+            raise ValueError("The arguments of task '%s' must be a JSON object with 'args' and "
+                             "'kwargs'!" % tsk)
+        args = params.get('args', [])
+        kwargs = params.get('kwargs', {})
+
+    return func, args, kwargs
+
+
+def run_pycall(tsk):
+    """call the function of the task tsk in this process, returning an exit code like a shell command would"""
+    try:
+        func, args, kwargs = parse_pycall(tsk)
+        func(*args, **kwargs)
+        code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except Exception as e:
+        traceback.print_exc()
+        code = 1
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return code
+
+
+def command(tsk):
+    """get the shell command to run the task tsk in a process of its own"""
+    if not is_pycall(tsk):
+        return tsk
+    return ' '.join(shlex.quote(arg) for arg in
+                    [sys.executable, '-c', 'import sys; from cake.pycall import run_pycall; '
+                     'sys.exit(run_pycall(sys.argv[1]))', tsk])
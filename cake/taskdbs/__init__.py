@@ -1,3 +1,6 @@
 # flake8: noqa
 from .sqlite import SQLiteTaskDB
+from .sharded import ShardedSQLiteTaskDB
+from .memory import MemoryTaskDB
+from .remote import RemoteTaskDB
 from .base import BaseTaskDB
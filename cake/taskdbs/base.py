@@ -7,18 +7,33 @@ class BaseTaskDB(metaclass=ABCMeta):
         """checkout a task for running"""
         pass
 
+    def checkout_many(self, n, state=None):
+        """checkout up to n tasks for running"""
+        tasks = []
+        for i in range(n):
+            task, id = self.checkout(state=state)
+            if task is None:
+                break
+            tasks.append((task, id))
+        return tasks
+
     @abstractmethod
     def checkin(self, state):
         """checkin a task that has been run"""
         pass
 
+    def checkin_many(self, results):
+        """checkin a list of (task_id, state, info) for tasks that have been run"""
+        for task_id, state, info in results:
+            self.checkin(task_id, state, info=info)
+
     @abstractmethod
-    def add(self, cmd, id=None):
-        """add a task to be run via cmd"""
+    def add(self, cmd, id=None, priority=None, depends_on=None, group=None):
+        """add a task to be run via cmd once the tasks with IDs in depends_on have succeeded"""
         pass
 
     @abstractmethod
-    def add_multiple(self, cmd, id=None):
+    def add_multiple(self, cmds, id=None, priority=None):
         """add a tasks to be run via cmd"""
         pass
 
@@ -64,7 +79,7 @@ class BaseTaskDB(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def status(self):
+    def status(self, as_dict=False):
         """get status of task DB"""
         pass
 
@@ -84,11 +99,16 @@ class BaseTaskDB(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def cleanup(self):
-        """cleanup the task DB"""
+    def cleanup(self, expired_only=False):
+        """cleanup the task DB, or only the tasks whose leases expired if expired_only is True"""
+        pass
+
+    @abstractmethod
+    def archive(self, compress=True):
+        """move finished tasks out of the working set of the task DB"""
         pass
 
     @abstractmethod
-    def runtime(self):
+    def runtime(self, as_dict=False):
         """get run time stats for tasks in the DB"""
         pass
@@ -0,0 +1,648 @@
+from __future__ import print_function
+import os
+import time
+import uuid
+import json
+import fcntl
+import heapq
+import itertools
+
+from ..defaults import TASK_STATES, TASKDB_STATES, TASK_LOG_ACTIONS
+from ..defaults import LIST_OF_TASK_STATES, VALID_LOG_CHECKIN_ACTIONS, CHECKOUT_TASK_STATES, ARCHIVE_TASK_STATES
+from ..defaults import DEF_TASKDB_CONF
+from .base import BaseTaskDB
+from .sqlite import SQLiteTaskDB, DEFAULT_GROUP, print_tasks, _now, _sort_key
+
+# tasks in these states wait on the tasks they depend on
+QUEUED_TASK_STATES = [TASK_STATES.QUEUED_NO_DEP, TASK_STATES.QUEUED_WITH_DEP]
+
+
+class _MemoryTask(object):
+    __slots__ = ['cmd', 'state', 'priority', 'start_time', 'end_time', 'num_attempts', 'runtime',
+                 'num_deps_left', 'group', 'add_time', 'sort_key', 'seq']
+
+    def __init__(self, cmd, state, priority, start_time=None, end_time=None, num_attempts=0, runtime=None,
+                 num_deps_left=0, group=DEFAULT_GROUP, add_time=None, sort_key=0.0):
+        self.cmd = cmd
+        self.state = state
+        self.priority = priority
+        self.start_time = start_time
+        self.end_time = end_time
+        self.num_attempts = num_attempts
+        self.runtime = runtime
+        self.num_deps_left = num_deps_left
+        self.group = group
+        self.add_time = add_time
+        self.sort_key = sort_key
+        self.seq = None
+
+
+class MemoryTaskDB(BaseTaskDB):
+    """task DB held in memory, backed by a SQLite task DB
+
+    The tasks of the SQLite task DB called name are loaded into a dict and a heap of
+    the queued tasks per state, so that checkout and checkin never touch the disk.
+    Every change is appended to a journal next to the DB file before it is returned
+    and the changed tasks are written back to the SQLite DB every snapshot_interval
+    seconds and on close. A DB left behind by a crash has its journal replayed into it
+    when it is next opened, so the journal fsync interval (journal_sync_interval) bounds
+    the changes lost if the node goes down and none are lost if only the process dies.
+
+    Only one process can have the DB loaded. Other clients of the SQLite DB should only
+    inspect it while it is loaded, and the tasks they see are up to snapshot_interval old.
+    Tasks are checked out in order of priority across all groups, without the fair-share
+    between the groups done by SQLiteTaskDB."""
+
+    def __init__(self, **conf):
+        self._conf = {}
+        self._conf.update(conf)
+        self._conf['intent'] = self._conf.get('intent', 'examine')
+        for key in ['snapshot_interval', 'journal_sync_interval']:
+            self._conf[key] = self._conf.get(key, DEF_TASKDB_CONF[key])
+
+        self._sqlite = SQLiteTaskDB(**self._conf)
+        self._journal = None
+        try:
+            self._open_journal()
+            self._load()
+        except Exception as e:
+            if self._journal is not None:
+                self._journal.close()
+            self._sqlite.close()
+            raise
+
+    def _open_journal(self):
+        """lock and replay the journal left behind by a crashed MemoryTaskDB"""
+        self._journal_name = self._conf['name'] + '.journal'
+        self._journal = open(self._journal_name, 'a+')
+        try:
+            fcntl.flock(self._journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            self._journal.close()
+            self._journal = None
+            raise ValueError("Task DB '%s' is already loaded by another MemoryTaskDB!" % self._conf['name'])
+
+        self._journal.seek(0)
+        header = None
+        records = []
+        for line in self._journal:
+            try:
+                if header is None:
+                    header = json.loads(line)
+                else:
+                    records.append(json.loads(line))
+            except ValueError as e:
+                # the last record was cut off by the crash, so it was never acknowledged
+                break
+
+        if header is not None:
+            self._write_back([row for r in records for row in r['tasks']],
+                             [log for r in records for log in r['logs']],
+                             [dep for r in records for dep in r['deps']])
+            self._reclaim_client(header['client'])
+
+        self._truncate_journal()
+        self._last_sync = time.time()
+
+    def _truncate_journal(self):
+        """empty the journal, leaving the header naming the client that writes it"""
+        self._journal.seek(0)
+        self._journal.truncate()
+        self._journal.write(json.dumps({'client': self._sqlite._client_id}) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _reclaim_client(self, client_id):
+        """mark the tasks left running by the crashed MemoryTaskDB with client_id as KILLED"""
+        sqlite = self._sqlite
+        if sqlite._lock_db(exclusive=True, msg='reclaim client'):
+            try:
+                c = sqlite._conn.cursor()
+                keys = c.execute("SELECT ID FROM TASKDATA WHERE STATE = ? AND CLIENT = ?",
+                                 (sqlite._state_codes[TASK_STATES.RUNNING], client_id)).fetchall()
+                c.executemany("INSERT INTO LOGDATA (TASK, ACTION, TIME, INFO) VALUES (?, ?, ?, 'lease expired')",
+                              [key + (sqlite._action_codes[TASK_LOG_ACTIONS.EXPIRED], _now()) for key in keys])
+                c.executemany("UPDATE TASKDATA SET STATE = ?, LEASE_EXPIRY = NULL, CLIENT = NULL WHERE ID = ?",
+                              [(sqlite._state_codes[TASK_STATES.KILLED],) + key for key in keys])
+                c.execute("DELETE FROM CLIENTS WHERE CLIENT_ID = ?", (client_id,))
+                sqlite._unlock_db()
+            except Exception as e:
+                sqlite._rollback_db()
+                raise ValueError("Could not reclaim the tasks of client %s! - %s" % (client_id, e))
+        else:
+            raise ValueError("Could not get lock to reclaim the tasks of client %s!" % client_id)
+
+    def _load(self):
+        """read the tasks of the SQLite DB into memory"""
+        self._tasks = {}
+        self._queues = dict((state, []) for state in LIST_OF_TASK_STATES)
+        self._dependents = {}
+        self._seq = itertools.count()
+
+        c = self._sqlite._conn.cursor()
+        self._aging = dict(c.execute("SELECT NAME, AGING FROM GROUPS").fetchall())
+        c.execute("SELECT t.TASK_ID, t.CMD, t.STATE, t.PRIORITY, t.START_TIME, t.END_TIME, t.NUM_ATTEMPTS,\n"
+                  "t.RUNTIME, t.NUM_DEPS_LEFT, g.NAME, t.ADD_TIME, t.SORT_KEY\n"
+                  "FROM TASKDATA AS t LEFT JOIN GROUPS AS g ON g.CODE = t.GRP ORDER BY t.ID")
+        for row in c:
+            task = _MemoryTask(row[1], self._sqlite._state_names[row[2]], *row[3:])
+            if task.group is None:
+                task.group = DEFAULT_GROUP
+            self._tasks[row[0]] = task
+            self._push(row[0], task)
+
+        c.execute("SELECT t.TASK_ID, d.TASK_ID FROM DEPENDENCIES AS p\n"
+                  "JOIN TASKDATA AS t ON t.ID = p.TASK JOIN TASKDATA AS d ON d.ID = p.DEPENDS_ON")
+        for task_id, dep_id in c:
+            self._dependents.setdefault(dep_id, []).append(task_id)
+
+        self._db_state = c.execute("SELECT STATE FROM INFO").fetchone()[0]
+
+        self._dirty = {}
+        self._touched = {}
+        self._logs = []
+        self._deps = []
+        self._dep_logs = []
+        self._last_snapshot = time.time()
+
+    def _archived_state(self, task_id):
+        """the state of the task in the archive of the SQLite DB, or None if it is not there"""
+        row = self._sqlite._conn.execute("SELECT STATE FROM ARCHIVEDATA WHERE TASK_ID = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        return self._sqlite._state_names[row[0]]
+
+    def _push(self, task_id, task):
+        """queue the task to be checked out in its state, highest sort key first
+
+        Entries left in the heaps by tasks that changed since are skipped when popped."""
+        if task.state != TASK_STATES.RUNNING:
+            task.seq = next(self._seq)
+            heapq.heappush(self._queues[task.state], (-task.sort_key, task.seq, task_id))
+
+    def _pop(self, states):
+        """pop the ID of the highest priority task with a state in states, or None"""
+        best = None
+        for state in states:
+            heap = self._queues[state]
+            while len(heap) > 0:
+                task = self._tasks.get(heap[0][2])
+                if task is not None and task.state == state and task.seq == heap[0][1]:
+                    break
+                heapq.heappop(heap)
+
+            if len(heap) > 0 and (best is None or heap[0] < self._queues[best][0]):
+                best = state
+
+        if best is None:
+            return None
+        return heapq.heappop(self._queues[best])[2]
+
+    def _set_state(self, task_id, task, state):
+        old_state = task.state
+        task.state = state
+        self._push(task_id, task)
+        self._touch(task_id, task)
+        self._update_dependents(task_id, old_state, state)
+
+    def _update_dependents(self, task_id, old_state, new_state):
+        """count the task as done, or not done any more, for the tasks that depend on it
+
+        As in SQLiteTaskDB, the tasks still waiting on a task deleted before it SUCCEEDED are
+        deleted too, with their logs kept until the next record."""
+        if old_state == new_state:
+            return
+
+        if new_state == TASK_STATES.DELETED and old_state != TASK_STATES.SUCCEEDED:
+            for dep_id in self._dependents.get(task_id, []):
+                dep = self._tasks.get(dep_id)
+                if dep is not None and dep.state == TASK_STATES.QUEUED_WITH_DEP:
+                    self._dep_logs.append([dep_id, TASK_LOG_ACTIONS.DELETED, _now(),
+                                           'depends on deleted task %s' % task_id])
+                    self._set_state(dep_id, dep, TASK_STATES.DELETED)
+
+        if (old_state in ARCHIVE_TASK_STATES) == (new_state in ARCHIVE_TASK_STATES):
+            return
+
+        delta = -1 if new_state in ARCHIVE_TASK_STATES else 1
+        for dep_id in self._dependents.get(task_id, []):
+            dep = self._tasks.get(dep_id)
+            if dep is None:
+                continue
+            dep.num_deps_left += delta
+            self._touch(dep_id, dep)
+            if dep.state in QUEUED_TASK_STATES:
+                state = TASK_STATES.QUEUED_WITH_DEP if dep.num_deps_left > 0 else TASK_STATES.QUEUED_NO_DEP
+                if state != dep.state:
+                    self._set_state(dep_id, dep, state)
+
+    def _touch(self, task_id, task):
+        """mark the task as changed by the current operation and since the last snapshot"""
+        self._dirty[task_id] = task
+        self._touched[task_id] = task
+
+    def _row(self, task_id, task, now):
+        """the row written back to the SQLite DB (and journal) for a task"""
+        if task.state == TASK_STATES.RUNNING:
+            # the leases taken here are renewed by the heartbeat of the SQLite DB until the next snapshot
+            lease_expiry, client = self._sqlite._lease_expiry(now), self._sqlite._client_id
+        else:
+            lease_expiry, client = None, None
+
+        return [task_id, task.cmd, task.state, task.priority, task.start_time, task.end_time, task.num_attempts,
+                task.runtime, task.num_deps_left, lease_expiry, client, task.group, task.add_time, task.sort_key]
+
+    def _record(self, logs, deps=()):
+        """append the tasks changed by the current operation and their logs to the journal"""
+        now = _now()
+        logs = logs + self._dep_logs
+        self._dep_logs = []
+        rec = {'tasks': [self._row(task_id, task, now) for task_id, task in self._touched.items()],
+               'logs': logs,
+               'deps': list(deps)}
+        self._touched = {}
+        self._logs.extend(logs)
+        self._deps.extend(deps)
+        self._journal.write(json.dumps(rec) + '\n')
+        self._journal.flush()
+
+        interval = self._conf['journal_sync_interval']
+        if interval is not None and time.time() - self._last_sync >= interval:
+            os.fsync(self._journal.fileno())
+            self._last_sync = time.time()
+
+        self._maybe_snapshot()
+
+    def _write_back(self, rows, logs, deps):
+        """write rows of tasks, their logs and new dependencies to the SQLite DB in one transaction"""
+        sqlite = self._sqlite
+        if sqlite._lock_db(exclusive=True, msg='write back'):
+            try:
+                c = sqlite._conn.cursor()
+                groups = {}
+                for (task_id, cmd, state, priority, start_time, end_time, num_attempts, runtime, num_deps_left,
+                     lease_expiry, client, group, add_time, sort_key) in rows:
+                    vals = (cmd, sqlite._state_codes[state], priority, start_time, end_time, num_attempts, runtime,
+                            num_deps_left, lease_expiry, client, sort_key)
+                    res = c.execute("UPDATE TASKDATA SET CMD = ?, STATE = ?, PRIORITY = ?, START_TIME = ?,\n"
+                                    "END_TIME = ?, NUM_ATTEMPTS = ?, RUNTIME = ?, NUM_DEPS_LEFT = ?,\n"
+                                    "LEASE_EXPIRY = ?, CLIENT = ?, SORT_KEY = ? WHERE TASK_ID = ?",
+                                    vals + (task_id,))
+                    if res.rowcount == 0:
+                        if group not in groups:
+                            groups[group] = sqlite._group(c, group)[0]
+                        c.execute("INSERT INTO TASKDATA (CMD, STATE, PRIORITY, START_TIME, END_TIME, NUM_ATTEMPTS,\n"
+                                  "RUNTIME, NUM_DEPS_LEFT, LEASE_EXPIRY, CLIENT, SORT_KEY, TASK_ID, GRP, ADD_TIME)\n"
+                                  "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)", vals + (task_id, groups[group], add_time))
+
+                # dependencies on archived tasks have no rows, as in SQLiteTaskDB
+                c.executemany("INSERT OR IGNORE INTO DEPENDENCIES (TASK, DEPENDS_ON)\n"
+                              "SELECT t.ID, d.ID FROM TASKDATA AS t, TASKDATA AS d WHERE t.TASK_ID = ? AND d.TASK_ID = ?",
+                              deps)
+                c.executemany("INSERT INTO LOGDATA (TASK, ACTION, TIME, INFO)\n"
+                              "SELECT ID, ?, ?, ? FROM TASKDATA WHERE TASK_ID = ?",
+                              [(sqlite._action_codes[action], t, info, task_id) for task_id, action, t, info in logs])
+                c.execute("UPDATE CLIENTS SET HEARTBEAT = ? WHERE CLIENT_ID = ?", (_now(), sqlite._client_id))
+                self._db_state = c.execute("SELECT STATE FROM INFO").fetchone()[0]
+                sqlite._unlock_db()
+            except Exception as e:
+                sqlite._rollback_db()
+                raise ValueError("Could not write the tasks back to the SQLite3 DB! - %s" % e)
+        else:
+            raise ValueError("Could not get lock to write the tasks back to the SQLite3 DB!")
+
+    def snapshot(self):
+        """write the tasks changed since the last snapshot back to the SQLite DB"""
+        now = _now()
+        self._write_back([self._row(task_id, task, now) for task_id, task in self._dirty.items()],
+                         self._logs, self._deps)
+
+        # the running tasks are written every time so that their leases stay current
+        self._dirty = dict((task_id, task) for task_id, task in self._dirty.items()
+                           if task.state == TASK_STATES.RUNNING)
+        self._logs = []
+        self._deps = []
+        self._last_snapshot = time.time()
+
+        # a crash before the journal is emptied replays it onto the snapshot, which
+        # leaves the tasks as they are but may log the replayed actions twice
+        self._truncate_journal()
+
+    def _maybe_snapshot(self):
+        if time.time() - self._last_snapshot >= self._conf['snapshot_interval']:
+            self.snapshot()
+
+    def _write_through(self, func):
+        """run func on the SQLite DB with the tasks snapshotted before and reloaded after"""
+        self.snapshot()
+        try:
+            return func()
+        finally:
+            self._load()
+
+    def close(self):
+        """write the tasks back to the SQLite DB and close it"""
+        try:
+            if self._journal is not None:
+                self.snapshot()
+                self._journal.close()
+                self._journal = None
+                os.remove(self._journal_name)
+        finally:
+            self._sqlite.close()
+
+    def checkout(self, state=None):
+        """checkout a task from the DB"""
+        tasks = self.checkout_many(1, state=state)
+        if len(tasks) == 0:
+            return None, None
+        else:
+            return tasks[0]
+
+    def checkout_many(self, n, state=None):
+        """checkout up to n tasks from the DB"""
+        if state is not None and state not in LIST_OF_TASK_STATES:
+            raise ValueError("State '%s' not a valid task state!" % state)
+
+        if state is None:
+            states = CHECKOUT_TASK_STATES
+        else:
+            states = [state]
+
+        stime = _now()
+        tasks = []
+        logs = []
+        while len(tasks) < n:
+            task_id = self._pop(states)
+            if task_id is None:
+                break
+
+            task = self._tasks[task_id]
+            if task.state == TASK_STATES.CHECKPOINTED:
+                action = TASK_LOG_ACTIONS.RAN_FROM_CHECKPOINT
+            else:
+                action = TASK_LOG_ACTIONS.RAN
+
+            # tasks run from a checkpoint keep the start time of their first run
+            if task.state != TASK_STATES.CHECKPOINTED or task.start_time is None:
+                task.start_time = stime
+            task.end_time = None
+            task.runtime = None
+            task.num_attempts += 1
+            self._set_state(task_id, task, TASK_STATES.RUNNING)
+
+            logs.append([task_id, action, stime, ''])
+            tasks.append((task.cmd, task_id))
+
+        if len(tasks) > 0:
+            self._record(logs)
+            # the running tasks written back by the snapshots hold leases renewed by the SQLite DB's heartbeat
+            self._sqlite._start_heartbeat()
+
+        return tasks
+
+    def checkin(self, task_id, state, info=''):
+        """checkin a task that has been run"""
+        self.checkin_many([(task_id, state, info)])
+
+    def checkin_many(self, results):
+        """checkin a list of (task_id, state, info) for tasks that have been run"""
+        results = [(str(task_id), state, info) for task_id, state, info in results]
+        if len(results) == 0:
+            return
+
+        for task_id, state, info in results:
+            assert state in VALID_LOG_CHECKIN_ACTIONS,\
+                "Supplied task '%s' state is not allowed!" % state
+
+        # nothing is changed unless all of the tasks can be checked in
+        for task_id, state, info in results:
+            if task_id not in self._tasks:
+                raise ValueError("Checkin of task %s in state '%s' failed!" % (task_id, state))
+
+        etime = _now()
+        logs = []
+        for task_id, state, info in results:
+            task = self._tasks[task_id]
+            task.end_time = etime
+            if task.start_time is not None:
+                task.runtime = etime - task.start_time
+            self._set_state(task_id, task, state)
+            logs.append([task_id, state, etime, info])
+
+        self._record(logs)
+
+    def add(self, cmd, id=None, priority=None, depends_on=None, group=None):
+        """add a task to be run via cmd once the tasks with IDs in depends_on have succeeded"""
+        return self.add_multiple([{'cmd': cmd, 'id': id, 'priority': priority, 'depends_on': depends_on,
+                                   'group': group}])[0]
+
+    def add_multiple(self, cmds, id=None, priority=None, chunksize=10000, atomic=True, callback=None,
+                     return_ids=True, group=None):
+        """add tasks to be run via cmd
+
+        Takes the same arguments as SQLiteTaskDB.add_multiple. Tasks can depend on tasks
+        already in the DB or added before them. Each chunk is checked for bad IDs and
+        dependencies before any of its tasks are added, but earlier chunks stay added."""
+
+        if id is None:
+            id = itertools.repeat(None)
+
+        if priority is None:
+            priority = itertools.repeat(0)
+        else:
+            try:
+                priority = iter(priority)
+            except Exception as e:
+                priority = itertools.repeat(priority)
+
+        def _tasks():
+            for cmd, tid, tpriority in zip(cmds, id, priority):
+                tsk = {'id': tid, 'priority': tpriority, 'group': group, 'depends_on': None}
+                if isinstance(cmd, dict):
+                    tsk.update((k, v) for k, v in cmd.items() if v is not None or k not in tsk)
+                else:
+                    tsk['cmd'] = cmd
+                if tsk['id'] is None:
+                    tsk['id'] = uuid.uuid1().hex
+                tsk['id'] = str(tsk['id'])
+                if tsk['priority'] is None:
+                    tsk['priority'] = 0
+                if tsk['group'] is None:
+                    tsk['group'] = DEFAULT_GROUP
+                tsk['depends_on'] = [str(dep_id) for dep_id in tsk['depends_on'] or []]
+                yield tsk
+
+        tasks = _tasks()
+        ids = []
+        num_added = 0
+        while True:
+            chunk = list(itertools.islice(tasks, chunksize))
+            if len(chunk) == 0:
+                break
+
+            seen = set()
+            for tsk in chunk:
+                if tsk['id'] in self._tasks or tsk['id'] in seen:
+                    raise ValueError("Could not add multiple tasks! - duplicate IDs found")
+                for dep_id in tsk['depends_on']:
+                    if dep_id in self._tasks:
+                        dep_state = self._tasks[dep_id].state
+                    elif dep_id in seen:
+                        dep_state = None
+                    else:
+                        dep_state = self._archived_state(dep_id)
+                        if dep_state is None:
+                            raise ValueError("Task %s depends on task %s, which is not in the DB or added after it!"
+                                             % (tsk['id'], dep_id))
+                    if dep_state == TASK_STATES.DELETED:
+                        raise ValueError("Task %s depends on task %s, which was deleted!" % (tsk['id'], dep_id))
+                seen.add(tsk['id'])
+
+            atime = _now()
+            logs = []
+            deps = []
+            for tsk in chunk:
+                if tsk['group'] not in self._aging:
+                    self._aging[tsk['group']] = 0.0
+                task = _MemoryTask(tsk['cmd'], TASK_STATES.QUEUED_NO_DEP, tsk['priority'], group=tsk['group'],
+                                   add_time=atime,
+                                   sort_key=_sort_key(tsk['priority'], self._aging[tsk['group']], atime))
+                for dep_id in set(tsk['depends_on']):
+                    # archived tasks have SUCCEEDED, so they count as done, as in SQLiteTaskDB
+                    if dep_id not in self._tasks:
+                        continue
+                    self._dependents.setdefault(dep_id, []).append(tsk['id'])
+                    deps.append([tsk['id'], dep_id])
+                    if self._tasks[dep_id].state != TASK_STATES.SUCCEEDED:
+                        task.num_deps_left += 1
+                if task.num_deps_left > 0:
+                    task.state = TASK_STATES.QUEUED_WITH_DEP
+
+                self._tasks[tsk['id']] = task
+                self._push(tsk['id'], task)
+                self._touch(tsk['id'], task)
+                logs.append([tsk['id'], TASK_LOG_ACTIONS.ADDED, atime, ''])
+
+            self._record(logs, deps)
+
+            num_added += len(chunk)
+            if return_ids:
+                ids.extend(tsk['id'] for tsk in chunk)
+            if callback is not None:
+                callback(num_added, [tsk['id'] for tsk in chunk])
+
+        if return_ids:
+            return ids
+        else:
+            return num_added
+
+    def update(self, id, task=None, priority=None, state=None):
+        """update a task with id"""
+        tsk = self._tasks.get(str(id))
+        if tsk is None:
+            raise ValueError("Could not udpate task %s!" % (id))
+        id = str(id)
+
+        info = ''
+        if priority is not None:
+            info += 'set PRIORITY to %d from %d; ' % (priority, tsk.priority)
+            # the time the task has waited still counts with its new priority
+            tsk.sort_key += priority - tsk.priority
+            tsk.priority = priority
+
+        if task is not None:
+            info += 'set CMD to "%s" from "%s"; ' % (task, tsk.cmd)
+            tsk.cmd = task
+
+        # any run time measured so far no longer applies to the task
+        tsk.start_time = None
+        tsk.end_time = None
+        tsk.runtime = None
+
+        if state is not None:
+            info += 'set STATE to %s from %s; ' % (state, tsk.state)
+            self._set_state(id, tsk, state)
+        else:
+            self._push(id, tsk)
+            self._touch(id, tsk)
+
+        self._record([[id, TASK_LOG_ACTIONS.UPDATED, _now(), info]])
+
+    def delete(self, id, remove=False):
+        """delete task id"""
+        id = str(id)
+        if id not in self._tasks:
+            raise ValueError("Could not delete task %s!" % id)
+
+        if remove:
+            self._write_through(lambda: self._sqlite.delete(id, remove=True))
+        else:
+            self._set_state(id, self._tasks[id], TASK_STATES.DELETED)
+            self._record([[id, TASK_LOG_ACTIONS.DELETED, _now(), '']])
+
+    def reset(self):
+        """reset all tasks to be rerun"""
+        self._write_through(self._sqlite.reset)
+
+    def set_group(self, name, weight=None, aging=None):
+        """set the weight and/or priority aging of the group called name"""
+        self._write_through(lambda: self._sqlite.set_group(name, weight=weight, aging=aging))
+
+    def _list_tasks(self, state=None):
+        """get the (task_id, state, cmd, priority, runtime) of the tasks, highest priority first"""
+        if state is not None and state not in LIST_OF_TASK_STATES:
+            raise ValueError("State '%s' not a valid task state!" % state)
+
+        tasks = sorted(((task_id, task) for task_id, task in self._tasks.items()
+                        if state is None or task.state == state), key=lambda x: -x[1].priority)
+        for task_id, task in tasks:
+            rtime = task.runtime / 1000.0 if task.runtime is not None else None
+            yield task_id, task.state, task.cmd, task.priority, rtime
+
+    def list(self, state=None, with_runtime=False):
+        """list all tasks in the db"""
+        print_tasks(self._list_tasks(state=state), with_runtime=with_runtime)
+
+    def log(self, task_id):
+        """get log for task id"""
+        self.snapshot()
+        self._sqlite.log(task_id)
+
+    def query(self, cmd, params=(), read_only=False):
+        """run the query cmd on the SQLite DB after writing the tasks back to it"""
+        self.snapshot()
+        return self._sqlite.query(cmd, params, read_only=read_only)
+
+    def status(self, as_dict=False):
+        """print staus of DB, or return it as a dict if as_dict is True"""
+        self.snapshot()
+        return self._sqlite.status(as_dict=as_dict)
+
+    def state(self):
+        """get the DB state, which is read from the SQLite DB at each snapshot"""
+        self._maybe_snapshot()
+        return self._db_state
+
+    def pause(self):
+        """set DB state to pause"""
+        self._sqlite.pause()
+        self._db_state = TASKDB_STATES.PAUSED
+
+    def run(self):
+        """set DB state to running"""
+        self._sqlite.run()
+        self._db_state = TASKDB_STATES.RUNNING
+
+    def cleanup(self, expired_only=False):
+        """cleanup the taskdb, see SQLiteTaskDB.cleanup"""
+        return self._write_through(lambda: self._sqlite.cleanup(expired_only=expired_only))
+
+    def archive(self, compress=True, chunksize=1000):
+        """move finished tasks and their logs into the archive, returning the number of tasks moved"""
+        return self._write_through(lambda: self._sqlite.archive(compress=compress, chunksize=chunksize))
+
+    def runtime(self, as_dict=False):
+        """get runtime stats for DB"""
+        self.snapshot()
+        return self._sqlite.runtime(as_dict=as_dict)
@@ -0,0 +1,259 @@
+from __future__ import print_function
+import sys
+import hmac
+import json
+import time
+import socket
+import struct
+import itertools
+
+from ..defaults import DEF_TASKDB_CONF
+from .base import BaseTaskDB
+
+# every message is a JSON object preceded by its length in bytes
+_HEADER = struct.Struct('!I')
+
+
+def parse_address(address):
+    """get the socket family and address of a broker given as host:port or the path of a unix socket"""
+    if ':' in address and '/' not in address:
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def send_msg(sock, msg):
+    data = json.dumps(msg).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def auth_digest(authkey, challenge):
+    """answer the challenge of a broker with the HMAC of it keyed by authkey, so the key is never sent"""
+    if authkey is None:
+        return None
+    return hmac.new(str(authkey).encode('utf-8'), bytes.fromhex(challenge), 'sha256').hexdigest()
+
+
+def _recv_bytes(sock, num):
+    data = b''
+    while len(data) < num:
+        chunk = sock.recv(num - len(data))
+        if len(chunk) == 0:
+            return None
+        data += chunk
+    return data
+
+
+def recv_msg(sock, max_size=None):
+    """receive a message, or None if the other end closed the connection
+
+    Messages longer than max_size bytes, if given, are refused before they are read."""
+    header = _recv_bytes(sock, _HEADER.size)
+    if header is None:
+        return None
+    size = _HEADER.unpack(header)[0]
+    if max_size is not None and size > max_size:
+        raise ValueError("Message of %d bytes is longer than %d bytes!" % (size, max_size))
+    data = _recv_bytes(sock, size)
+    if data is None:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+class RemoteTaskDB(BaseTaskDB):
+    """task DB served by a broker started with `cake serve`
+
+    Each call is sent to the broker at address (host:port or the path of a unix socket)
+    and run there on the task DB it owns, so clients never touch the DB file. The broker
+    checks in the tasks of clients that disconnect without checking them in as KILLED.
+    authkey has to match the key the broker was started with, if any. Queries are run
+    read-only by the broker."""
+
+    def __init__(self, **conf):
+        self._conf = {}
+        self._conf.update(conf)
+        self._conf['timeout'] = self._conf.get('timeout', DEF_TASKDB_CONF['timeout'])
+        self._conf['name'] = self._conf.get('name', self._conf['address'])
+        self._sock = None
+
+        # the broker may still be starting up, so keep trying for the timeout
+        family, address = parse_address(self._conf['address'])
+        start = time.time()
+        while True:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.connect(address)
+                break
+            except OSError as e:
+                sock.close()
+                if time.time() - start > self._conf['timeout']:
+                    raise ValueError("Could not connect to the task broker at '%s'! - %s" % (self._conf['address'], e))
+                time.sleep(0.1)
+
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = sock
+
+        try:
+            try:
+                challenge = recv_msg(sock)
+            except OSError as e:
+                challenge = None
+            if challenge is None:
+                raise ValueError("Lost the connection to the task broker at '%s'!" % self._conf['address'])
+            self._call('hello', digest=auth_digest(self._conf.get('authkey'), challenge['challenge']))
+        except Exception as e:
+            self.close()
+            raise
+
+    def _call(self, op, *args, **kwargs):
+        """run op on the task DB of the broker, printing anything it prints"""
+        try:
+            send_msg(self._sock, {'op': op, 'args': args, 'kwargs': kwargs})
+            reply = recv_msg(self._sock)
+        except OSError as e:
+            reply = None
+        if reply is None:
+            raise ValueError("Lost the connection to the task broker at '%s'!" % self._conf['address'])
+
+        if len(reply.get('output', '')) > 0:
+            sys.stdout.write(reply['output'])
+            sys.stdout.flush()
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        return reply.get('result')
+
+    def close(self):
+        """close the connection to the broker"""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def checkout(self, state=None):
+        """checkout a task from the DB"""
+        tasks = self.checkout_many(1, state=state)
+        if len(tasks) == 0:
+            return None, None
+        else:
+            return tasks[0]
+
+    def checkout_many(self, n, state=None):
+        """checkout up to n tasks from the DB"""
+        return [tuple(task) for task in self._call('checkout_many', n, state=state)]
+
+    def checkin(self, task_id, state, info=''):
+        """checkin a task that has been run"""
+        self.checkin_many([(task_id, state, info)])
+
+    def checkin_many(self, results):
+        """checkin a list of (task_id, state, info) for tasks that have been run"""
+        results = [(str(task_id), state, info) for task_id, state, info in results]
+        if len(results) > 0:
+            self._call('checkin_many', results)
+
+    def add(self, cmd, id=None, priority=None, depends_on=None, group=None):
+        """add a task to be run via cmd once the tasks with IDs in depends_on have succeeded"""
+        return self._call('add', cmd, id=id, priority=priority, depends_on=depends_on, group=group)
+
+    def add_multiple(self, cmds, id=None, priority=None, chunksize=10000, atomic=True, callback=None,
+                     return_ids=True, group=None):
+        """add tasks to be run via cmd
+
+        Takes the same arguments as SQLiteTaskDB.add_multiple. The tasks are sent to the
+        broker a chunk at a time, so with atomic each chunk is added in one transaction."""
+
+        if id is None:
+            id = itertools.repeat(None)
+
+        if priority is None:
+            priority = itertools.repeat(0)
+        else:
+            try:
+                priority = iter(priority)
+            except Exception as e:
+                priority = itertools.repeat(priority)
+
+        def _tasks():
+            for cmd, tid, tpriority in zip(cmds, id, priority):
+                tsk = {'id': tid, 'priority': tpriority}
+                if isinstance(cmd, dict):
+                    tsk.update(cmd)
+                else:
+                    tsk['cmd'] = cmd
+                yield tsk
+
+        tasks = _tasks()
+        ids = []
+        num_added = 0
+        while True:
+            chunk = list(itertools.islice(tasks, chunksize))
+            if len(chunk) == 0:
+                break
+
+            chunk_ids = self._call('add_multiple', chunk, chunksize=len(chunk), atomic=atomic, group=group)
+            num_added += len(chunk_ids)
+            if return_ids:
+                ids.extend(chunk_ids)
+            if callback is not None:
+                callback(num_added, chunk_ids)
+
+        if return_ids:
+            return ids
+        else:
+            return num_added
+
+    def update(self, id, task=None, priority=None, state=None):
+        """update a task with id"""
+        self._call('update', id, task=task, priority=priority, state=state)
+
+    def delete(self, id, remove=False):
+        """delete task id"""
+        self._call('delete', id, remove=remove)
+
+    def reset(self):
+        """reset all tasks to be rerun"""
+        self._call('reset')
+
+    def set_group(self, name, weight=None, aging=None):
+        """set the weight and/or priority aging of the group called name"""
+        self._call('set_group', name, weight=weight, aging=aging)
+
+    def list(self, state=None, with_runtime=False):
+        """list all tasks in the db"""
+        self._call('list', state=state, with_runtime=with_runtime)
+
+    def log(self, task_id):
+        """get log for task id"""
+        self._call('log', task_id)
+
+    def query(self, cmd, params=()):
+        """run the read-only query cmd on the database of the broker"""
+        return [tuple(row) for row in self._call('query', cmd, params)]
+
+    def status(self, as_dict=False):
+        """print staus of DB, or return it as a dict if as_dict is True"""
+        return self._call('status', as_dict=as_dict)
+
+    def state(self):
+        """get the DB state"""
+        return self._call('state')
+
+    def pause(self):
+        """set DB state to pause"""
+        self._call('pause')
+
+    def run(self):
+        """set DB state to running"""
+        self._call('run')
+
+    def cleanup(self, expired_only=False):
+        """cleanup the taskdb, see SQLiteTaskDB.cleanup"""
+        return self._call('cleanup', expired_only=expired_only)
+
+    def archive(self, compress=True, chunksize=1000):
+        """move finished tasks and their logs into the archive, returning the number of tasks moved"""
+        return self._call('archive', compress=compress, chunksize=chunksize)
+
+    def runtime(self, as_dict=False):
+        """get runtime stats for DB"""
+        return self._call('runtime', as_dict=as_dict)
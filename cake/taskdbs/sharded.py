@@ -0,0 +1,308 @@
+from __future__ import print_function
+import os
+import re
+import time
+import uuid
+import zlib
+import heapq
+import random
+import itertools
+
+from ..defaults import TASKDB_STATES, LIST_OF_TASK_STATES, CHECKOUT_TASK_STATES
+from ..defaults import DEF_TASKDB_CONF, DEF_NUM_SHARDS
+from .base import BaseTaskDB
+from .sqlite import SQLiteTaskDB, print_tasks, print_status, print_runtime
+
+SHARD_NAME = 'shard-%03d.db'
+SHARD_PATTERN = re.compile(r'^shard-(\d+)\.db$')
+
+
+class ShardedSQLiteTaskDB(BaseTaskDB):
+    """task DB split over a directory of SQLite task DBs
+
+    Each task lives in the shard picked by a hash of its ID, so that every shard has
+    its own writer lock. Clients check tasks out of a randomly chosen home shard and
+    move on to the other shards when it runs dry. The shards are made with
+    num_shards files (DEF_NUM_SHARDS by default) when the directory does not exist.
+
+    Dependencies are not supported since they would have to span shards. Groups share
+    out the tasks within each shard."""
+
+    def __init__(self, **conf):
+        self._conf = {}
+        self._conf.update(conf)
+        self._conf['intent'] = self._conf.get('intent', 'examine')
+        num_shards = self._conf.pop('num_shards', None)
+
+        name = self._conf['name']
+        if not os.path.exists(name):
+            if self._conf['intent'] == 'read':
+                raise ValueError("Sharded task DB '%s' does not exist!" % name)
+            os.makedirs(name)
+            paths = [os.path.join(name, SHARD_NAME % i) for i in range(num_shards or DEF_NUM_SHARDS)]
+        else:
+            nums = sorted(int(m.group(1)) for m in (SHARD_PATTERN.match(f) for f in os.listdir(name)) if m)
+            if len(nums) == 0 or nums != list(range(len(nums))):
+                raise ValueError("Directory '%s' does not hold the shards of a task DB!" % name)
+            if num_shards is not None and num_shards != len(nums):
+                raise ValueError("Sharded task DB '%s' has %d shards, not %d!" % (name, len(nums), num_shards))
+            paths = [os.path.join(name, SHARD_NAME % i) for i in nums]
+
+        self._shards = []
+        try:
+            for path in paths:
+                sconf = {}
+                sconf.update(self._conf)
+                sconf['name'] = path
+                self._shards.append(SQLiteTaskDB(**sconf))
+        except Exception as e:
+            for shard in self._shards:
+                shard.close()
+            raise
+
+        # spread the clients over the shards so that they do not all wait on the same lock
+        self._home = random.randrange(len(self._shards))
+
+    @property
+    def num_shards(self):
+        return len(self._shards)
+
+    def _shard_index(self, task_id):
+        return zlib.crc32(str(task_id).encode('utf-8')) % len(self._shards)
+
+    def _shard(self, task_id):
+        """the shard holding the task with task_id"""
+        return self._shards[self._shard_index(task_id)]
+
+    def close(self):
+        """close down the DB"""
+        for shard in self._shards:
+            shard.close()
+
+    def checkout(self, state=None):
+        """checkout a task from the DB"""
+        tasks = self.checkout_many(1, state=state)
+        if len(tasks) == 0:
+            return None, None
+        else:
+            return tasks[0]
+
+    def checkout_many(self, n, state=None):
+        """checkout up to n tasks, starting at the home shard and stealing from the others"""
+        if state is not None and state not in LIST_OF_TASK_STATES:
+            raise ValueError("State '%s' not a valid task state!" % state)
+
+        if state is None:
+            states = CHECKOUT_TASK_STATES
+        else:
+            states = [state]
+
+        tasks = []
+        for itr in range(self._conf.get('task_checkout_num_tries', DEF_TASKDB_CONF['task_checkout_num_tries'])):
+            if itr > 0:
+                time.sleep(self._conf.get('task_checkout_delay', DEF_TASKDB_CONF['task_checkout_delay']))
+
+            busy = False
+            for i in range(len(self._shards)):
+                index = (self._home + i) % len(self._shards)
+                stasks = self._shards[index]._try_checkout(n - len(tasks), states)
+                if stasks is None:
+                    busy = True
+                    continue
+
+                tasks.extend(stasks)
+                if len(tasks) >= n:
+                    # keep working on the shard that still has tasks
+                    self._home = index
+                    break
+
+            # only a shard that could not be locked can still have tasks for us
+            if len(tasks) > 0 or not busy:
+                break
+
+        return tasks
+
+    def checkin(self, task_id, state, info=''):
+        """checkin a task that has been run"""
+        self._shard(task_id).checkin(task_id, state, info=info)
+
+    def checkin_many(self, results):
+        """checkin a list of (task_id, state, info) for tasks that have been run, one transaction per shard"""
+        shard_results = {}
+        for result in results:
+            shard_results.setdefault(self._shard_index(result[0]), []).append(result)
+        for index, sresults in shard_results.items():
+            self._shards[index].checkin_many(sresults)
+
+    def add(self, cmd, id=None, priority=None, depends_on=None, group=None):
+        """add a task to be run via cmd"""
+        if depends_on:
+            raise ValueError("Sharded task DBs do not support dependencies between tasks!")
+
+        if id is None:
+            id = uuid.uuid1().hex
+        id = str(id)
+
+        return self._shard(id).add(cmd, id=id, priority=priority, group=group)
+
+    def add_multiple(self, cmds, id=None, priority=None, chunksize=10000, atomic=True, callback=None,
+                     return_ids=True, group=None):
+        """add tasks to be run via cmd
+
+        Takes the same arguments as SQLiteTaskDB.add_multiple, except that dependencies are
+        not supported. The tasks of each chunk are added to each shard in one transaction,
+        so with atomic a failed call leaves the chunks and shards before the failure added."""
+
+        if id is None:
+            id = itertools.repeat(None)
+
+        if priority is None:
+            priority = itertools.repeat(0)
+        else:
+            try:
+                priority = iter(priority)
+            except Exception as e:
+                priority = itertools.repeat(priority)
+
+        def _tasks():
+            for cmd, tid, tpriority in zip(cmds, id, priority):
+                tsk = {'id': tid, 'priority': tpriority, 'group': group}
+                if isinstance(cmd, dict):
+                    tsk.update(cmd)
+                else:
+                    tsk['cmd'] = cmd
+                if tsk.get('depends_on'):
+                    raise ValueError("Sharded task DBs do not support dependencies between tasks!")
+                if tsk['id'] is None:
+                    tsk['id'] = uuid.uuid1().hex
+                tsk['id'] = str(tsk['id'])
+                yield tsk
+
+        tasks = _tasks()
+        ids = []
+        num_added = 0
+        while True:
+            chunk = list(itertools.islice(tasks, chunksize))
+            if len(chunk) == 0:
+                break
+
+            shard_chunks = {}
+            for tsk in chunk:
+                shard_chunks.setdefault(self._shard_index(tsk['id']), []).append(tsk)
+            for index, schunk in shard_chunks.items():
+                self._shards[index].add_multiple(schunk, chunksize=len(schunk), return_ids=False)
+
+            num_added += len(chunk)
+            if return_ids:
+                ids.extend(tsk['id'] for tsk in chunk)
+            if callback is not None:
+                callback(num_added, [tsk['id'] for tsk in chunk])
+
+        if return_ids:
+            return ids
+        else:
+            return num_added
+
+    def update(self, id, task=None, priority=None, state=None):
+        """update a task with id"""
+        self._shard(id).update(id, task=task, priority=priority, state=state)
+
+    def delete(self, id, remove=False):
+        """delete task id"""
+        self._shard(id).delete(id, remove=remove)
+
+    def reset(self):
+        """reset all tasks to be rerun"""
+        for shard in self._shards:
+            shard.reset()
+
+    def set_group(self, name, weight=None, aging=None):
+        """set the weight and/or priority aging of the group called name in every shard"""
+        for shard in self._shards:
+            shard.set_group(name, weight=weight, aging=aging)
+
+    def list(self, state=None, with_runtime=False):
+        """list all tasks in the db"""
+        print_tasks(heapq.merge(*[shard._list_tasks(state=state) for shard in self._shards],
+                                key=lambda x: -x[3]),
+                    with_runtime=with_runtime)
+
+    def log(self, task_id):
+        """get log for task id"""
+        self._shard(task_id).log(task_id)
+
+    def query(self, cmd, params=(), read_only=False):
+        """run the query cmd on every shard, returning all of the rows"""
+        res = []
+        for shard in self._shards:
+            res.extend(shard.query(cmd, params, read_only=read_only))
+        return res
+
+    def status(self, as_dict=False):
+        """print staus of DB, or return it as a dict if as_dict is True"""
+        stats = [shard.status(as_dict=True) for shard in self._shards]
+
+        # every client opens all of the shards
+        stat = {'name': self._conf['name'],
+                'state': self.state(),
+                'clients': max(s['clients'] for s in stats),
+                'tasks': sum(s['tasks'] for s in stats),
+                'archived': sum(s['archived'] for s in stats),
+                'states': dict((state, sum(s['states'][state] for s in stats)) for state in LIST_OF_TASK_STATES),
+                'shards': len(stats)}
+
+        if as_dict:
+            return stat
+
+        print_status(stat)
+
+    def state(self):
+        """get the DB state, which is PAUSED if any shard is paused"""
+        if any(shard.state() == TASKDB_STATES.PAUSED for shard in self._shards):
+            return TASKDB_STATES.PAUSED
+        return TASKDB_STATES.RUNNING
+
+    def pause(self):
+        """set DB state to pause"""
+        for shard in self._shards:
+            shard.pause()
+
+    def run(self):
+        """set DB state to running"""
+        for shard in self._shards:
+            shard.run()
+
+    def cleanup(self, expired_only=False):
+        """cleanup the taskdb, see SQLiteTaskDB.cleanup"""
+        res = [shard.cleanup(expired_only=expired_only) for shard in self._shards]
+        if expired_only:
+            return sum(res)
+
+    def archive(self, compress=True, chunksize=1000):
+        """move finished tasks and their logs into the archive of each shard, returning the number of tasks moved"""
+        return sum(shard.archive(compress=compress, chunksize=chunksize) for shard in self._shards)
+
+    def runtime(self, as_dict=False):
+        """get runtime stats for DB"""
+        stats = [s for s in (shard.runtime(as_dict=True) for shard in self._shards) if s['tasks'] > 0]
+
+        rstats = {'name': self._conf['name'],
+                  'total': sum(s['total'] for s in stats),
+                  'tasks': sum(s['tasks'] for s in stats),
+                  'avg': 0.0,
+                  'min': 0.0,
+                  'min_task': 'N/A',
+                  'max': 0.0,
+                  'max_task': 'N/A'}
+
+        if rstats['tasks'] > 0:
+            rstats['avg'] = rstats['total'] / rstats['tasks']
+            smin = min(stats, key=lambda s: s['min'])
+            rstats['min'], rstats['min_task'] = smin['min'], smin['min_task']
+            smax = max(stats, key=lambda s: s['max'])
+            rstats['max'], rstats['max_task'] = smax['max'], smax['max_task']
+
+        if as_dict:
+            return rstats
+
+        print_runtime(rstats)
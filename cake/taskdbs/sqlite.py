@@ -1,17 +1,126 @@
 from __future__ import print_function
 import os
 import sys
+import random
 import sqlite3
 import time
 import uuid
+import urllib.parse
+import itertools
+import json
+import zlib
+import threading
+import heapq
 
 import yaml
 
 from ..defaults import TASK_STATES, TASKDB_STATES, TASK_LOG_ACTIONS
-from ..defaults import LIST_OF_TASK_STATES, VALID_LOG_CHECKIN_ACTIONS
-from ..defaults import DEF_TASKDB_CONF
+from ..defaults import LIST_OF_TASK_STATES, LIST_OF_TASK_LOG_ACTIONS, VALID_LOG_CHECKIN_ACTIONS
+from ..defaults import ARCHIVE_TASK_STATES, CHECKOUT_TASK_STATES
+from ..defaults import DEF_TASKDB_CONF, NETWORK_FILESYSTEMS
 from .base import BaseTaskDB
-from ..utils import diff_timestamps
+from ..utils import filesystem_type
+
+# version of the layout of the tables in the DB file
+#   1 - TEXT task IDs, states, actions and times in every row
+#   2 - integer task keys, integer state and action codes and times in epoch milliseconds
+#   3 - leases on running tasks and client heartbeats
+#   4 - dependencies between tasks
+#   5 - task groups for fair-share checkout and priority aging
+SCHEMA_VERSION = 5
+
+# tasks added without a group go into this one
+DEFAULT_GROUP = 'default'
+
+
+def _now():
+    """the current time in epoch milliseconds"""
+    return int(round(time.time() * 1000.0))
+
+
+MSECS_PER_HOUR = 3600000.0
+
+
+def _sort_key(priority, aging, atime):
+    """the key tasks are checked out by within their group
+
+    Tasks added at atime with priority rank the same as priority + aging * (now - atime)
+    in hours, so ordering by this fixed key ages the priorities without rewriting them."""
+    return priority - aging * atime / MSECS_PER_HOUR
+
+
+# the only things a read-only query is allowed to do
+_READ_ONLY_ACTIONS = set([sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION,
+                          getattr(sqlite3, 'SQLITE_RECURSIVE', sqlite3.SQLITE_SELECT)])
+
+
+def _read_only_authorizer(action, arg1, arg2, db_name, trigger):
+    """SQLite authorizer that denies anything but reading tables"""
+    return sqlite3.SQLITE_OK if action in _READ_ONLY_ACTIONS else sqlite3.SQLITE_DENY
+
+
+def _format_time(msecs):
+    """format a time in epoch milliseconds like the times in the logs"""
+    return '%s.%03d' % (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(msecs // 1000)), msecs % 1000)
+
+
+def print_tasks(tasks, with_runtime=False):
+    """print the (task_id, state, cmd, priority, runtime) of tasks as done by list"""
+    for id, state, cmd, priority, rtime in tasks:
+        print("task %s:\n    cmd: '%s'\n    state: %s\n    priority: %d" % (id, cmd, state, priority))
+
+        if state == TASK_STATES.SUCCEEDED and with_runtime and rtime is not None:
+            print("    run time: %gs" % rtime)
+
+    sys.stdout.flush()
+
+
+def print_status(stat):
+    """print the status dict of a task DB"""
+    maxlen = None
+    for state in LIST_OF_TASK_STATES:
+        slen = len("    %s: " % state)
+        if maxlen is None or slen > maxlen:
+            maxlen = slen
+
+    def _pad_str(sstr):
+        if len(sstr) < maxlen:
+            sstr += " " * (maxlen - len(sstr))
+        return sstr
+
+    print("%s:" % (stat['name']))
+    sstr = _pad_str("    state: ")
+    print("%s%s" % (sstr, stat['state']))
+
+    sstr = _pad_str("    # of clients: ")
+    print("%s%d" % (sstr, stat['clients']))
+
+    sstr = _pad_str("    # of tasks: ")
+    print("%s%d" % (sstr, stat['tasks']))
+
+    sstr = _pad_str("    # of archived: ")
+    print("%s%d" % (sstr, stat['archived']))
+
+    for state in LIST_OF_TASK_STATES:
+        sstr = _pad_str("    %s: " % state)
+        print("%s%d" % (sstr, stat['states'][state]))
+
+    sys.stdout.flush()
+
+
+def print_runtime(stats):
+    """print the runtime stats dict of a task DB"""
+    print("%s:" % (stats['name']))
+    print("""\
+    total time:           %gs
+    # of tasks SUCCEEDED: %d
+    avg time per task:    %gs
+    min time of tasks:    %gs (task %s)
+    max time of tasks:    %gs (task %s)""" % (
+        stats['total'], stats['tasks'], stats['avg'], stats['min'], stats['min_task'], stats['max'],
+        stats['max_task']))
+
+    sys.stdout.flush()
 
 
 class SQLiteTaskDB(BaseTaskDB):
@@ -24,25 +133,39 @@ class SQLiteTaskDB(BaseTaskDB):
     def _init_db(self):
         self._errcheck = False
         self._conn = None
+        self._read_only = self._conf['intent'] == 'read'
+        self._heartbeat = None
+
+        if self._read_only:
+            # only used to inspect the DB, so it is never locked and no client is registered
+            self._client_id = None
+            self._open_read_only_db()
+            return
 
         if not os.path.exists(self._conf['name']):
             # create the DB
-            self._conn = sqlite3.connect(self._conf['name'], isolation_level=None)
+            self._conn = self._connect(self._conf['name'])
             tconf = {}
             tconf.update(DEF_TASKDB_CONF)
             tconf.update(self._conf)
             self._conf.update(tconf)
 
+            # lets archive() hand the pages it frees back to the filesystem, this has
+            # to be set before the journal mode or any tables
+            self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+            self._configure_db()
             self._create_db()
+            self._load_names()
         else:
             # connect to DB on disk
-            self._conn = sqlite3.connect(self._conf['name'], isolation_level=None)
+            self._conn = self._connect(self._conf['name'])
 
             old_timeout = self._conf.get('timeout', DEF_TASKDB_CONF['timeout'])
             self._conf['timeout'] = DEF_TASKDB_CONF['timeout']
             if self._lock_db(exclusive=True, msg='init setup'):
                 try:
-                    old_conf = yaml.load(self._conn.execute('SELECT CONFIG FROM INFO').fetchall()[0][0])
+                    old_conf = yaml.safe_load(self._conn.execute('SELECT CONFIG FROM INFO').fetchall()[0][0])
                     self._unlock_db()
                 except Exception as e:
                     self._rollback_db()
@@ -58,39 +181,117 @@ class SQLiteTaskDB(BaseTaskDB):
             tconf.update(self._conf)
             self._conf.update(tconf)
 
+            self._configure_db()
+            self._check_version()
+            self._load_names()
+
         # add self client
         self._client_id = uuid.uuid1().hex
         self._add_client(self._client_id)
 
+    def _connect(self, name, uri=False):
+        # every statement uses placeholders for its values, so a small cache of
+        # prepared statements covers all of the SQL the DB runs
+        return sqlite3.connect(name, uri=uri, isolation_level=None,
+                               timeout=self._conf.get('busy_timeout', DEF_TASKDB_CONF['busy_timeout']),
+                               cached_statements=self._conf.get('cached_statements',
+                                                                DEF_TASKDB_CONF['cached_statements']))
+
+    def _open_read_only_db(self):
+        if not os.path.exists(self._conf['name']):
+            raise ValueError("SQLite3 DB '%s' does not exist!" % self._conf['name'])
+
+        uri = 'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(self._conf['name']))
+        self._conn = self._connect(uri, uri=True)
+
+        try:
+            old_conf = yaml.safe_load(self._conn.execute('SELECT CONFIG FROM INFO').fetchall()[0][0])
+        except Exception as e:
+            raise ValueError("Config could not be selected from SQLite3 DB!")
+
+        tconf = {}
+        tconf.update(DEF_TASKDB_CONF)
+        tconf.update(old_conf)
+        tconf.update(self._conf)
+        self._conf.update(tconf)
+
+        self._configure_db()
+        self._check_version()
+        self._load_names()
+
+    def _schema_version(self):
+        c = self._conn.execute("PRAGMA table_info(INFO)")
+        if 'VERSION' not in [row[1] for row in c.fetchall()]:
+            return 1
+        return self._conn.execute("SELECT VERSION FROM INFO").fetchone()[0]
+
+    def _check_version(self):
+        """make sure the DB can be used by this version of cake, migrating it if asked to"""
+        version = self._schema_version()
+        if version > SCHEMA_VERSION:
+            raise ValueError("SQLite3 DB '%s' has schema version %d, which is newer than this version of "
+                             "cake supports (%d)!" % (self._conf['name'], version, SCHEMA_VERSION))
+        elif version < SCHEMA_VERSION:
+            if self._conf['intent'] != 'migrate':
+                raise ValueError("SQLite3 DB '%s' has schema version %d and has to be upgraded to version %d "
+                                 "with `cake migrate %s`!" % (self._conf['name'], version, SCHEMA_VERSION,
+                                                              self._conf['name']))
+            self._migrate_db()
+
+    def _load_names(self):
+        """read the integer codes of the task states and log actions"""
+        if not self._read_only:
+            # states and actions added by newer versions of cake get their codes here
+            missing = ([name for name in LIST_OF_TASK_STATES if name not in self._read_names('STATE_NAMES')] +
+                       [name for name in LIST_OF_TASK_LOG_ACTIONS if name not in self._read_names('ACTION_NAMES')])
+            if len(missing) > 0:
+                if self._lock_db(exclusive=True, msg='load names'):
+                    try:
+                        self._insert_names(self._conn)
+                        self._unlock_db()
+                    except Exception as e:
+                        self._rollback_db()
+                        raise ValueError("Could not add task states and actions to the SQLite3 DB!")
+                else:
+                    raise ValueError("SQLite3 DB could not be locked when trying to add task states and actions!")
+
+        self._state_codes = self._read_names('STATE_NAMES')
+        self._state_names = dict((code, name) for name, code in self._state_codes.items())
+        self._action_codes = self._read_names('ACTION_NAMES')
+        self._action_names = dict((code, name) for name, code in self._action_codes.items())
+
+    def _read_names(self, table):
+        return dict(self._conn.execute("SELECT NAME, CODE FROM %s" % table).fetchall())
+
+    def _insert_names(self, c):
+        c.executemany("INSERT OR IGNORE INTO STATE_NAMES (NAME) VALUES (?)",
+                      [(name,) for name in LIST_OF_TASK_STATES])
+        c.executemany("INSERT OR IGNORE INTO ACTION_NAMES (NAME) VALUES (?)",
+                      [(name,) for name in LIST_OF_TASK_LOG_ACTIONS])
+
     def _create_db(self):
         if self._lock_db(exclusive=True, msg='create'):
             try:
-                self._conn.execute("CREATE TABLE TASKS(\n"
-                                   "TASK_ID TEXT PRIMARY KEY NOT NULL,\n"
-                                   "CMD TEXT DEFAULT '',\n"
-                                   "STATE TEXT DEFAULT '%s',\n"
-                                   "PRIORITY REAL DEFAULT 0);\n"
-                                   % TASK_STATES.QUEUED_NO_DEP)
-
-                self._conn.execute("CREATE TABLE LOGS(\n"
-                                   "LOG_ID INTEGER PRIMARY KEY AUTOINCREMENT,\n"
-                                   "ACTION TEXT DEFAULT '%s',\n"
-                                   "INFO TEXT DEFAULT '',\n"
-                                   "TIME TIMESTAMP DEFAULT(strftime('%%Y-%%m-%%d %%H:%%M:%%f','NOW')),\n"
-                                   "TASK_ID TEXT,\n"
-                                   "FOREIGN KEY(TASK_ID) REFERENCES TASKS(TASK_ID));\n"
-                                   % TASK_LOG_ACTIONS.ADDED)
-
                 self._conn.execute("CREATE TABLE INFO(\n"
                                    "STATE TEXT DEFAULT '%s',\n"
-                                   "CONFIG TEXT);\n"
+                                   "CONFIG TEXT,\n"
+                                   "VERSION INTEGER DEFAULT 1,\n"
+                                   "VIRTUAL_TIME REAL DEFAULT 0);\n"
                                    % (TASKDB_STATES.PAUSED))
 
                 self._conn.execute("CREATE TABLE CLIENTS(\n"
-                                   "CLIENT_ID TEXT PRIMARY KEY NOT NULL);")
+                                   "CLIENT_ID TEXT PRIMARY KEY NOT NULL,\n"
+                                   "HEARTBEAT INTEGER);")
+
+                self._create_tables(self._conn)
+                self._insert_names(self._conn)
+                self._create_indexes(self._conn)
+                self._create_state_counts(self._conn)
+                self._create_triggers(self._conn)
+                self._create_views(self._conn)
 
-                self._conn.execute('INSERT INTO INFO (STATE,CONFIG) VALUES (?,?)',
-                                   (TASKDB_STATES.PAUSED, yaml.dump(self._conf)))
+                self._conn.execute('INSERT INTO INFO (STATE,CONFIG,VERSION) VALUES (?,?,?)',
+                                   (TASKDB_STATES.PAUSED, yaml.dump(self._conf), SCHEMA_VERSION))
 
                 self._unlock_db()
             except Exception as e:
@@ -99,8 +300,307 @@ class SQLiteTaskDB(BaseTaskDB):
         else:
             raise ValueError("SQLite3 DB could not be locked when trying to create it!")
 
+    def _create_tables(self, c):
+        # states and log actions are stored as small integer codes, with their names here
+        c.execute("CREATE TABLE STATE_NAMES(\n"
+                  "CODE INTEGER PRIMARY KEY,\n"
+                  "NAME TEXT UNIQUE NOT NULL);")
+        c.execute("CREATE TABLE ACTION_NAMES(\n"
+                  "CODE INTEGER PRIMARY KEY,\n"
+                  "NAME TEXT UNIQUE NOT NULL);")
+
+        # tasks are keyed by the integer ID, which is all the logs refer to, and the
+        # external TASK_ID is kept in its own index
+        c.execute("CREATE TABLE TASKDATA(\n"
+                  "ID INTEGER PRIMARY KEY AUTOINCREMENT,\n"
+                  "TASK_ID TEXT UNIQUE NOT NULL,\n"
+                  "CMD TEXT DEFAULT '',\n"
+                  "STATE INTEGER NOT NULL,\n"
+                  "PRIORITY REAL DEFAULT 0,\n"
+                  "START_TIME INTEGER,\n"
+                  "END_TIME INTEGER,\n"
+                  "NUM_ATTEMPTS INTEGER DEFAULT 0,\n"
+                  "RUNTIME INTEGER,\n"
+                  "LEASE_EXPIRY INTEGER,\n"
+                  "CLIENT TEXT,\n"
+                  "NUM_DEPS_LEFT INTEGER DEFAULT 0,\n"
+                  "GRP INTEGER DEFAULT 0,\n"
+                  "ADD_TIME INTEGER,\n"
+                  "SORT_KEY REAL DEFAULT 0);")
+
+        self._create_dependencies(c)
+        self._create_groups(c)
+
+        # tasks removed from the DB keep their key here so that their logs can still be found
+        c.execute("CREATE TABLE REMOVED_TASKS(\n"
+                  "ID INTEGER PRIMARY KEY,\n"
+                  "TASK_ID TEXT NOT NULL);")
+
+        c.execute("CREATE TABLE LOGDATA(\n"
+                  "LOG_ID INTEGER PRIMARY KEY,\n"
+                  "TASK INTEGER NOT NULL,\n"
+                  "ACTION INTEGER NOT NULL,\n"
+                  "TIME INTEGER NOT NULL,\n"
+                  "INFO TEXT DEFAULT '');")
+
+        # finished tasks are moved here by archive() along with their logs so that
+        # the TASKDATA and LOGDATA tables only hold the tasks still being worked on
+        c.execute("CREATE TABLE ARCHIVEDATA(\n"
+                  "ID INTEGER PRIMARY KEY,\n"
+                  "TASK_ID TEXT UNIQUE NOT NULL,\n"
+                  "CMD TEXT DEFAULT '',\n"
+                  "STATE INTEGER,\n"
+                  "PRIORITY REAL DEFAULT 0,\n"
+                  "START_TIME INTEGER,\n"
+                  "END_TIME INTEGER,\n"
+                  "NUM_ATTEMPTS INTEGER DEFAULT 0,\n"
+                  "RUNTIME INTEGER,\n"
+                  "ARCHIVE_TIME INTEGER,\n"
+                  "LOGS BLOB);")
+
+    def _create_dependencies(self, c):
+        # one row per task and task it depends on, keyed so that the tasks waiting on a
+        # given task are found with a single search of the DEPENDS_ON index
+        c.execute("CREATE TABLE IF NOT EXISTS DEPENDENCIES(\n"
+                  "TASK INTEGER NOT NULL,\n"
+                  "DEPENDS_ON INTEGER NOT NULL,\n"
+                  "PRIMARY KEY (TASK, DEPENDS_ON)) WITHOUT ROWID;")
+
+    def _create_groups(self, c):
+        # checkout shares the tasks out between the groups in proportion to their weights
+        # with stride scheduling, where each task checked out of a group advances the
+        # PASS of the group by 1 / WEIGHT and the group with the lowest PASS goes next
+        c.execute("CREATE TABLE IF NOT EXISTS GROUPS(\n"
+                  "CODE INTEGER PRIMARY KEY,\n"
+                  "NAME TEXT UNIQUE NOT NULL,\n"
+                  "WEIGHT REAL DEFAULT 1,\n"
+                  "AGING REAL DEFAULT 0,\n"
+                  "PASS REAL DEFAULT 0);")
+        c.execute("INSERT OR IGNORE INTO GROUPS (CODE, NAME) VALUES (0, ?)", (DEFAULT_GROUP,))
+
+    def _create_indexes(self, c):
+        # checkout reads the next task of a given state and group straight off of this index
+        c.execute("CREATE INDEX IF NOT EXISTS TASKDATA_STATE_GROUP ON TASKDATA(STATE, GRP, SORT_KEY DESC);")
+        c.execute("CREATE INDEX IF NOT EXISTS LOGDATA_TASK ON LOGDATA(TASK);")
+        c.execute("CREATE INDEX IF NOT EXISTS REMOVED_TASKS_TASK_ID ON REMOVED_TASKS(TASK_ID);")
+        c.execute("CREATE INDEX IF NOT EXISTS DEPENDENCIES_DEPENDS_ON ON DEPENDENCIES(DEPENDS_ON);")
+
+        # only running tasks hold leases, so the index of their expiry times stays small
+        running = c.execute("SELECT CODE FROM STATE_NAMES WHERE NAME = ?", (TASK_STATES.RUNNING,)).fetchone()[0]
+        c.execute("CREATE INDEX IF NOT EXISTS TASKDATA_LEASE_EXPIRY ON TASKDATA(LEASE_EXPIRY)\n"
+                  "WHERE STATE = %d;" % running)
+
+        # runtime reads the stats of the succeeded tasks off of these instead of the tables
+        succeeded = c.execute("SELECT CODE FROM STATE_NAMES WHERE NAME = ?", (TASK_STATES.SUCCEEDED,)).fetchone()[0]
+        for table in ['TASKDATA', 'ARCHIVEDATA']:
+            c.execute("CREATE INDEX IF NOT EXISTS %s_RUNTIME ON %s(RUNTIME)\n"
+                      "WHERE STATE = %d;" % (table, table, succeeded))
+
+    def _create_state_counts(self, c):
+        # the number of tasks in each state is kept up to date by triggers so that
+        # status never has to count the tasks
+        c.execute("CREATE TABLE STATE_COUNTS(\n"
+                  "STATE INTEGER PRIMARY KEY NOT NULL,\n"
+                  "NUM INTEGER DEFAULT 0);")
+        c.execute("INSERT INTO STATE_COUNTS (STATE, NUM) SELECT CODE, 0 FROM STATE_NAMES")
+
+        c.execute("CREATE TRIGGER TASKDATA_COUNT_INSERT AFTER INSERT ON TASKDATA\n"
+                  "BEGIN\n"
+                  "INSERT OR IGNORE INTO STATE_COUNTS (STATE, NUM) VALUES (NEW.STATE, 0);\n"
+                  "UPDATE STATE_COUNTS SET NUM = NUM + 1 WHERE STATE = NEW.STATE;\n"
+                  "END;")
+        c.execute("CREATE TRIGGER TASKDATA_COUNT_DELETE AFTER DELETE ON TASKDATA\n"
+                  "BEGIN\n"
+                  "UPDATE STATE_COUNTS SET NUM = NUM - 1 WHERE STATE = OLD.STATE;\n"
+                  "END;")
+        c.execute("CREATE TRIGGER TASKDATA_COUNT_UPDATE AFTER UPDATE OF STATE ON TASKDATA\n"
+                  "WHEN OLD.STATE IS NOT NEW.STATE\n"
+                  "BEGIN\n"
+                  "UPDATE STATE_COUNTS SET NUM = NUM - 1 WHERE STATE = OLD.STATE;\n"
+                  "INSERT OR IGNORE INTO STATE_COUNTS (STATE, NUM) VALUES (NEW.STATE, 0);\n"
+                  "UPDATE STATE_COUNTS SET NUM = NUM + 1 WHERE STATE = NEW.STATE;\n"
+                  "END;")
+
+    def _create_triggers(self, c):
+        # task IDs stay unique across the tasks and the archive
+        c.execute("CREATE TRIGGER TASKDATA_ARCHIVE_UNIQUE BEFORE INSERT ON TASKDATA\n"
+                  "WHEN EXISTS (SELECT 1 FROM ARCHIVEDATA WHERE TASK_ID = NEW.TASK_ID)\n"
+                  "BEGIN\n"
+                  "SELECT RAISE(ABORT, 'task ID is already in the archive');\n"
+                  "END;")
+
+    def _create_views(self, c):
+        # the tasks, logs and archive with names for the states and actions and
+        # times in seconds (or as text for the logs), as they were in schema version 1
+        c.execute("CREATE VIEW TASKS AS\n"
+                  "SELECT t.TASK_ID AS TASK_ID, t.CMD AS CMD, s.NAME AS STATE, t.PRIORITY AS PRIORITY,\n"
+                  "t.START_TIME / 1000.0 AS START_TIME, t.END_TIME / 1000.0 AS END_TIME,\n"
+                  "t.NUM_ATTEMPTS AS NUM_ATTEMPTS, t.RUNTIME / 1000.0 AS RUNTIME\n"
+                  "FROM TASKDATA AS t JOIN STATE_NAMES AS s ON s.CODE = t.STATE;")
+        logs = ("SELECT l.LOG_ID AS LOG_ID, a.NAME AS ACTION, l.INFO AS INFO,\n"
+                "strftime('%%Y-%%m-%%d %%H:%%M:%%S', l.TIME / 1000, 'unixepoch') || printf('.%%03d', l.TIME %% 1000)\n"
+                "AS TIME, t.TASK_ID AS TASK_ID\n"
+                "FROM LOGDATA AS l JOIN %s AS t ON t.ID = l.TASK\n"
+                "JOIN ACTION_NAMES AS a ON a.CODE = l.ACTION")
+        c.execute("CREATE VIEW LOGS AS\n%s\nUNION ALL\n%s;" % (logs % 'TASKDATA', logs % 'REMOVED_TASKS'))
+        c.execute("CREATE VIEW ARCHIVE AS\n"
+                  "SELECT r.TASK_ID AS TASK_ID, r.CMD AS CMD, s.NAME AS STATE, r.PRIORITY AS PRIORITY,\n"
+                  "r.START_TIME / 1000.0 AS START_TIME, r.END_TIME / 1000.0 AS END_TIME,\n"
+                  "r.NUM_ATTEMPTS AS NUM_ATTEMPTS, r.RUNTIME / 1000.0 AS RUNTIME,\n"
+                  "r.ARCHIVE_TIME / 1000.0 AS ARCHIVE_TIME, r.LOGS AS LOGS\n"
+                  "FROM ARCHIVEDATA AS r JOIN STATE_NAMES AS s ON s.CODE = r.STATE;")
+
+    def _migrate_db(self):
+        """upgrade a DB made by an older version of cake to the current schema"""
+        if self._lock_db(exclusive=True, msg='migrate'):
+            try:
+                version = self._schema_version()
+                if version < 2:
+                    self._migrate_v1(self._conn)
+                if version < 3:
+                    self._migrate_v2(self._conn)
+                if version < 4:
+                    self._migrate_v3(self._conn)
+                if version < 5:
+                    self._migrate_v4(self._conn)
+                self._create_indexes(self._conn)
+                self._conn.execute("UPDATE INFO SET VERSION = ?", (SCHEMA_VERSION,))
+                self._unlock_db()
+            except Exception as e:
+                self._rollback_db()
+                raise ValueError("SQLite3 DB could not be migrated! - %s" % e)
+        else:
+            raise ValueError("SQLite3 DB could not be locked when trying to migrate it!")
+
+        # give the space of the old tables back to the filesystem
+        self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._conn.execute("VACUUM")
+
+    def _migrate_v1(self, c):
+        """convert a version 1 DB, with only the TASKS, LOGS, INFO and CLIENTS tables, to version 2"""
+        # the timing columns are filled in from the logs first
+        for column in ['START_TIME REAL', 'END_TIME REAL', 'NUM_ATTEMPTS INTEGER DEFAULT 0', 'RUNTIME REAL']:
+            c.execute("ALTER TABLE TASKS ADD COLUMN %s" % column)
+        self._backfill_timing(c)
+
+        self._create_tables(c)
+        self._insert_names(c)
+        c.execute("INSERT OR IGNORE INTO STATE_NAMES (NAME) SELECT DISTINCT STATE FROM TASKS")
+        c.execute("INSERT OR IGNORE INTO ACTION_NAMES (NAME) SELECT DISTINCT ACTION FROM LOGS")
+
+        def _msecs(column):
+            return "CAST(ROUND(%s * 1000.0) AS INTEGER)" % column
+
+        c.execute("INSERT INTO TASKDATA (TASK_ID, CMD, STATE, PRIORITY, START_TIME, END_TIME, NUM_ATTEMPTS,\n"
+                  "RUNTIME)\n"
+                  "SELECT t.TASK_ID, t.CMD, s.CODE, t.PRIORITY, %s, %s, t.NUM_ATTEMPTS, %s\n"
+                  "FROM TASKS AS t JOIN STATE_NAMES AS s ON s.NAME = t.STATE ORDER BY t.ROWID"
+                  % (_msecs('t.START_TIME'), _msecs('t.END_TIME'), _msecs('t.RUNTIME')))
+
+        # tasks that were removed from the DB get their keys from TASKDATA as well
+        c.execute("INSERT INTO TASKDATA (TASK_ID, STATE)\n"
+                  "SELECT DISTINCT l.TASK_ID, -1 FROM LOGS AS l WHERE l.TASK_ID IS NOT NULL\n"
+                  "AND NOT EXISTS (SELECT 1 FROM TASKDATA AS t WHERE t.TASK_ID = l.TASK_ID)")
+        c.execute("INSERT INTO REMOVED_TASKS (ID, TASK_ID) SELECT ID, TASK_ID FROM TASKDATA WHERE STATE = -1")
+
+        # julianday gives times in days since noon on 4714-11-24 BC
+        c.execute("INSERT INTO LOGDATA (LOG_ID, TASK, ACTION, TIME, INFO)\n"
+                  "SELECT l.LOG_ID, t.ID, a.CODE, %s, COALESCE(l.INFO, '')\n"
+                  "FROM LOGS AS l JOIN TASKDATA AS t ON t.TASK_ID = l.TASK_ID\n"
+                  "JOIN ACTION_NAMES AS a ON a.NAME = l.ACTION ORDER BY l.LOG_ID"
+                  % _msecs('(julianday(l.TIME) - 2440587.5) * 86400.0'))
+
+        c.execute("DELETE FROM TASKDATA WHERE STATE = -1")
+        c.execute("DROP TABLE LOGS")
+        c.execute("DROP TABLE TASKS")
+
+        # indexes, counts and triggers are made after the rows are copied since that is faster
+        self._create_indexes(c)
+        self._create_state_counts(c)
+        c.execute("INSERT OR REPLACE INTO STATE_COUNTS (STATE, NUM)\n"
+                  "SELECT STATE, COUNT(*) FROM TASKDATA GROUP BY STATE")
+        self._create_triggers(c)
+        self._create_views(c)
+
+        c.execute("ALTER TABLE INFO ADD COLUMN VERSION INTEGER DEFAULT 1")
+
+    def _migrate_v2(self, c):
+        """convert a version 2 DB to version 3"""
+        # DBs migrated from version 1 already have the lease columns of TASKDATA
+        columns = set(row[1] for row in c.execute("PRAGMA table_info(TASKDATA)"))
+        for column in ['LEASE_EXPIRY INTEGER', 'CLIENT TEXT']:
+            if column.split()[0] not in columns:
+                c.execute("ALTER TABLE TASKDATA ADD COLUMN %s" % column)
+        c.execute("ALTER TABLE CLIENTS ADD COLUMN HEARTBEAT INTEGER")
+
+    def _migrate_v3(self, c):
+        """convert a version 3 DB to version 4"""
+        columns = set(row[1] for row in c.execute("PRAGMA table_info(TASKDATA)"))
+        if 'NUM_DEPS_LEFT' not in columns:
+            c.execute("ALTER TABLE TASKDATA ADD COLUMN NUM_DEPS_LEFT INTEGER DEFAULT 0")
+        self._create_dependencies(c)
+
+    def _migrate_v4(self, c):
+        """convert a version 4 DB to version 5"""
+        columns = set(row[1] for row in c.execute("PRAGMA table_info(TASKDATA)"))
+        for column in ['GRP INTEGER DEFAULT 0', 'ADD_TIME INTEGER', 'SORT_KEY REAL DEFAULT 0']:
+            if column.split()[0] not in columns:
+                c.execute("ALTER TABLE TASKDATA ADD COLUMN %s" % column)
+        if 'VIRTUAL_TIME' not in set(row[1] for row in c.execute("PRAGMA table_info(INFO)")):
+            c.execute("ALTER TABLE INFO ADD COLUMN VIRTUAL_TIME REAL DEFAULT 0")
+        self._create_groups(c)
+
+        # all of the tasks go into the default group, which does not age
+        c.execute("UPDATE TASKDATA SET GRP = 0, SORT_KEY = PRIORITY, ADD_TIME = (\n"
+                  "SELECT MIN(l.TIME) FROM LOGDATA AS l JOIN ACTION_NAMES AS a ON a.CODE = l.ACTION\n"
+                  "WHERE l.TASK = TASKDATA.ID AND a.NAME = ?)", (TASK_LOG_ACTIONS.ADDED,))
+        c.execute("DROP INDEX IF EXISTS TASKDATA_STATE_PRIORITY")
+
+    def _backfill_timing(self, c):
+        """fill in the timing columns of a version 1 TASKS table from its LOGS table"""
+        from itertools import groupby
+
+        def _timing(logs):
+            stime = None
+            etime = None
+            num_attempts = 0
+            for _, action, _time in logs:
+                if action == TASK_LOG_ACTIONS.RAN or action == TASK_LOG_ACTIONS.RAN_FROM_CHECKPOINT:
+                    num_attempts += 1
+                    if action == TASK_LOG_ACTIONS.RAN or stime is None:
+                        stime = _time
+                    etime = None
+                elif action in VALID_LOG_CHECKIN_ACTIONS:
+                    etime = _time
+                elif action in [TASK_LOG_ACTIONS.RESET, TASK_LOG_ACTIONS.UPDATED]:
+                    stime = None
+                    etime = None
+                    if action == TASK_LOG_ACTIONS.RESET:
+                        num_attempts = 0
+
+            if stime is not None and etime is not None:
+                rtime = etime - stime
+            else:
+                rtime = None
+
+            return stime, etime, num_attempts, rtime
+
+        clogs = self._conn.cursor()
+        clogs.execute("SELECT TASK_ID, ACTION, (julianday(TIME) - 2440587.5) * 86400.0\n"
+                      "FROM LOGS ORDER BY TASK_ID, LOG_ID")
+
+        rows = []
+        for id, logs in groupby(clogs, lambda x: x[0]):
+            rows.append(_timing(logs) + (id,))
+            if len(rows) >= 10000:
+                c.executemany("UPDATE TASKS SET START_TIME = ?, END_TIME = ?, NUM_ATTEMPTS = ?, RUNTIME = ?\n"
+                              "WHERE TASK_ID = ?", rows)
+                rows = []
+        c.executemany("UPDATE TASKS SET START_TIME = ?, END_TIME = ?, NUM_ATTEMPTS = ?, RUNTIME = ?\n"
+                      "WHERE TASK_ID = ?", rows)
+
     def _add_client(self, client_id):
-        if self._lock_db(transaction=True, msg='add client'):
+        if self._lock_db(exclusive=True, msg='add client'):
             try:
                 self._conn.execute("INSERT INTO CLIENTS (CLIENT_ID) VALUES (?)", (client_id,))
                 self._unlock_db()
@@ -112,12 +612,18 @@ class SQLiteTaskDB(BaseTaskDB):
 
     def close(self):
         """close down the DB"""
+        self._stop_heartbeat()
+
+        if self._read_only:
+            self._conn.close()
+            return
+
         if self._lock_db(exclusive=True, msg='close'):
             try:
                 num_clients = self._conn.execute('SELECT COUNT(*) FROM CLIENTS').fetchall()[0][0]
-                self._conn.execute("DELETE FROM CLIENTS WHERE CLIENT_ID = '%s'" % self._client_id)
+                self._conn.execute("DELETE FROM CLIENTS WHERE CLIENT_ID = ?", (self._client_id,))
                 if num_clients == 1:
-                    self._conn.execute("UPDATE INFO SET STATE = '%s'" % TASKDB_STATES.PAUSED)
+                    self._conn.execute("UPDATE INFO SET STATE = ?", (TASKDB_STATES.PAUSED,))
                 self._unlock_db()
             except Exception as e:
                 self._rollback_db()
@@ -127,15 +633,64 @@ class SQLiteTaskDB(BaseTaskDB):
 
         self._conn.close()
 
+    def _configure_db(self):
+        """set the journal mode, busy handling and other pragmas of the connection"""
+        self._conn.execute("PRAGMA busy_timeout = %d" % int(1000.0 * self._conf['busy_timeout']))
+        self._conn.execute("PRAGMA cache_size = %d" % self._conf['cache_size'])
+        self._conn.execute("PRAGMA mmap_size = %d" % self._conf['mmap_size'])
+
+        if self._read_only:
+            self._journal_mode = self._conn.execute("PRAGMA journal_mode").fetchall()[0][0].lower()
+            return
+
+        # WAL lets readers and the writer run at the same time, but needs shared memory
+        # between all clients, which network filesystems do not provide
+        journal_mode = self._conf['journal_mode'].lower()
+        if journal_mode == 'auto':
+            if filesystem_type(self._conf['name']) in NETWORK_FILESYSTEMS:
+                journal_mode = 'delete'
+            else:
+                journal_mode = 'wal'
+
+        self._journal_mode = self._conn.execute("PRAGMA journal_mode").fetchall()[0][0].lower()
+        if self._journal_mode != journal_mode:
+            try:
+                self._journal_mode = self._conn.execute(
+                    "PRAGMA journal_mode = %s" % journal_mode).fetchall()[0][0].lower()
+            except sqlite3.OperationalError as e:
+                # other clients are using the DB, so leave the journal mode alone
+                pass
+
+        synchronous = self._conf['synchronous']
+        if synchronous is None:
+            if self._journal_mode == 'wal':
+                synchronous = 'NORMAL'
+            else:
+                synchronous = 'FULL'
+        self._conn.execute("PRAGMA synchronous = %s" % synchronous)
+
     def _lock_db(self, transaction=False, exclusive=False, msg=''):
-        """lock the DB"""
+        """lock the DB
+
+        SQLite waits up to busy_timeout for the lock itself. Past that, each failed
+        attempt sleeps for an exponentially growing, jittered delay so that clients
+        waiting on a busy DB cost sleeps instead of CPU time."""
         if self._errcheck:
             print('CAKE: lock DB - %s' % msg)
 
+        if self._read_only and (exclusive or transaction):
+            raise ValueError("SQLite3 DB was opened read-only and cannot be locked for '%s'!" % msg)
+
+        if self._conn.in_transaction:
+            # left open by an operation that was interrupted (e.g., by a signal)
+            self._rollback_db()
+
         locked = False
 
+        delay = self._conf.get('lock_backoff_min', DEF_TASKDB_CONF['lock_backoff_min'])
+        max_delay = self._conf.get('lock_backoff_max', DEF_TASKDB_CONF['lock_backoff_max'])
         start = time.time()
-        while time.time() - start < self._conf['timeout']:
+        while True:
             try:
                 if exclusive:
                     self._conn.execute("BEGIN EXCLUSIVE")
@@ -146,9 +701,16 @@ class SQLiteTaskDB(BaseTaskDB):
 
                 locked = True
                 break
-            except Exception as e:
+            except sqlite3.OperationalError as e:
                 pass
 
+            remaining = self._conf['timeout'] - (time.time() - start)
+            if remaining <= 0:
+                break
+
+            time.sleep(min(random.uniform(0.5, 1.0) * delay, remaining))
+            delay = min(2.0 * delay, max_delay)
+
         return locked
 
     def _unlock_db(self):
@@ -162,74 +724,333 @@ class SQLiteTaskDB(BaseTaskDB):
         self._conn.execute('rollback')
 
     def _write_log(self, c, task_id, action, info=''):
-        c.execute("INSERT INTO LOGS(ACTION, TASK_ID, INFO) VALUES (?,?,?)",
-                  (action, task_id, info))
+        c.execute("INSERT INTO LOGDATA (TASK, ACTION, TIME, INFO)\n"
+                  "SELECT ID, ?, ?, ? FROM TASKDATA WHERE TASK_ID = ?",
+                  (self._action_codes[action], _now(), info, task_id))
 
     def _update_task_state(self, c, task_id, state):
-        c.execute("UPDATE TASKS SET STATE = '%s' WHERE TASK_ID = '%s'" % (state, task_id))
+        c.execute("UPDATE TASKDATA SET STATE = ? WHERE TASK_ID = ?", (self._state_codes[state], task_id))
+
+    def _lease_expiry(self, now):
+        """the time a lease taken or renewed at now runs out, or None if leases are off"""
+        if self._conf['lease_time'] is None:
+            return None
+        return now + int(round(self._conf['lease_time'] * 1000.0))
+
+    def _start_task(self, c, key, stime):
+        # tasks run from a checkpoint keep the start time of their first run
+        c.execute("UPDATE TASKDATA SET STATE = ?,\n"
+                  "START_TIME = CASE WHEN STATE = ? AND START_TIME IS NOT NULL THEN START_TIME ELSE ? END,\n"
+                  "END_TIME = NULL, RUNTIME = NULL, NUM_ATTEMPTS = NUM_ATTEMPTS + 1,\n"
+                  "LEASE_EXPIRY = ?, CLIENT = ?\n"
+                  "WHERE ID = ?", (self._state_codes[TASK_STATES.RUNNING],
+                                   self._state_codes[TASK_STATES.CHECKPOINTED], stime,
+                                   self._lease_expiry(stime), self._client_id, key))
+
+    def _end_task(self, c, task_id, state, etime):
+        """end the task task_id if this client still holds its lease, returning whether it did
+
+        Once a lease expired, the task may have been checked out again by another client,
+        whose run is the one that counts."""
+        row = c.execute("SELECT ID, STATE, CLIENT FROM TASKDATA WHERE TASK_ID = ?", (task_id,)).fetchone()
+        if row is None:
+            return False
+
+        key, old_state, client = row
+        if old_state != self._state_codes[TASK_STATES.RUNNING] or client != self._client_id:
+            return False
+
+        c.execute("UPDATE TASKDATA SET STATE = ?, END_TIME = ?, RUNTIME = ? - START_TIME,\n"
+                  "LEASE_EXPIRY = NULL, CLIENT = NULL\n"
+                  "WHERE ID = ?", (self._state_codes[state], etime, etime, key))
+        self._update_dependents(c, key, self._state_names[old_state], state)
+        return True
+
+    def _add_dependencies(self, c, key, task_id, depends_on):
+        """make the task with key wait on the tasks with IDs in depends_on
+
+        Tasks that have SUCCEEDED, including those in the archive, count as done already."""
+        num_left = 0
+        for dep_id in depends_on:
+            dep_id = str(dep_id)
+            if dep_id == task_id:
+                raise ValueError("Task %s cannot depend on itself!" % task_id)
+
+            row = c.execute("SELECT ID, STATE FROM TASKDATA WHERE TASK_ID = ?", (dep_id,)).fetchone()
+            if row is None:
+                row = c.execute("SELECT NULL, STATE FROM ARCHIVEDATA WHERE TASK_ID = ?", (dep_id,)).fetchone()
+            if row is None:
+                raise ValueError("Task %s depends on task %s, which is not in the DB!" % (task_id, dep_id))
+
+            dep_key, dep_state = row
+            if dep_state == self._state_codes[TASK_STATES.DELETED]:
+                raise ValueError("Task %s depends on task %s, which was deleted!" % (task_id, dep_id))
+
+            if dep_key is not None:
+                res = c.execute("INSERT OR IGNORE INTO DEPENDENCIES (TASK, DEPENDS_ON) VALUES (?, ?)", (key, dep_key))
+                if dep_state != self._state_codes[TASK_STATES.SUCCEEDED] and res.rowcount > 0:
+                    num_left += 1
+
+        if num_left > 0:
+            c.execute("UPDATE TASKDATA SET NUM_DEPS_LEFT = ?, STATE = ? WHERE ID = ?",
+                      (num_left, self._state_codes[TASK_STATES.QUEUED_WITH_DEP], key))
+
+    def _update_dependents(self, c, key, old_state, new_state):
+        """count the task with key as done, or not done any more, for the tasks that depend on it
+
+        Only the direct dependents are touched. Queued dependents are moved between
+        QUEUED_WITH_DEP and QUEUED_NO_DEP as their last dependency finishes or is undone.
+        Tasks finished for good (SUCCEEDED or DELETED) count as done, but the tasks still
+        waiting on a task deleted before it SUCCEEDED could never run, so they are deleted too."""
+        if old_state == new_state:
+            return
+
+        if new_state == TASK_STATES.DELETED and old_state != TASK_STATES.SUCCEEDED:
+            self._delete_waiting(c, key)
+
+        if (old_state in ARCHIVE_TASK_STATES) == (new_state in ARCHIVE_TASK_STATES):
+            return
+
+        delta = -1 if new_state in ARCHIVE_TASK_STATES else 1
+        c.execute("UPDATE TASKDATA SET NUM_DEPS_LEFT = NUM_DEPS_LEFT + ?\n"
+                  "WHERE ID IN (SELECT TASK FROM DEPENDENCIES WHERE DEPENDS_ON = ?)", (delta, key))
+        c.execute("UPDATE TASKDATA SET STATE = CASE WHEN NUM_DEPS_LEFT > 0 THEN ? ELSE ? END\n"
+                  "WHERE ID IN (SELECT TASK FROM DEPENDENCIES WHERE DEPENDS_ON = ?) AND STATE IN (?, ?)",
+                  (self._state_codes[TASK_STATES.QUEUED_WITH_DEP], self._state_codes[TASK_STATES.QUEUED_NO_DEP],
+                   key, self._state_codes[TASK_STATES.QUEUED_WITH_DEP],
+                   self._state_codes[TASK_STATES.QUEUED_NO_DEP]))
+
+    def _delete_waiting(self, c, key):
+        """mark the tasks waiting on the task with key, which is being deleted, as DELETED"""
+        task_id = c.execute("SELECT TASK_ID FROM TASKDATA WHERE ID = ?", (key,)).fetchone()[0]
+        rows = c.execute("SELECT ID FROM TASKDATA WHERE STATE = ? AND\n"
+                         "ID IN (SELECT TASK FROM DEPENDENCIES WHERE DEPENDS_ON = ?)",
+                         (self._state_codes[TASK_STATES.QUEUED_WITH_DEP], key)).fetchall()
+        for dep_key, in rows:
+            c.execute("INSERT INTO LOGDATA (TASK, ACTION, TIME, INFO) VALUES (?, ?, ?, ?)",
+                      (dep_key, self._action_codes[TASK_LOG_ACTIONS.DELETED], _now(),
+                       'depends on deleted task %s' % task_id))
+            c.execute("UPDATE TASKDATA SET STATE = ? WHERE ID = ?", (self._state_codes[TASK_STATES.DELETED], dep_key))
+            self._update_dependents(c, dep_key, TASK_STATES.QUEUED_WITH_DEP, TASK_STATES.DELETED)
+
+    def _reclaim_expired(self, c, now):
+        """mark the running tasks of other clients whose leases ran out before now as KILLED
+
+        Returns the number of tasks reclaimed. The clients that held the leases and any
+        other clients that have not sent a heartbeat for a whole lease are dropped as well."""
+        # the state is part of the SQL so that the partial index of the leases can be used,
+        # which sqlite would otherwise pass over for the (STATE, GRP, SORT_KEY) index
+        rows = c.execute("SELECT ID, CLIENT FROM TASKDATA INDEXED BY TASKDATA_LEASE_EXPIRY\n"
+                         "WHERE STATE = %d AND LEASE_EXPIRY < ? AND CLIENT IS NOT ?"
+                         % self._state_codes[TASK_STATES.RUNNING], (now, self._client_id)).fetchall()
+        keys = [(key,) for key, _ in rows]
+
+        if len(keys) > 0:
+            c.executemany("INSERT INTO LOGDATA (TASK, ACTION, TIME, INFO) VALUES (?, ?, ?, 'lease expired')",
+                          [key + (self._action_codes[TASK_LOG_ACTIONS.EXPIRED], now) for key in keys])
+            c.executemany("UPDATE TASKDATA SET STATE = ?, LEASE_EXPIRY = NULL, CLIENT = NULL WHERE ID = ?",
+                          [(self._state_codes[TASK_STATES.KILLED],) + key for key in keys])
+            c.executemany("DELETE FROM CLIENTS WHERE CLIENT_ID = ?",
+                          [(client,) for client in set(client for _, client in rows)])
+
+        if self._conf['lease_time'] is not None:
+            c.execute("DELETE FROM CLIENTS WHERE HEARTBEAT < ? AND CLIENT_ID != ?",
+                      (now - int(round(self._conf['lease_time'] * 1000.0)), self._client_id))
+
+        return len(keys)
+
+    def _start_heartbeat(self):
+        """start renewing the leases of the tasks this client has checked out"""
+        if self._heartbeat is not None or self._conf['lease_time'] is None:
+            return
+
+        interval = self._conf['heartbeat_interval']
+        if interval is None:
+            interval = self._conf['lease_time'] / 3.0
+
+        stop = threading.Event()
+        thread = threading.Thread(target=self._heartbeat_loop, args=(stop, interval), name='cake-heartbeat')
+        thread.daemon = True
+        self._heartbeat = (thread, stop)
+        thread.start()
+
+    def _stop_heartbeat(self):
+        if self._heartbeat is not None:
+            thread, stop = self._heartbeat
+            stop.set()
+            thread.join()
+            self._heartbeat = None
+
+    def _heartbeat_loop(self, stop, interval):
+        # sqlite connections cannot be shared between threads, so the heartbeat has its own
+        conn = self._connect(self._conf['name'])
+        try:
+            delay = interval
+            while not stop.wait(delay):
+                try:
+                    now = _now()
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.execute("UPDATE TASKDATA SET LEASE_EXPIRY = ? WHERE STATE = ? AND CLIENT = ?",
+                                 (self._lease_expiry(now), self._state_codes[TASK_STATES.RUNNING],
+                                  self._client_id))
+                    conn.execute("UPDATE CLIENTS SET HEARTBEAT = ? WHERE CLIENT_ID = ?", (now, self._client_id))
+                    conn.execute("COMMIT")
+                    delay = interval
+                except sqlite3.Error as e:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    # try again soon instead of letting the leases run out
+                    delay = min(interval, 1.0)
+        finally:
+            conn.close()
+
+    def _select_group_tasks(self, c, states, grp, num):
+        """select the num highest priority tasks of group grp with a state in states
+
+        Each state is looked up separately so that every query is a single search of
+        the (STATE, GRP, SORT_KEY) index instead of a scan and sort of the whole table."""
+        tasks = []
+        for state in states:
+            tasks.extend((cmd, id, state, sort_key, key) for cmd, id, sort_key, key in c.execute(
+                "SELECT CMD, TASK_ID, SORT_KEY, ID FROM TASKDATA WHERE STATE = ? AND GRP = ?\n"
+                "ORDER BY SORT_KEY DESC, ID ASC LIMIT ?;", (self._state_codes[state], grp, num)).fetchall())
+        tasks.sort(key=lambda x: (-x[3], x[4]))
+        return tasks[:num]
+
+    def _select_tasks(self, c, states, num):
+        """select num tasks with a state in states, sharing them out between the groups
+
+        The group with the lowest PASS gives up its next task and has its PASS advanced
+        by 1 / WEIGHT. Groups that had nothing to run start from the PASS of the groups
+        that did (the virtual time), so that they cannot make up for the time they were idle."""
+        vtime = c.execute("SELECT VIRTUAL_TIME FROM INFO").fetchone()[0]
+        heap = [(max(pass_, vtime), grp, weight) for grp, weight, pass_ in
+                c.execute("SELECT CODE, WEIGHT, PASS FROM GROUPS").fetchall()]
+        heapq.heapify(heap)
+
+        tasks = []
+        queued = {}
+        passes = {}
+        while len(heap) > 0 and len(tasks) < num:
+            pass_, grp, weight = heapq.heappop(heap)
+            if grp not in queued:
+                queued[grp] = self._select_group_tasks(c, states, grp, num - len(tasks))[::-1]
+            if len(queued[grp]) == 0:
+                continue
+
+            tasks.append(queued[grp].pop())
+            vtime = max(vtime, pass_)
+            passes[grp] = pass_ + 1.0 / weight
+            heapq.heappush(heap, (passes[grp], grp, weight))
+
+        if len(passes) > 0:
+            c.executemany("UPDATE GROUPS SET PASS = ? WHERE CODE = ?", [(p, grp) for grp, p in passes.items()])
+            c.execute("UPDATE INFO SET VIRTUAL_TIME = ?", (vtime,))
+
+        return tasks
+
+    def _group(self, c, name):
+        """get the code and aging of the group called name, adding the group if it is new"""
+        if name is None:
+            name = DEFAULT_GROUP
+
+        row = c.execute("SELECT CODE, AGING FROM GROUPS WHERE NAME = ?", (name,)).fetchone()
+        if row is None:
+            c.execute("INSERT INTO GROUPS (NAME, PASS) SELECT ?, VIRTUAL_TIME FROM INFO", (name,))
+            row = c.execute("SELECT CODE, AGING FROM GROUPS WHERE NAME = ?", (name,)).fetchone()
+        return row
+
+    def set_group(self, name, weight=None, aging=None):
+        """set the weight and/or priority aging of the group called name
+
+        Each group gets a share of the tasks checked out in proportion to its weight. With
+        aging, the tasks of the group gain aging in priority for every hour they wait."""
+        if weight is not None and weight <= 0:
+            raise ValueError("The weight of group '%s' has to be positive!" % name)
+
+        if self._lock_db(exclusive=True, msg='set group'):
+            try:
+                grp, old_aging = self._group(self._conn, name)
+                if weight is not None:
+                    self._conn.execute("UPDATE GROUPS SET WEIGHT = ? WHERE CODE = ?", (weight, grp))
+                if aging is not None and aging != old_aging:
+                    self._conn.execute("UPDATE GROUPS SET AGING = ? WHERE CODE = ?", (aging, grp))
+                    self._conn.execute("UPDATE TASKDATA SET SORT_KEY = PRIORITY - ? * COALESCE(ADD_TIME, 0) / ?\n"
+                                       "WHERE GRP = ?", (aging, MSECS_PER_HOUR, grp))
+                self._unlock_db()
+            except Exception as e:
+                self._rollback_db()
+                raise ValueError("Could not set group '%s'!" % name)
+        else:
+            raise ValueError("Could not get lock to set group '%s'!" % name)
 
     def checkout(self, state=None):
         """checkout a task from the DB"""
+        tasks = self.checkout_many(1, state=state)
+        if len(tasks) == 0:
+            return None, None
+        else:
+            return tasks[0]
+
+    def checkout_many(self, n, state=None):
+        """checkout up to n tasks from the DB in a single transaction"""
 
         if state is not None and state not in LIST_OF_TASK_STATES:
             raise ValueError("State '%s' not a valid task state!" % state)
 
-        got_task = False
-        task = None
-        id = None
+        if state is None:
+            states = CHECKOUT_TASK_STATES
+        else:
+            states = [state]
+
+        tasks = []
 
         for itr in range(self._conf['task_checkout_num_tries']):
             if itr > 0:
                 time.sleep(self._conf['task_checkout_delay'])
 
-            if self._lock_db(exclusive=True, msg='checkout'):
-                try:
-                    if state is None:
-                        c = self._conn.execute("SELECT CMD, TASK_ID, STATE FROM TASKS\n"
-                                               "WHERE STATE = '%s' OR STATE = '%s' OR STATE = '%s'\n"
-                                               "ORDER BY PRIORITY DESC LIMIT 1;"
-                                               % (TASK_STATES.QUEUED_NO_DEP,
-                                                  TASK_STATES.CHECKPOINTED,
-                                                  TASK_STATES.KILLED))
-                    else:
-                        c = self._conn.execute("SELECT CMD, TASK_ID, STATE\n"
-                                               "FROM TASKS WHERE STATE = '%s'\n"
-                                               "ORDER BY PRIORITY DESC LIMIT 1;"
-                                               % (state))
+            tasks = self._try_checkout(n, states)
+            if tasks is not None:
+                break
 
-                    tasks = c.fetchall()
-                    if len(tasks) == 0:
-                        self._unlock_db()
-                        break
-                    else:
-                        task, id, state = tasks[0]
+        return tasks or []
 
-                    self._update_task_state(self._conn, id, TASK_STATES.RUNNING)
+    def _try_checkout(self, n, states):
+        """checkout up to n tasks with a state in states, or return None if the DB could not be locked"""
+        if not self._lock_db(exclusive=True, msg='checkout'):
+            return None
 
-                    if state == TASK_STATES.CHECKPOINTED:
-                        logval = TASK_LOG_ACTIONS.RAN_FROM_CHECKPOINT
-                    else:
-                        logval = TASK_LOG_ACTIONS.RAN
+        tasks = []
+        try:
+            stime = _now()
+            if self._conf['lease_time'] is not None:
+                self._reclaim_expired(self._conn, stime)
 
-                    self._write_log(self._conn, id, logval)
+            for task, id, task_state, _, key in self._select_tasks(self._conn, states, n):
+                self._start_task(self._conn, key, stime)
 
-                    self._unlock_db()
+                if task_state == TASK_STATES.CHECKPOINTED:
+                    logval = TASK_LOG_ACTIONS.RAN_FROM_CHECKPOINT
+                else:
+                    logval = TASK_LOG_ACTIONS.RAN
 
-                    got_task = True
-                except Exception as e:
-                    self._rollback_db()
-                    got_task = False
-                    task = None
-                    id = None
-                    pass
+                self._write_log(self._conn, id, logval)
+                tasks.append((task, id))
 
-            if got_task:
-                break
+            self._unlock_db()
+        except Exception as e:
+            self._rollback_db()
+            return None
+
+        if len(tasks) > 0:
+            self._start_heartbeat()
 
-        return task, id
+        return tasks
 
     def checkin(self, task_id, state, info=''):
-        """checkin a task that has been run"""
+        """checkin a task that has been run
+
+        Checkins of tasks this client does not hold the lease on any more are dropped."""
 
         if type(task_id) != str:
             task_id = str(task_id)
@@ -239,8 +1060,8 @@ class SQLiteTaskDB(BaseTaskDB):
 
         if self._lock_db(exclusive=True, msg='checkin'):
             try:
-                self._update_task_state(self._conn, task_id, state)
-                self._write_log(self._conn, task_id, state, info=info)
+                if self._end_task(self._conn, task_id, state, _now()):
+                    self._write_log(self._conn, task_id, state, info=info)
                 self._unlock_db()
             except Exception as e:
                 self._rollback_db()
@@ -248,8 +1069,36 @@ class SQLiteTaskDB(BaseTaskDB):
         else:
             raise ValueError("Could not get lock for checkin of task %s in state '%s'!" % (task_id, state))
 
-    def add(self, cmd, id=None, priority=None):
-        """add a task to be run via cmd"""
+    def checkin_many(self, results):
+        """checkin a list of (task_id, state, info) for tasks that have been run in a single transaction"""
+
+        results = [(str(task_id), state, info) for task_id, state, info in results]
+        if len(results) == 0:
+            return
+
+        for task_id, state, info in results:
+            assert state in VALID_LOG_CHECKIN_ACTIONS,\
+                "Supplied task '%s' state is not allowed!" % state
+
+        if self._lock_db(exclusive=True, msg='checkin many'):
+            try:
+                etime = _now()
+                for task_id, state, info in results:
+                    if self._end_task(self._conn, task_id, state, etime):
+                        self._write_log(self._conn, task_id, state, info=info)
+                self._unlock_db()
+            except Exception as e:
+                self._rollback_db()
+                raise ValueError("Checkin of %d tasks failed!" % len(results))
+        else:
+            raise ValueError("Could not get lock for checkin of %d tasks!" % len(results))
+
+    def add(self, cmd, id=None, priority=None, depends_on=None, group=None):
+        """add a task to be run via cmd
+
+        The task is only run once all of the tasks with IDs in depends_on have SUCCEEDED.
+        Tasks are checked out of each group in turn according to the group weights (see
+        set_group), with tasks without a group put in the default group."""
 
         if id is None:
             id = uuid.uuid1().hex
@@ -262,64 +1111,141 @@ class SQLiteTaskDB(BaseTaskDB):
 
         if self._lock_db(exclusive=True, msg='add'):
             try:
-                c = self._conn.execute("SELECT TASK_ID FROM TASKS WHERE TASK_ID = '%s'" % id)
+                c = self._conn.execute("SELECT TASK_ID FROM TASKDATA WHERE TASK_ID = ?", (id,))
                 if len(c.fetchall()) != 0:
                     raise ValueError("Could not add task %s in state '%s' w/ cmd '%s' due to duplicate ID!" % (
                         id, state, cmd))
 
-                self._conn.execute("INSERT INTO TASKS(CMD, STATE, TASK_ID, PRIORITY) VALUES (?,?,?,?)",
-                                   (cmd, state, id, priority))
+                grp, aging = self._group(self._conn, group)
+                atime = _now()
+                c = self._conn.execute("INSERT INTO TASKDATA(CMD, STATE, TASK_ID, PRIORITY, GRP, ADD_TIME, SORT_KEY)\n"
+                                       "VALUES (?,?,?,?,?,?,?)",
+                                       (cmd, self._state_codes[state], id, priority, grp, atime,
+                                        _sort_key(priority, aging, atime)))
+                if depends_on:
+                    self._add_dependencies(self._conn, c.lastrowid, id, depends_on)
                 self._write_log(self._conn, id, log_state)
                 self._unlock_db()
             except Exception as e:
                 self._rollback_db()
-                raise ValueError("Could not add task %s in state '%s' w/ cmd '%s'!" % (id, state, cmd))
+                raise ValueError("Could not add task %s in state '%s' w/ cmd '%s'! - %s" % (id, state, cmd, e))
         else:
             raise ValueError("Could not lock DB to add task %s in state '%s' w/ cmd '%s'!" % (id, state, cmd))
 
         return id
 
-    def add_multiple(self, cmds, id=None, priority=None):
-        """add tasks to be run via cmd"""
+    def add_multiple(self, cmds, id=None, priority=None, chunksize=10000, atomic=True, callback=None,
+                     return_ids=True, group=None):
+        """add tasks to be run via cmd
+
+        cmds, id and priority can be any iterables (or priority a single value), so tasks can
+        be streamed in from a generator. Each cmd can also be a dict with the keys 'cmd' and
+        optionally 'id', 'priority', 'group' and 'depends_on', a list of the IDs of tasks added
+        before it or in the same call. Tasks without a group are put in group. Tasks are inserted chunksize at a time. If atomic is
+        False, each chunk is committed on its own so that workers can use the DB in between.
+        callback is called with the total number of tasks added and the IDs of the tasks in
+        the chunk after each chunk. Returns the list of task IDs, or the number of tasks added
+        if return_ids is False."""
 
         if id is None:
-            id = [uuid.uuid1().hex for cmd in cmds]
+            id = itertools.repeat(None)
 
         if priority is None:
-            priority = [0 for cmd in cmds]
+            priority = itertools.repeat(0)
         else:
             try:
                 priority = iter(priority)
             except Exception as e:
-                priority = [priority for cmd in cmds]
+                priority = itertools.repeat(priority)
+
+        def _rows():
+            for cmd, tid, tpriority in zip(cmds, id, priority):
+                depends_on = None
+                tgroup = group
+                if isinstance(cmd, dict):
+                    tid = cmd.get('id', tid)
+                    tpriority = cmd.get('priority', tpriority)
+                    tgroup = cmd.get('group', tgroup)
+                    depends_on = cmd.get('depends_on')
+                    cmd = cmd['cmd']
+                if tid is None:
+                    tid = uuid.uuid1().hex
+                if tpriority is None:
+                    tpriority = 0
+                yield (cmd, str(tid), tpriority, tgroup), depends_on
+
+        state = self._state_codes[TASK_STATES.QUEUED_NO_DEP]
+        action = self._action_codes[TASK_LOG_ACTIONS.ADDED]
+        rows = _rows()
+        ids = []
+        num_added = 0
+        groups = {}
+
+        if atomic and not self._lock_db(exclusive=True, msg='add multiple'):
+            raise ValueError("Could not get lock to add multiple tasks!")
 
-        states = [TASK_STATES.QUEUED_NO_DEP for cmd in cmds]
-        log_states = [TASK_LOG_ACTIONS.ADDED for cmd in cmds]
-        infos = ['' for cmd in cmds]
+        try:
+            while True:
+                chunk = list(itertools.islice(rows, chunksize))
+                if len(chunk) == 0:
+                    break
+                deps = [(row[1], depends_on) for row, depends_on in chunk if depends_on]
+                chunk = [row for row, _ in chunk]
 
-        if self._lock_db(exclusive=True, msg='add multiple'):
-            try:
-                c = self._conn.execute("SELECT TASK_ID FROM TASKS")
-                db_ids = c.fetchall()
-                curr_ids = set([tup[0] for tup in db_ids])
-                set_ids = set(id)
-                int_ids = set_ids & curr_ids
-                if len(int_ids) != 0:
+                if not atomic and not self._lock_db(exclusive=True, msg='add multiple'):
+                    raise ValueError("Could not get lock to add multiple tasks!")
+
+                atime = _now()
+                for tgroup in set(row[3] for row in chunk):
+                    if tgroup not in groups:
+                        groups[tgroup] = self._group(self._conn, tgroup)
+
+                try:
+                    # duplicate IDs are caught by the unique index on the task IDs
+                    self._conn.executemany("INSERT INTO TASKDATA(CMD, STATE, TASK_ID, PRIORITY, GRP, ADD_TIME,\n"
+                                           "SORT_KEY) VALUES (?,?,?,?,?,?,?)",
+                                           [(cmd, state, tid, tpriority, groups[tgroup][0], atime,
+                                             _sort_key(tpriority, groups[tgroup][1], atime))
+                                            for cmd, tid, tpriority, tgroup in chunk])
+                    self._conn.executemany("INSERT INTO LOGDATA (TASK, ACTION, TIME, INFO)\n"
+                                           "SELECT ID, ?, ?, '' FROM TASKDATA WHERE TASK_ID = ?",
+                                           [(action, atime, row[1]) for row in chunk])
+                except sqlite3.IntegrityError as e:
                     raise ValueError("duplicate IDs found")
 
-                self._conn.executemany("INSERT INTO TASKS(CMD, STATE, TASK_ID, PRIORITY) VALUES (?,?,?,?)",
-                                       zip(cmds, states, id, priority))
-                self._conn.executemany("INSERT INTO LOGS(ACTION, TASK_ID, INFO) VALUES (?,?,?)",
-                                       zip(log_states, id, infos))
+                # tasks can only depend on tasks added before them, so no cycles can be made
+                if len(deps) > 0:
+                    order = dict((row[1], i) for i, row in enumerate(chunk))
+                for tid, depends_on in deps:
+                    for dep_id in depends_on:
+                        if order.get(str(dep_id), -1) >= order[tid]:
+                            raise ValueError("Task %s depends on task %s, which is added after it!" % (tid, dep_id))
+                    key = self._conn.execute("SELECT ID FROM TASKDATA WHERE TASK_ID = ?", (tid,)).fetchone()[0]
+                    self._add_dependencies(self._conn, key, tid, depends_on)
+
+                if not atomic:
+                    self._unlock_db()
+
+                num_added += len(chunk)
+                if return_ids:
+                    ids.extend(row[1] for row in chunk)
+                if callback is not None:
+                    callback(num_added, [row[1] for row in chunk])
+
+            if atomic:
                 self._unlock_db()
-            except Exception as e:
+        except Exception as e:
+            if self._conn.in_transaction:
                 self._rollback_db()
+            if atomic or num_added == 0:
                 raise ValueError("Could not add multiple tasks! - %s" % e)
+            else:
+                raise ValueError("Could not add multiple tasks! - %s - %d tasks were added" % (e, num_added))
 
+        if return_ids:
+            return ids
         else:
-            raise ValueError("Could not get lock to add multiple tasks!")
-
-        return id
+            return num_added
 
     def update(self, id, task=None, priority=None, state=None):
         """update a task with id"""
@@ -329,23 +1255,31 @@ class SQLiteTaskDB(BaseTaskDB):
                 info = ''
 
                 if priority is not None:
-                    c = self._conn.execute("SELECT PRIORITY FROM TASKS WHERE TASK_ID = '%s'" % (id))
+                    c = self._conn.execute("SELECT PRIORITY FROM TASKDATA WHERE TASK_ID = ?", (id,))
                     old_priority = c.fetchall()[0][0]
-                    self._conn.execute("UPDATE TASKS SET PRIORITY = %d WHERE TASK_ID = '%s'" % (priority, id))
+                    # the time the task has waited still counts with its new priority
+                    self._conn.execute("UPDATE TASKDATA SET PRIORITY = ?, SORT_KEY = SORT_KEY + ? - PRIORITY\n"
+                                       "WHERE TASK_ID = ?", (priority, priority, id))
                     info += 'set PRIORITY to %d from %d; ' % (priority, old_priority)
 
                 if state is not None:
-                    c = self._conn.execute("SELECT STATE FROM TASKS WHERE TASK_ID = '%s'" % (id))
-                    old_state = c.fetchall()[0][0]
-                    self._conn.execute("UPDATE TASKS SET STATE = '%s' WHERE TASK_ID = '%s'" % (state, id))
+                    c = self._conn.execute("SELECT ID, STATE FROM TASKDATA WHERE TASK_ID = ?", (id,))
+                    key, old_state = c.fetchall()[0]
+                    old_state = self._state_names[old_state]
+                    self._update_task_state(self._conn, id, state)
+                    self._update_dependents(self._conn, key, old_state, state)
                     info += 'set STATE to %s from %s; ' % (state, old_state)
 
                 if task is not None:
-                    c = self._conn.execute("SELECT CMD FROM TASKS WHERE TASK_ID = '%s'" % (id))
+                    c = self._conn.execute("SELECT CMD FROM TASKDATA WHERE TASK_ID = ?", (id,))
                     old_cmd = c.fetchall()[0][0]
-                    self._conn.execute("UPDATE TASKS SET CMD = '%s' WHERE TASK_ID = '%s'" % (task, id))
+                    self._conn.execute("UPDATE TASKDATA SET CMD = ? WHERE TASK_ID = ?", (task, id))
                     info += 'set CMD to "%s" from "%s"; ' % (task, old_cmd)
 
+                # any run time measured so far no longer applies to the task
+                self._conn.execute("UPDATE TASKDATA SET START_TIME = NULL, END_TIME = NULL, RUNTIME = NULL\n"
+                                   "WHERE TASK_ID = ?", (id,))
+
                 self._write_log(c, id, TASK_LOG_ACTIONS.UPDATED, info=info)
                 self._unlock_db()
             except Exception as e:
@@ -362,11 +1296,17 @@ class SQLiteTaskDB(BaseTaskDB):
 
         if self._lock_db(exclusive=True, msg='delete'):
             try:
+                key, old_state = self._conn.execute("SELECT ID, STATE FROM TASKDATA WHERE TASK_ID = ?",
+                                                    (id,)).fetchone()
+                self._update_dependents(self._conn, key, self._state_names[old_state], state)
                 if remove:
-                    self._conn.execute("DELETE FROM TASKS WHERE TASK_ID = '%s'" % id)
+                    self._write_log(self._conn, id, log_state)
+                    self._conn.execute("INSERT INTO REMOVED_TASKS (ID, TASK_ID) VALUES (?, ?)", (key, id))
+                    self._conn.execute("DELETE FROM DEPENDENCIES WHERE TASK = ? OR DEPENDS_ON = ?", (key, key))
+                    self._conn.execute("DELETE FROM TASKDATA WHERE ID = ?", (key,))
                 else:
                     self._update_task_state(self._conn, id, state)
-                self._write_log(self._conn, id, log_state)
+                    self._write_log(self._conn, id, log_state)
                 self._unlock_db()
             except Exception as e:
                 self._rollback_db()
@@ -382,23 +1322,26 @@ class SQLiteTaskDB(BaseTaskDB):
 
         if self._lock_db(exclusive=True, msg='reset'):
             try:
-                cids = self._conn.cursor()
-                cids.execute("SELECT TASK_ID FROM TASKS WHERE STATE != '%s'" % TASK_STATES.DELETED)
-
-                c = self._conn.cursor()
-                while True:
-                    ids = cids.fetchmany(size=c.arraysize)
-
-                    if len(ids) == 0:
-                        break
-
-                    for id in ids:
-                        self._write_log(c, id[0], log_state)
-
-                self._conn.execute("UPDATE TASKS SET STATE = '%s' WHERE STATE != '%s'" % (state, TASK_STATES.DELETED))
-
-                self._conn.execute("DELETE FROM CLIENTS WHERE CLIENT_ID != '%s'" % self._client_id)
-                self._conn.execute("UPDATE INFO SET STATE = '%s'" % TASKDB_STATES.PAUSED)
+                self._conn.execute("INSERT INTO LOGDATA (TASK, ACTION, TIME, INFO)\n"
+                                   "SELECT ID, ?, ?, '' FROM TASKDATA WHERE STATE != ? ORDER BY ID",
+                                   (self._action_codes[log_state], _now(), self._state_codes[TASK_STATES.DELETED]))
+
+                self._conn.execute("UPDATE TASKDATA SET STATE = ?, START_TIME = NULL, END_TIME = NULL,\n"
+                                   "RUNTIME = NULL, NUM_ATTEMPTS = 0, LEASE_EXPIRY = NULL, CLIENT = NULL\n"
+                                   "WHERE STATE != ?",
+                                   (self._state_codes[state], self._state_codes[TASK_STATES.DELETED]))
+
+                # every task is queued again, so only dependencies on archived and deleted tasks are still done
+                self._conn.execute("UPDATE TASKDATA SET NUM_DEPS_LEFT = (\n"
+                                   "SELECT COUNT(*) FROM DEPENDENCIES AS d JOIN TASKDATA AS t ON t.ID = d.DEPENDS_ON\n"
+                                   "WHERE d.TASK = TASKDATA.ID AND t.STATE != ?)\n"
+                                   "WHERE ID IN (SELECT TASK FROM DEPENDENCIES)",
+                                   (self._state_codes[TASK_STATES.DELETED],))
+                self._conn.execute("UPDATE TASKDATA SET STATE = ? WHERE STATE = ? AND NUM_DEPS_LEFT > 0",
+                                   (self._state_codes[TASK_STATES.QUEUED_WITH_DEP], self._state_codes[state]))
+
+                self._conn.execute("DELETE FROM CLIENTS WHERE CLIENT_ID != ?", (self._client_id,))
+                self._conn.execute("UPDATE INFO SET STATE = ?", (TASKDB_STATES.PAUSED,))
 
                 self._unlock_db()
             except Exception as e:
@@ -407,44 +1350,26 @@ class SQLiteTaskDB(BaseTaskDB):
         else:
             raise ValueError("Could not get lock to reset task DB!")
 
-    def _extract_runtime_task(self, logs):
-        succ_tup = None
-        ran_tup = None
-        for i in range(len(logs) - 1, 0, -1):
-            if logs[i][2] == TASK_LOG_ACTIONS.SUCCEEDED and succ_tup is None:
-                succ_tup = logs[i]
-
-            if logs[i][2] == TASK_LOG_ACTIONS.RAN and ran_tup is None:
-                ran_tup = logs[i]
-
-            if succ_tup is not None and ran_tup is not None:
-                break
-
-        return diff_timestamps(ran_tup[3], succ_tup[3])
-
-    def list(self, state=None, with_runtime=False):
-        """list all tasks in the db"""
-
+    def _list_tasks(self, state=None):
+        """get the (task_id, state, cmd, priority, runtime) of the tasks, highest priority first"""
         if state is None:
-            c = self._conn.execute('SELECT TASK_ID, STATE, CMD, PRIORITY FROM TASKS ORDER BY PRIORITY DESC')
+            c = self._conn.execute('SELECT TASK_ID, STATE, CMD, PRIORITY, RUNTIME FROM TASKDATA '
+                                   'ORDER BY PRIORITY DESC')
         else:
             if state not in LIST_OF_TASK_STATES:
                 raise ValueError("State '%s' not a valid task state!" % state)
-            c = self._conn.execute("SELECT TASK_ID, STATE, CMD, PRIORITY "
-                                   "FROM TASKS WHERE STATE = '%s' ORDER BY PRIORITY DESC" % state)
-
-        tasks = c.fetchall()
-        for id, state, cmd, priority in tasks:
-            print("task %s:\n    cmd: '%s'\n    state: %s\n    priority: %d" % (id, cmd, state, priority))
+            c = self._conn.execute("SELECT TASK_ID, STATE, CMD, PRIORITY, RUNTIME "
+                                   "FROM TASKDATA WHERE STATE = ? ORDER BY PRIORITY DESC",
+                                   (self._state_codes.get(state),))
 
-            if state == TASK_STATES.SUCCEEDED and with_runtime:
-                c = self._conn.execute("SELECT LOG_ID, TASK_ID, ACTION, TIME, INFO "
-                                       "FROM LOGS WHERE TASK_ID = '%s' ORDER BY LOG_ID ASC" % id)
-                logs = c.fetchall()
-                rtime = self._extract_runtime_task(logs)
-                print("    run time: %gs" % rtime)
+        for id, state, cmd, priority, rtime in c:
+            if rtime is not None:
+                rtime /= 1000.0
+            yield id, self._state_names[state], cmd, priority, rtime
 
-        sys.stdout.flush()
+    def list(self, state=None, with_runtime=False):
+        """list all tasks in the db"""
+        print_tasks(self._list_tasks(state=state), with_runtime=with_runtime)
 
     def log(self, task_id):
         """get log for task id"""
@@ -452,20 +1377,34 @@ class SQLiteTaskDB(BaseTaskDB):
             task_id = str(task_id)
 
         c = self._conn.cursor()
-        c.execute("SELECT LOG_ID, TASK_ID, ACTION, TIME, INFO "
-                  "FROM LOGS WHERE TASK_ID = '%s' ORDER BY LOG_ID ASC" % task_id)
-        logs = c.fetchall()
-        c.execute("SELECT TASK_ID, CMD, STATE, PRIORITY FROM TASKS WHERE TASK_ID = '%s'" % task_id)
-        id, cmd, state, priority = c.fetchall()[0]
-        print("task %s:\n    cmd: '%s'\n    state: %s\n    priority: %d" % (id, cmd, state, priority))
-
-        if state == TASK_STATES.SUCCEEDED:
-            rtime = self._extract_runtime_task(logs)
+        c.execute("SELECT ID, TASK_ID, CMD, STATE, PRIORITY, NUM_ATTEMPTS, RUNTIME FROM TASKDATA WHERE TASK_ID = ?",
+                  (task_id,))
+        tasks = c.fetchall()
+        if len(tasks) > 0:
+            key, id, cmd, state, priority, num_attempts, rtime = tasks[0]
+            logs = self._read_logs(c, key)
+        else:
+            c.execute("SELECT TASK_ID, CMD, STATE, PRIORITY, NUM_ATTEMPTS, RUNTIME, LOGS FROM ARCHIVEDATA "
+                      "WHERE TASK_ID = ?", (task_id,))
+            tasks = c.fetchall()
+            if len(tasks) == 0:
+                raise ValueError("Task %s is not in the DB!" % task_id)
+            id, cmd, state, priority, num_attempts, rtime, logs = tasks[0]
+            logs = self._decode_logs(logs)
+
+        state = self._state_names[state]
+        if rtime is not None:
+            rtime /= 1000.0
+
+        print("task %s:\n    cmd: '%s'\n    state: %s\n    priority: %d\n    attempts: %d"
+              % (id, cmd, state, priority, num_attempts))
+
+        if state == TASK_STATES.SUCCEEDED and rtime is not None:
             print("    run time: %gs" % rtime)
 
         print("    log:")
 
-        for logid, taskid, action, t, info in logs:
+        for action, t, info in logs:
             tstr = t
             if len(info) > 0:
                 print("        %s - %s - '%s'" % (tstr, action, info))
@@ -474,13 +1413,21 @@ class SQLiteTaskDB(BaseTaskDB):
 
         sys.stdout.flush()
 
-    def query(self, cmd):
-        """run the query cmd on the database"""
+    def query(self, cmd, params=(), read_only=False):
+        """run the query cmd on the database, with params bound to any placeholders in it
+
+        If read_only is True, cmd can only read tables (no writes, ATTACH or PRAGMA)."""
         res = None
-        if self._lock_db(exclusive=True, msg='query'):
+        if self._lock_db(exclusive=not (self._read_only or read_only), msg='query'):
             try:
-                c = self._conn.execute(cmd)
-                res = c.fetchall()
+                if read_only:
+                    self._conn.set_authorizer(_read_only_authorizer)
+                try:
+                    c = self._conn.execute(cmd, params)
+                    res = c.fetchall()
+                finally:
+                    if read_only:
+                        self._conn.set_authorizer(None)
                 self._unlock_db()
             except Exception as e:
                 self._rollback_db()
@@ -490,49 +1437,47 @@ class SQLiteTaskDB(BaseTaskDB):
 
         return res
 
-    def status(self):
-        """print staus of DB"""
-        maxlen = None
-        for state in LIST_OF_TASK_STATES:
-            slen = len("    %s: " % state)
-            if maxlen is None or slen > maxlen:
-                maxlen = slen
+    def _read_logs(self, c, key):
+        """get the (action, time, info) logs of the task with key"""
+        c.execute("SELECT ACTION, TIME, INFO FROM LOGDATA WHERE TASK = ? ORDER BY LOG_ID ASC", (key,))
+        return [(self._action_names[action], _format_time(t), info) for action, t, info in c.fetchall()]
 
-        def _pad_str(sstr):
-            if len(sstr) < maxlen:
-                sstr += " " * (maxlen - len(sstr))
-            return sstr
+    def _state_counts(self, c):
+        c.execute("SELECT STATE, NUM FROM STATE_COUNTS")
+        return dict((self._state_names[state], num) for state, num in c.fetchall() if state in self._state_names)
 
+    def status(self, as_dict=False):
+        """print staus of DB, or return it as a dict if as_dict is True"""
         c = self._conn.cursor()
 
         c.execute("SELECT STATE FROM INFO")
-        state = c.fetchone()[0]
-        print("%s:" % (self._conf['name']))
-        sstr = _pad_str("    state: ")
-        print("%s%s" % (sstr, state))
+        db_state = c.fetchone()[0]
 
         c.execute("SELECT COUNT(*) FROM CLIENTS")
         num_clients = c.fetchone()[0]
-        sstr = _pad_str("    # of clients: ")
-        print("%s%d" % (sstr, num_clients))
 
-        c.execute("SELECT COUNT(*) FROM TASKS WHERE STATE != '%s'" % TASK_STATES.DELETED)
-        num = c.fetchone()[0]
-        sstr = _pad_str("    # of tasks: ")
-        print("%s%d" % (sstr, num))
+        counts = self._state_counts(c)
+        counts = dict((state, counts.get(state, 0)) for state in LIST_OF_TASK_STATES)
 
-        for state in LIST_OF_TASK_STATES:
-            c.execute("SELECT COUNT(*) FROM TASKS WHERE STATE = '%s'" % state)
-            num = c.fetchone()[0]
-            sstr = _pad_str("    %s: " % state)
-            print("%s%d" % (sstr, num))
+        c.execute("SELECT COUNT(*) FROM ARCHIVEDATA")
+        num_archived = c.fetchone()[0]
 
-        sys.stdout.flush()
+        stat = {'name': self._conf['name'],
+                'state': db_state,
+                'clients': num_clients,
+                'tasks': sum(counts.values()) - counts[TASK_STATES.DELETED],
+                'archived': num_archived,
+                'states': counts}
+
+        if as_dict:
+            return stat
+
+        print_status(stat)
 
     def _set_db_state(self, state):
         if self._lock_db(exclusive=True, msg='set DB state'):
             try:
-                self._conn.execute("UPDATE INFO SET STATE = '%s'" % state)
+                self._conn.execute("UPDATE INFO SET STATE = ?", (state,))
                 self._unlock_db()
             except Exception as e:
                 self._rollback_db()
@@ -556,27 +1501,41 @@ class SQLiteTaskDB(BaseTaskDB):
         """set DB state to running"""
         self._set_db_state(TASKDB_STATES.RUNNING)
 
-    def cleanup(self):
-        """cleanup the taskdb"""
-        if self._lock_db(exclusive=True, msg='cleanup'):
-            try:
-                cids = self._conn.cursor()
-                cids.execute("SELECT TASK_ID FROM TASKS WHERE STATE = '%s'" % TASK_STATES.RUNNING)
+    def cleanup(self, expired_only=False):
+        """cleanup the taskdb
 
-                c = self._conn.cursor()
-                while True:
-                    ids = cids.fetchmany(size=c.arraysize)
+        If expired_only is True, only the tasks whose leases have expired are marked
+        KILLED and only clients without a recent heartbeat are dropped, so that the DB
+        can be cleaned up while other workers are running. Returns the number of tasks
+        marked KILLED in that case."""
+        if expired_only:
+            if self._conf['lease_time'] is None:
+                raise ValueError("Leases are turned off for the task DB, so none can expire!")
 
-                    if len(ids) == 0:
-                        break
+            if self._lock_db(exclusive=True, msg='cleanup expired'):
+                try:
+                    num_reclaimed = self._reclaim_expired(self._conn, _now())
+                    self._unlock_db()
+                except Exception as e:
+                    self._rollback_db()
+                    raise ValueError("Could not cleanup the expired tasks of the task DB!")
+            else:
+                raise ValueError("Could not lock DB to cleanup the expired tasks of the task DB!")
 
-                    for id in ids:
-                        self._write_log(c, id[0], TASK_LOG_ACTIONS.CLEANED)
+            return num_reclaimed
 
-                c.execute("UPDATE INFO SET STATE = '%s'" % TASKDB_STATES.PAUSED)
-                c.execute("DELETE FROM CLIENTS WHERE CLIENT_ID != '%s'" % self._client_id)
-                c.execute("UPDATE TASKS SET STATE = '%s' WHERE STATE = '%s'" % (
-                    TASK_STATES.KILLED, TASK_STATES.RUNNING))
+        if self._lock_db(exclusive=True, msg='cleanup'):
+            try:
+                c = self._conn.cursor()
+                c.execute("INSERT INTO LOGDATA (TASK, ACTION, TIME, INFO)\n"
+                          "SELECT ID, ?, ?, '' FROM TASKDATA WHERE STATE = ? ORDER BY ID",
+                          (self._action_codes[TASK_LOG_ACTIONS.CLEANED], _now(),
+                           self._state_codes[TASK_STATES.RUNNING]))
+
+                c.execute("UPDATE INFO SET STATE = ?", (TASKDB_STATES.PAUSED,))
+                c.execute("DELETE FROM CLIENTS WHERE CLIENT_ID != ?", (self._client_id,))
+                c.execute("UPDATE TASKDATA SET STATE = ?, LEASE_EXPIRY = NULL, CLIENT = NULL WHERE STATE = ?",
+                          (self._state_codes[TASK_STATES.KILLED], self._state_codes[TASK_STATES.RUNNING]))
 
                 self._unlock_db()
             except Exception as e:
@@ -585,82 +1544,112 @@ class SQLiteTaskDB(BaseTaskDB):
         else:
             raise ValueError("Could not lock DB to cleanup the task DB!")
 
-    def runtime(self):
-        """get runtime stats for DB"""
-        from itertools import groupby
-
-        c = self._conn.cursor()
-        c.execute("""\
-SELECT tl.task_id, tl.log_id, tl.action, tl.time
-FROM LOGS as tl, TASKS as t
-WHERE t.task_id = tl.task_id and t.state = 'SUCCEEDED'
-ORDER BY tl.task_id, tl.log_id DESC""")
-        all_logs = c.fetchall()
-
-        num_tasks = 0
-        max_task = None
-        max_time = None
-        min_time = None
-        min_task = None
-        tot_time = 0.0
-
-        for id, ilogs in groupby(all_logs, lambda x: x[0]):
-            logs = list(ilogs)
+    def _encode_logs(self, logs, compress):
+        # the logs keep the names of the actions and formatted times so that they
+        # can be read without the rest of the DB
+        logs = json.dumps(logs).encode('utf-8')
+        if compress:
+            logs = zlib.compress(logs)
+        return logs
+
+    def _decode_logs(self, logs):
+        logs = bytes(logs)
+        if logs[:1] != b'[':
+            logs = zlib.decompress(logs)
+        return json.loads(logs.decode('utf-8'))
+
+    def archive(self, compress=True, chunksize=1000):
+        """move finished tasks and their logs into the archive, returning the number of tasks moved
+
+        The tasks and logs are written to the ARCHIVEDATA table with the logs of each
+        task stored as JSON, compressed with zlib if compress is True. Tasks in the
+        archive can still be read with log and runtime."""
+
+        num_archived = 0
+        states = ', '.join('?' for state in ARCHIVE_TASK_STATES)
+        if self._lock_db(exclusive=True, msg='archive'):
+            try:
+                atime = _now()
+                c = self._conn.cursor()
+                while True:
+                    c.execute("SELECT ID, TASK_ID, CMD, STATE, PRIORITY, START_TIME, END_TIME, NUM_ATTEMPTS,\n"
+                              "RUNTIME FROM TASKDATA WHERE STATE IN (%s) LIMIT ?" % states,
+                              tuple(self._state_codes[state] for state in ARCHIVE_TASK_STATES) + (chunksize,))
+                    tasks = c.fetchall()
+                    if len(tasks) == 0:
+                        break
 
-            stime = None
-            slog_id = None
-            etime = None
-            elog_id = None
-            rlog_id = None
-            for _, log_id, state, _time in logs:
-                if state == TASK_LOG_ACTIONS.SUCCEEDED:
-                    etime = _time
-                    elog_id = log_id
-                elif state == TASK_LOG_ACTIONS.RAN:
-                    stime = _time
-                    slog_id = log_id
-                elif state == TASK_LOG_ACTIONS.DELETED or \
-                        state == TASK_LOG_ACTIONS.RESET or \
-                        state == TASK_LOG_ACTIONS.KILLED or \
-                        state == TASK_LOG_ACTIONS.UPDATED or \
-                        state == TASK_LOG_ACTIONS.ADDED:
-                    rlog_id = log_id
-                    break
+                    rows = []
+                    for task in tasks:
+                        logs = [list(log) for log in self._read_logs(c, task[0])]
+                        rows.append(task[1:] + (atime, self._encode_logs(logs, compress)))
+
+                    c.executemany("INSERT OR REPLACE INTO ARCHIVEDATA (TASK_ID, CMD, STATE, PRIORITY, START_TIME,\n"
+                                  "END_TIME, NUM_ATTEMPTS, RUNTIME, ARCHIVE_TIME, LOGS)\n"
+                                  "VALUES (?,?,?,?,?,?,?,?,?,?)", rows)
+                    c.executemany("DELETE FROM LOGDATA WHERE TASK = ?", [(task[0],) for task in tasks])
+                    # archived tasks are done for good, so they are dropped from the dependencies
+                    c.executemany("DELETE FROM DEPENDENCIES WHERE TASK = ?", [(task[0],) for task in tasks])
+                    c.executemany("DELETE FROM DEPENDENCIES WHERE DEPENDS_ON = ?", [(task[0],) for task in tasks])
+                    c.executemany("DELETE FROM TASKDATA WHERE ID = ?", [(task[0],) for task in tasks])
+                    num_archived += len(tasks)
+
+                # only DBs made with auto_vacuum on can give the freed pages back without a full VACUUM
+                if c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                    c.execute("PRAGMA incremental_vacuum").fetchall()
 
-            if slog_id > rlog_id and elog_id > rlog_id:
-                tdiff = diff_timestamps(stime, etime)
+                self._unlock_db()
+            except Exception as e:
+                self._rollback_db()
+                raise ValueError("Could not archive the task DB! - %s" % e)
+        else:
+            raise ValueError("Could not lock DB to archive the task DB!")
 
-                if max_time is None or tdiff > max_time:
-                    max_time = tdiff
-                    max_task = id
+        return num_archived
 
-                if min_time is None or tdiff < min_time:
-                    min_time = tdiff
-                    min_task = id
+    def runtime(self, as_dict=False):
+        """get runtime stats for DB"""
 
-                num_tasks += 1
-                tot_time += tdiff
+        # the timing columns are kept up to date on checkout and checkin, so the stats come
+        # from one pass over the partial index of the succeeded runtimes of each table, while
+        # sqlite finds the MIN and MAX, along with the rest of their row, at the ends of it
+        c = self._conn.cursor()
+        num_tasks, tot_time = 0, 0
+        min_task, min_time = 'N/A', None
+        max_task, max_time = 'N/A', None
+        for table in ['TASKDATA', 'ARCHIVEDATA']:
+            tasks = "FROM %s INDEXED BY %s_RUNTIME WHERE STATE = %d AND RUNTIME IS NOT NULL" \
+                % (table, table, self._state_codes[TASK_STATES.SUCCEEDED])
+            num, tot = c.execute("SELECT COUNT(*), TOTAL(RUNTIME) " + tasks).fetchone()
+            num_tasks += num
+            tot_time += tot
+
+            task_id, rtime = c.execute("SELECT TASK_ID, MIN(RUNTIME) " + tasks).fetchone()
+            if rtime is not None and (min_time is None or rtime < min_time):
+                min_task, min_time = task_id, rtime
+            task_id, rtime = c.execute("SELECT TASK_ID, MAX(RUNTIME) " + tasks).fetchone()
+            if rtime is not None and (max_time is None or rtime > max_time):
+                max_task, max_time = task_id, rtime
+
+        tot_time = tot_time / 1000.0
+        min_time = min_time / 1000.0 if min_time is not None else 0.0
+        max_time = max_time / 1000.0 if max_time is not None else 0.0
 
         if num_tasks > 0:
             avg_time = tot_time / num_tasks
         else:
             avg_time = 0.0
 
-        if max_task is None:
-            max_task = 'N/A'
-            max_time = 0.0
-
-        if min_task is None:
-            min_task = 'N/A'
-            min_time = 0.0
+        stats = {'name': self._conf['name'],
+                 'total': tot_time,
+                 'tasks': num_tasks,
+                 'avg': avg_time,
+                 'min': min_time,
+                 'min_task': min_task,
+                 'max': max_time,
+                 'max_task': max_task}
 
-        print("%s:" % (self._conf['name']))
-        print("""\
-    total time:           %gs
-    # of tasks SUCCEEDED: %d
-    avg time per task:    %gs
-    min time of tasks:    %gs (task %s)
-    max time of tasks:    %gs (task %s)""" % (
-            tot_time, num_tasks, avg_time, min_time, min_task, max_time, max_task))
+        if as_dict:
+            return stats
 
-        sys.stdout.flush()
+        print_runtime(stats)
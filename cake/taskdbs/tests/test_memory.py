@@ -0,0 +1,212 @@
+import os
+import unittest
+import random
+import time
+
+from .. import MemoryTaskDB, SQLiteTaskDB
+from ...defaults import TASK_STATES, TASK_LOG_ACTIONS, TASKDB_STATES
+
+NAMES = ['test_memory.db', 'test_memory.db-wal', 'test_memory.db-shm', 'test_memory.db.journal']
+
+
+class TestMemoryTaskDB(unittest.TestCase):
+    def setUp(self):
+        for name in NAMES:
+            try:
+                os.remove(name)
+            except Exception as e:
+                pass
+
+        # snapshots are only taken by hand so that the tests see what the journal holds
+        self._conf = {'name': 'test_memory.db', 'timeout': 120.0, 'snapshot_interval': 1e6}
+        self._db = MemoryTaskDB(**self._conf)
+
+    def tearDown(self):
+        if self._db is not None:
+            self._db.close()
+        for name in NAMES:
+            try:
+                os.remove(name)
+            except Exception as e:
+                pass
+
+    def _crash(self):
+        """drop the DB without writing it back, as if the process had died"""
+        self._db._journal.close()
+        self._db._sqlite._conn.close()
+        self._db = None
+
+    def test_checkout_order(self):
+        priors = [random.uniform(0, 1) for i in range(20)]
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(20)], priority=priors, chunksize=7)
+        order = [ids[i] for i in sorted(range(20), key=lambda i: -priors[i])]
+
+        tasks = self._db.checkout_many(5)
+        tasks += [self._db.checkout() for i in range(15)]
+        self.assertTrue([id for _, id in tasks] == order)
+        self.assertTrue(self._db.checkout() == (None, None))
+
+        self._db.checkin_many([(id, TASK_STATES.FAILED, '1') for id in order[:10]])
+        for id in order[10:]:
+            self._db.checkin(id, TASK_STATES.SUCCEEDED)
+        self.assertTrue(self._db.checkout() == (None, None))
+        self.assertTrue(self._db.checkout(state=TASK_STATES.FAILED)[1] == order[0])
+
+        try:
+            self._db.add('echo "dup"', id=ids[0])
+            failed = False
+        except ValueError as e:
+            failed = True
+        self.assertTrue(failed)
+
+    def test_snapshot(self):
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(4)], priority=[3, 2, 1, 0])
+        task, id = self._db.checkout()
+        self._db.checkin(id, TASK_STATES.SUCCEEDED)
+        self._db.checkout()
+        self._db.update(ids[2], priority=10)
+        self._db.delete(ids[3])
+
+        # nothing reaches the DB file until the snapshot
+        with SQLiteTaskDB(name='test_memory.db', intent='read') as db:
+            self.assertTrue(db.status(as_dict=True)['tasks'] == 0)
+
+        self._db.snapshot()
+        with open('test_memory.db.journal', 'r') as fp:
+            self.assertTrue(len(fp.readlines()) == 1)
+        with SQLiteTaskDB(name='test_memory.db', intent='read') as db:
+            states = dict(db.query("select task_id, state from tasks"))
+            self.assertTrue(states == {ids[0]: TASK_STATES.SUCCEEDED, ids[1]: TASK_STATES.RUNNING,
+                                       ids[2]: TASK_STATES.QUEUED_NO_DEP, ids[3]: TASK_STATES.DELETED})
+            self.assertTrue(db.query("select priority from tasks where task_id = ?", (ids[2],))[0][0] == 10)
+            res = db.query("select action from logs where task_id = ? order by log_id", (ids[0],))
+            self.assertTrue([r[0] for r in res] == [TASK_LOG_ACTIONS.ADDED, TASK_LOG_ACTIONS.RAN,
+                                                    TASK_LOG_ACTIONS.SUCCEEDED])
+            self.assertTrue(db.runtime(as_dict=True)['tasks'] == 1)
+
+        # the running task is picked up by the next checkout once it is checked in
+        self._db.checkin(ids[1], TASK_STATES.KILLED)
+        self.assertTrue(self._db.checkout()[1] == ids[2])
+        self.assertTrue(self._db.checkout()[1] == ids[1])
+
+    def test_replay(self):
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(6)], priority=list(range(6)))
+        self._db.snapshot()
+        tasks = self._db.checkout_many(3)
+        self._db.checkin(tasks[0][1], TASK_STATES.SUCCEEDED)
+        self._db.checkin(tasks[1][1], TASK_STATES.FAILED)
+        new_id = self._db.add('echo "new"', depends_on=[ids[0]])
+        self._crash()
+
+        # a second DB cannot load the file while another has it
+        self._db = MemoryTaskDB(**self._conf)
+        try:
+            MemoryTaskDB(**self._conf)
+            failed = False
+        except ValueError as e:
+            failed = True
+        self.assertTrue(failed)
+
+        states = dict(self._db.query("select task_id, state from tasks"))
+        self.assertTrue(states[tasks[0][1]] == TASK_STATES.SUCCEEDED)
+        self.assertTrue(states[tasks[1][1]] == TASK_STATES.FAILED)
+        self.assertTrue(states[tasks[2][1]] == TASK_STATES.KILLED)
+        self.assertTrue(states[new_id] == TASK_STATES.QUEUED_WITH_DEP)
+        res = self._db.query("select action from logs where task_id = ? order by log_id", (tasks[2][1],))
+        self.assertTrue(res[-1][0] == TASK_LOG_ACTIONS.EXPIRED)
+
+        stat = self._db.status(as_dict=True)
+        self.assertTrue(stat['tasks'] == 7)
+        self.assertTrue(stat['clients'] == 1)
+
+    def test_leases(self):
+        self._db.close()
+        self._conf.update({'lease_time': 1.0, 'heartbeat_interval': 0.2})
+        self._db = MemoryTaskDB(**self._conf)
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(2)])
+        tasks = self._db.checkout_many(2)
+        self._db.snapshot()
+
+        # the leases of the running tasks are renewed without any snapshots or checkouts
+        time.sleep(2.0)
+        conf = dict(self._conf, intent='examine')
+        with SQLiteTaskDB(**conf) as db:
+            self.assertTrue(db.cleanup(expired_only=True) == 0)
+            self.assertTrue(db.status(as_dict=True)['clients'] == 2)
+        self.assertTrue(sorted(id for _, id in tasks) == sorted(ids))
+
+    def test_dependencies(self):
+        a = self._db.add('echo "a"')
+        b = self._db.add('echo "b"', depends_on=[a], priority=5)
+        c = self._db.add_multiple([{'cmd': 'echo "c"', 'depends_on': [a, b], 'priority': 10}])[0]
+
+        self.assertTrue(self._db.checkout()[1] == a)
+        self.assertTrue(self._db.checkout() == (None, None))
+        self._db.checkin(a, TASK_STATES.SUCCEEDED)
+        self.assertTrue(self._db.checkout()[1] == b)
+        self._db.checkin(b, TASK_STATES.SUCCEEDED)
+        self.assertTrue(self._db.checkout()[1] == c)
+
+        # the dependencies are written back and read in again
+        self._db.reset()
+        self.assertTrue(self._db.status(as_dict=True)['states'][TASK_STATES.QUEUED_WITH_DEP] == 2)
+        self._db.run()
+        self.assertTrue(self._db.state() == TASKDB_STATES.RUNNING)
+        self.assertTrue([self._db.checkout()[1] for i in range(2)] == [a, None])
+
+        try:
+            self._db.add('echo "d"', depends_on=['nope'])
+            failed = False
+        except ValueError as e:
+            failed = True
+        self.assertTrue(failed)
+
+    def test_delete_dependencies(self):
+        # deleting a task deletes the tasks waiting on it, a -> b -> c
+        a = self._db.add('echo "a"')
+        b = self._db.add('echo "b"', depends_on=[a])
+        c = self._db.add('echo "c"', depends_on=[b])
+        self._db.delete(a)
+        self.assertTrue(self._db.status(as_dict=True)['states'][TASK_STATES.DELETED] == 3)
+        res = self._db.query("select info from logs where task_id = ? and action = ?", (c, TASK_LOG_ACTIONS.DELETED))
+        self.assertTrue(res == [('depends on deleted task %s' % b,)])
+
+        # a task that SUCCEEDED still counts as done once deleted, also after a reset
+        d = self._db.add('echo "d"')
+        e = self._db.add('echo "e"', depends_on=[d])
+        self.assertTrue(self._db.checkout()[1] == d)
+        self._db.checkin(d, TASK_STATES.SUCCEEDED)
+        self._db.delete(d)
+        self._db.reset()
+        self._db.run()
+        self.assertTrue([self._db.checkout()[1] for i in range(2)] == [e, None])
+
+    def test_checkin_unknown(self):
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(2)])
+        self._db.checkout_many(2)
+
+        # a batch with an unknown task changes nothing
+        with self.assertRaises(ValueError):
+            self._db.checkin_many([(ids[0], TASK_STATES.SUCCEEDED, ''), ('nope', TASK_STATES.FAILED, '')])
+        self.assertTrue(self._db._tasks[ids[0]].state == TASK_STATES.RUNNING)
+        self.assertTrue(self._db.status(as_dict=True)['states'][TASK_STATES.RUNNING] == 2)
+
+        self._db.checkin_many([(id, TASK_STATES.SUCCEEDED, '') for id in ids])
+        self.assertTrue(self._db.status(as_dict=True)['states'][TASK_STATES.SUCCEEDED] == 2)
+
+    def test_archived_dependencies(self):
+        a = self._db.add('echo "a"')
+        x = self._db.add('echo "x"')
+        self.assertTrue(self._db.checkout()[1] == a)
+        self._db.checkin(a, TASK_STATES.SUCCEEDED)
+        self._db.delete(x)
+        self.assertTrue(self._db.archive() == 2)
+
+        # an archived task that SUCCEEDED counts as done, as in SQLiteTaskDB
+        b = self._db.add('echo "b"', depends_on=[a])
+        self.assertTrue(self._db.checkout()[1] == b)
+
+        with self.assertRaises(ValueError):
+            self._db.add('echo "c"', depends_on=[x])
+        with self.assertRaises(ValueError):
+            self._db.add('echo "c"', depends_on=['nope'])
@@ -0,0 +1,153 @@
+import os
+import time
+import socket
+import struct
+import unittest
+import threading
+
+from .. import RemoteTaskDB, SQLiteTaskDB
+from ..remote import parse_address, recv_msg
+from ...broker import TaskBroker
+from ...defaults import TASK_STATES, TASK_LOG_ACTIONS
+
+NAMES = ['test_remote.db', 'test_remote.db-wal', 'test_remote.db-shm']
+
+
+class TestRemoteTaskDB(unittest.TestCase):
+    def setUp(self):
+        for name in NAMES:
+            try:
+                os.remove(name)
+            except Exception as e:
+                pass
+
+        # sqlite connections belong to the thread that made them, so the broker makes the DB itself
+        started = threading.Event()
+
+        def _serve():
+            with SQLiteTaskDB(name='test_remote.db', timeout=120.0) as taskdb:
+                self._broker = TaskBroker(taskdb, '127.0.0.1:0', authkey='secret')
+                started.set()
+                self._broker.serve()
+
+        self._thread = threading.Thread(target=_serve)
+        self._thread.start()
+        started.wait()
+        self._conf = {'address': self._broker.address, 'authkey': 'secret', 'timeout': 10.0}
+        self._db = RemoteTaskDB(**self._conf)
+
+    def tearDown(self):
+        self._db.close()
+        self._broker.stop()
+        self._thread.join()
+        for name in NAMES:
+            try:
+                os.remove(name)
+            except Exception as e:
+                pass
+
+    def test_ops(self):
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(10)], priority=list(range(10)), chunksize=3)
+        id = self._db.add('echo "10"', priority=10)
+        self.assertTrue(self._db.status(as_dict=True)['tasks'] == 11)
+
+        tasks = self._db.checkout_many(4)
+        self.assertTrue([tid for _, tid in tasks] == [id] + ids[::-1][:3])
+        self._db.checkin_many([(tid, TASK_STATES.SUCCEEDED, '') for _, tid in tasks])
+        task, tid = self._db.checkout()
+        self.assertTrue(tid == ids[6])
+        self._db.checkin(tid, TASK_STATES.FAILED, info='1')
+
+        res = self._db.query("select action from logs where task_id = ? order by log_id", (tid,))
+        self.assertTrue([r[0] for r in res] == [TASK_LOG_ACTIONS.ADDED, TASK_LOG_ACTIONS.RAN,
+                                                TASK_LOG_ACTIONS.FAILED])
+        self.assertTrue(self._db.runtime(as_dict=True)['tasks'] == 4)
+
+        # errors on the broker are raised by the client
+        for bad in [lambda: self._db.add('echo "dup"', id=id),
+                    lambda: self._db.update('nope', priority=1),
+                    lambda: self._db.checkout(state='nope'),
+                    lambda: self._db.query("delete from tasks"),
+                    lambda: self._db.query("attach database 'test_remote_attach.db' as other"),
+                    lambda: self._db.query("select x'00'")]:
+            try:
+                bad()
+                failed = False
+            except ValueError as e:
+                failed = True
+            self.assertTrue(failed)
+
+        # queries are read-only, and a result that JSON cannot hold does not drop the connection
+        self.assertFalse(os.path.exists('test_remote_attach.db'))
+        self.assertTrue(self._db.status(as_dict=True)['tasks'] == 11)
+
+        self.assertTrue(self._db.archive(chunksize=2) == 4)
+
+    def test_many_clients(self):
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(200)])
+        done = []
+
+        def _work():
+            with RemoteTaskDB(**self._conf) as db:
+                while True:
+                    tasks = db.checkout_many(3)
+                    if len(tasks) == 0:
+                        break
+                    db.checkin_many([(tid, TASK_STATES.SUCCEEDED, '') for _, tid in tasks])
+                    done.extend(tid for _, tid in tasks)
+
+        threads = [threading.Thread(target=_work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(sorted(done) == sorted(ids))
+        self.assertTrue(self._db.status(as_dict=True)['states'][TASK_STATES.SUCCEEDED] == 200)
+
+    def test_disconnect(self):
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(4)])
+        with RemoteTaskDB(**self._conf) as db:
+            tasks = db.checkout_many(2)
+            db.checkin(tasks[0][1], TASK_STATES.SUCCEEDED)
+
+        # the task still held by the client is handed back once the broker sees it go
+        for i in range(100):
+            states = dict(self._db.query("select task_id, state from tasks"))
+            if states[tasks[1][1]] != TASK_STATES.RUNNING:
+                break
+            time.sleep(0.05)
+        self.assertTrue(sorted(states) == sorted(ids))
+        self.assertTrue(states[tasks[1][1]] == TASK_STATES.KILLED)
+        self.assertTrue(sorted(states.values()).count(TASK_STATES.QUEUED_NO_DEP) == 2)
+
+        try:
+            RemoteTaskDB(address=self._conf['address'], authkey='wrong', timeout=1.0)
+            failed = False
+        except ValueError as e:
+            failed = True
+        self.assertTrue(failed)
+
+    def test_auth(self):
+        # TCP needs a key, and only the user running the broker can use its unix socket
+        try:
+            TaskBroker(None, '127.0.0.1:0')
+            failed = False
+        except ValueError as e:
+            failed = True
+        self.assertTrue(failed)
+
+        # clients that are not accepted yet cannot make the broker read a large message
+        sock = socket.create_connection(parse_address(self._conf['address'])[1])
+        with sock:
+            self.assertTrue('challenge' in recv_msg(sock))
+            sock.sendall(struct.pack('!I', 2 ** 31))
+            self.assertTrue('error' in recv_msg(sock))
+            self.assertTrue(recv_msg(sock) is None)
+
+        broker = TaskBroker(None, 'test_remote.sock')
+        try:
+            self.assertTrue(os.stat('test_remote.sock').st_mode & 0o777 == 0o600)
+        finally:
+            broker._server.server_close()
+            os.remove('test_remote.sock')
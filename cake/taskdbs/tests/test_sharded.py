@@ -0,0 +1,112 @@
+import os
+import shutil
+import unittest
+import random
+
+from .. import ShardedSQLiteTaskDB
+from ..sharded import SHARD_NAME
+from ...defaults import TASK_STATES, TASKDB_STATES
+
+
+class TestShardedSQLiteTaskDB(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree('test_shards', ignore_errors=True)
+        self._conf = {'name': 'test_shards', 'timeout': 120.0, 'num_shards': 4}
+        self._db = ShardedSQLiteTaskDB(**self._conf)
+
+    def tearDown(self):
+        self._db.close()
+        shutil.rmtree('test_shards', ignore_errors=True)
+
+    def test_shards(self):
+        self.assertTrue(self._db.num_shards == 4)
+        names = sorted(name for name in os.listdir('test_shards') if name.endswith('.db'))
+        self.assertTrue(names == [SHARD_NAME % i for i in range(4)])
+
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(40)], chunksize=7)
+        ids.append(self._db.add('echo "40"'))
+        counts = [shard.status(as_dict=True)['tasks'] for shard in self._db._shards]
+        self.assertTrue(sum(counts) == 41)
+        self.assertTrue(all(count > 0 for count in counts))
+        for id in ids:
+            res = self._db._shard(id).query("select count(*) from tasks where task_id = ?", (id,))
+            self.assertTrue(res[0][0] == 1)
+
+        # the shards are found again when the DB is opened
+        conf = {'name': 'test_shards'}
+        with ShardedSQLiteTaskDB(**conf) as db:
+            self.assertTrue(db.num_shards == 4)
+            self.assertTrue(db.status(as_dict=True)['tasks'] == 41)
+
+        try:
+            ShardedSQLiteTaskDB(name='test_shards', num_shards=3)
+            failed = False
+        except ValueError as e:
+            failed = True
+        self.assertTrue(failed)
+
+    def test_checkout_steals(self):
+        priors = [random.uniform(0, 1) for i in range(20)]
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(20)], priority=priors)
+
+        # every task is found, whichever shard the client starts at
+        for home in range(4):
+            self._db.reset()
+            self._db._home = home
+            tasks = self._db.checkout_many(100)
+            self.assertTrue(sorted(id for _, id in tasks) == sorted(ids))
+            self.assertTrue(self._db.checkout() == (None, None))
+
+        self._db.checkin_many([(id, TASK_STATES.SUCCEEDED, '') for id in ids])
+        stat = self._db.status(as_dict=True)
+        self.assertTrue(stat['states'][TASK_STATES.SUCCEEDED] == 20)
+        self.assertTrue(stat['states'][TASK_STATES.RUNNING] == 0)
+
+    def test_aggregates(self):
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(12)], priority=list(range(12)))
+        self._db.run()
+        self.assertTrue(self._db.state() == TASKDB_STATES.RUNNING)
+        self._db._shards[2].pause()
+        self.assertTrue(self._db.state() == TASKDB_STATES.PAUSED)
+
+        tasks = self._db.checkout_many(12)
+        for i, (_, id) in enumerate(tasks):
+            self._db.checkin(id, TASK_STATES.SUCCEEDED if i < 8 else TASK_STATES.FAILED)
+        self._db.update(ids[0], priority=100)
+        self._db.delete(ids[1])
+
+        stat = self._db.status(as_dict=True)
+        self.assertTrue(stat['tasks'] == 11)
+        self.assertTrue(stat['clients'] == 1)
+        self.assertTrue(stat['states'][TASK_STATES.DELETED] == 1)
+        self._db.status()
+
+        # the update of ids[0] drops its run time if it had SUCCEEDED
+        num_succeeded = len(self._db.query("select task_id from tasks where state = 'SUCCEEDED'"))
+        rtimes = dict(self._db.query("select task_id, runtime from tasks where state = 'SUCCEEDED' "
+                                     "and runtime is not null"))
+        stats = self._db.runtime(as_dict=True)
+        self.assertTrue(stats['tasks'] == len(rtimes))
+        self.assertTrue(abs(stats['total'] - sum(rtimes.values())) < 1e-6)
+        self.assertTrue(stats['max'] == max(rtimes.values()))
+        self.assertTrue(stats['min'] == min(rtimes.values()))
+        self._db.runtime()
+
+        tasks = [task for shard in self._db._shards for task in shard._list_tasks()]
+        self.assertTrue(len(tasks) == 12)
+        self._db.list()
+        self._db.log(ids[0])
+
+        self.assertTrue(self._db.archive() == num_succeeded + 1)
+        self.assertTrue(self._db.status(as_dict=True)['archived'] == num_succeeded + 1)
+
+    def test_no_dependencies(self):
+        id = self._db.add('echo "0"')
+        for add in [lambda: self._db.add('echo "1"', depends_on=[id]),
+                    lambda: self._db.add_multiple([{'cmd': 'echo "1"', 'depends_on': [id]}])]:
+            try:
+                add()
+                failed = False
+            except ValueError as e:
+                failed = True
+            self.assertTrue(failed)
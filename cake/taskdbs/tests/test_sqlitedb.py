@@ -2,17 +2,21 @@ import os
 import unittest
 import random
 import time
+import sqlite3
 
 from .. import SQLiteTaskDB
 from ...defaults import TASK_STATES, TASK_LOG_ACTIONS, TASKDB_STATES, VALID_LOG_CHECKIN_ACTIONS
+from ...defaults import NETWORK_FILESYSTEMS
+from ...utils import filesystem_type
 
 
 class TestSQLiteTaskDB(unittest.TestCase):
     def setUp(self):
-        try:
-            os.remove('test.db')
-        except Exception as e:
-            pass
+        for name in ['test.db', 'test.db-wal', 'test.db-shm']:
+            try:
+                os.remove(name)
+            except Exception as e:
+                pass
 
         self._conf = {'name': 'test.db', 'timeout': 120.0}
         self._db = SQLiteTaskDB(**self._conf)
@@ -20,10 +24,12 @@ class TestSQLiteTaskDB(unittest.TestCase):
         self._delay = 0.0
 
     def tearDown(self):
-        try:
-            os.remove('test.db')
-        except Exception as e:
-            pass
+        self._db.close()
+        for name in ['test.db', 'test.db-wal', 'test.db-shm']:
+            try:
+                os.remove(name)
+            except Exception as e:
+                pass
 
     def test_add_log(self):
         num_add = 13
@@ -94,6 +100,61 @@ class TestSQLiteTaskDB(unittest.TestCase):
 
         self.assertTrue(failed)
 
+    def test_add_multiple_stream(self):
+        def _tasks():
+            for i in range(25):
+                if i % 5 == 0:
+                    yield {'cmd': 'echo "%d"' % i, 'id': 'task%d' % i, 'priority': i}
+                else:
+                    yield 'echo "%d"' % i
+
+        nums = []
+        ids = []
+
+        def _callback(num, chunk_ids):
+            nums.append(num)
+            ids.extend(chunk_ids)
+
+        num_added = self._db.add_multiple(_tasks(), priority=(-i for i in range(25)), chunksize=7,
+                                          callback=_callback, return_ids=False)
+        self.assertTrue(num_added == 25)
+        self.assertTrue(nums == [7, 14, 21, 25])
+        self.assertTrue(sorted(ids) == sorted(r[0] for r in self._db.query("select task_id from tasks")))
+
+        for i in range(25):
+            res = self._db.query("select task_id, priority from tasks where cmd = 'echo \"%d\"'" % i)[0]
+            if i % 5 == 0:
+                self.assertTrue(res[0] == 'task%d' % i)
+                self.assertAlmostEqual(res[1], i)
+            else:
+                self.assertAlmostEqual(res[1], -i)
+        res = self._db.query("select count(*) from logs where action = '%s'" % TASK_LOG_ACTIONS.ADDED)
+        self.assertTrue(res[0][0] == 25)
+
+    def test_add_multiple_dup(self):
+        self._db.add('echo "dup"', id='dup')
+        ids = ['id%d' % i for i in range(10)] + ['dup']
+        cmds = ['echo "%d"' % i for i in range(11)]
+
+        # atomic adds are all or nothing
+        try:
+            self._db.add_multiple(cmds, id=ids, chunksize=4)
+            failed = False
+        except ValueError as e:
+            failed = True
+        self.assertTrue(failed)
+        self.assertTrue(self._db.query("select count(*) from tasks")[0][0] == 1)
+
+        # otherwise the chunks before the duplicate are kept
+        try:
+            self._db.add_multiple(cmds, id=ids, chunksize=4, atomic=False)
+            failed = False
+        except ValueError as e:
+            failed = True
+        self.assertTrue(failed)
+        self.assertTrue(self._db.query("select count(*) from tasks")[0][0] == 9)
+        self.assertTrue(self._db.query("select count(*) from logs")[0][0] == 9)
+
     def test_update_log(self):
         num_add = 13
         ids = []
@@ -459,3 +520,716 @@ class TestSQLiteTaskDB(unittest.TestCase):
             cids.append(id)
 
         self.assertTrue(sorted(cids) == sorted(ids))
+
+    def test_checkout_priority_order(self):
+        num_add = 12
+        priors = [random.uniform(0, 1) for i in range(num_add)]
+        ids = [self._db.add('echo "%d"' % i, priority=priors[i]) for i in range(num_add)]
+
+        # spread the tasks over all of the states checkout picks from by default
+        for i, id in enumerate(ids):
+            if i % 3 == 1:
+                self._db.update(id, state=TASK_STATES.CHECKPOINTED)
+            elif i % 3 == 2:
+                self._db.update(id, state=TASK_STATES.KILLED)
+
+        cids = []
+        for i in range(num_add):
+            tsk, id = self._db.checkout()
+            cids.append(id)
+
+        srt_ids = [id for _, id in sorted(zip(priors, ids), reverse=True)]
+        self.assertTrue(cids == srt_ids)
+
+        tsk, id = self._db.checkout()
+        self.assertTrue(tsk is None)
+        self.assertTrue(id is None)
+
+    def test_checkout_uses_index(self):
+        plan = self._db.query("EXPLAIN QUERY PLAN SELECT CMD, TASK_ID, SORT_KEY, ID FROM TASKDATA "
+                              "WHERE STATE = 1 AND GRP = 0 ORDER BY SORT_KEY DESC, ID ASC LIMIT 1")
+        plan = ' '.join(row[-1] for row in plan)
+        self.assertTrue('TASKDATA_STATE_GROUP' in plan)
+        self.assertTrue('TEMP B-TREE' not in plan)
+
+    def test_checkout_many(self):
+        num_add = 10
+        priors = [random.uniform(0, 1) for i in range(num_add)]
+        ids = [self._db.add('echo "%d"' % i, priority=priors[i]) for i in range(num_add)]
+        srt_ids = [id for _, id in sorted(zip(priors, ids), reverse=True)]
+
+        tasks = self._db.checkout_many(4)
+        self.assertTrue([id for _, id in tasks] == srt_ids[:4])
+        for tsk, id in tasks:
+            res = self._db.query("select cmd, state from tasks where task_id = '%s'" % id)[0]
+            self.assertTrue(res[0] == tsk)
+            self.assertTrue(res[1] == TASK_STATES.RUNNING)
+
+            res = self._db.query("select action from logs where task_id = '%s' ORDER BY log_id DESC" % id)[0]
+            self.assertTrue(res[0] == TASK_LOG_ACTIONS.RAN)
+
+        tasks = self._db.checkout_many(100)
+        self.assertTrue([id for _, id in tasks] == srt_ids[4:])
+
+        tasks = self._db.checkout_many(2)
+        self.assertTrue(len(tasks) == 0)
+
+        for id in ids[:3]:
+            self._db.checkin(id, TASK_STATES.FAILED)
+        tasks = self._db.checkout_many(5, state=TASK_STATES.FAILED)
+        self.assertTrue(sorted([id for _, id in tasks]) == sorted(ids[:3]))
+
+    def test_checkin_many(self):
+        num_add = 8
+        ids = [self._db.add('echo "%d"' % i) for i in range(num_add)]
+        tasks = self._db.checkout_many(num_add)
+        self.assertTrue(len(tasks) == num_add)
+
+        results = []
+        for i, (tsk, id) in enumerate(tasks):
+            results.append((id, VALID_LOG_CHECKIN_ACTIONS[i % len(VALID_LOG_CHECKIN_ACTIONS)], 'info %d' % i))
+        self._db.checkin_many(results)
+
+        for id, state, info in results:
+            res = self._db.query("select state from tasks where task_id = '%s'" % id)[0]
+            self.assertTrue(res[0] == state)
+
+            res = self._db.query("select action, info from logs where task_id = '%s' ORDER BY log_id DESC" % id)[0]
+            self.assertTrue(res[0] == state)
+            self.assertTrue(res[1] == info)
+
+        try:
+            self._db.checkin_many([(ids[0], TASK_STATES.RUNNING, '')])
+            failed = False
+        except Exception as e:
+            failed = True
+        self.assertTrue(failed)
+
+    def test_journal_mode(self):
+        mode = self._db.query('PRAGMA journal_mode')[0][0]
+        if filesystem_type('test.db') in NETWORK_FILESYSTEMS:
+            self.assertTrue(mode == 'delete')
+        else:
+            self.assertTrue(mode == 'wal')
+
+        conf = {}
+        conf.update(self._conf)
+        conf['journal_mode'] = 'delete'
+        self._db.close()
+        with SQLiteTaskDB(**conf) as db2:
+            mode = db2.query('PRAGMA journal_mode')[0][0]
+            self.assertTrue(mode == 'delete')
+        self._db = SQLiteTaskDB(**self._conf)
+
+    def test_lock_backoff(self):
+        conf = {}
+        conf.update(self._conf)
+        conf['timeout'] = 1.0
+        db2 = SQLiteTaskDB(**conf)
+
+        # hold the lock so that db2 has to wait it out
+        self.assertTrue(self._db._lock_db(exclusive=True))
+        wstart = time.time()
+        cstart = time.process_time()
+        self.assertFalse(db2._lock_db(exclusive=True))
+        wtime = time.time() - wstart
+        ctime = time.process_time() - cstart
+        self._db._unlock_db()
+
+        self.assertTrue(wtime >= 1.0)
+        self.assertTrue(ctime < 0.5 * wtime)
+
+        self.assertTrue(db2._lock_db(exclusive=True))
+        db2._unlock_db()
+        db2.close()
+
+    def test_read_only(self):
+        ids = [self._db.add('echo "%d"' % i) for i in range(4)]
+
+        conf = {}
+        conf.update(self._conf)
+        conf['intent'] = 'read'
+        db2 = SQLiteTaskDB(**conf)
+
+        numc = self._db.query('SELECT COUNT(*) FROM CLIENTS')[0][0]
+        self.assertTrue(numc == 1)
+
+        # reading does not need the lock held by the writer
+        self.assertTrue(self._db._lock_db(exclusive=True))
+        self.assertTrue(db2.state() == TASKDB_STATES.PAUSED)
+        res = db2.query("select task_id from tasks where task_id = '%s'" % ids[0])
+        self.assertTrue(res[0][0] == ids[0])
+        self._db._unlock_db()
+
+        for func, args in [(db2.add, ('echo 10',)),
+                           (db2.checkout, ()),
+                           (db2.delete, (ids[0],)),
+                           (db2.pause, ())]:
+            try:
+                func(*args)
+                failed = False
+            except Exception as e:
+                failed = True
+            self.assertTrue(failed)
+
+        db2.close()
+        numc = self._db.query('SELECT COUNT(*) FROM CLIENTS')[0][0]
+        self.assertTrue(numc == 1)
+
+        conf['name'] = 'does_not_exist.db'
+        try:
+            SQLiteTaskDB(**conf)
+            failed = False
+        except Exception as e:
+            failed = True
+        self.assertTrue(failed)
+        self.assertFalse(os.path.exists('does_not_exist.db'))
+
+    def _assert_state_counts(self, db):
+        counts = dict(db.query("SELECT STATE, COUNT(*) FROM TASKS GROUP BY STATE"))
+        stat = db.status(as_dict=True)
+        for state in stat['states']:
+            self.assertTrue(stat['states'][state] == counts.get(state, 0))
+        self.assertTrue(stat['tasks'] == sum(counts.values()) - counts.get(TASK_STATES.DELETED, 0))
+
+    def test_status_counts(self):
+        ids = [self._db.add('echo "%d"' % i) for i in range(6)]
+        ids.extend(self._db.add_multiple(['echo "%d"' % i for i in range(6, 12)]))
+        self._assert_state_counts(self._db)
+
+        tasks = self._db.checkout_many(8)
+        self._assert_state_counts(self._db)
+
+        self._db.checkin_many([(id, VALID_LOG_CHECKIN_ACTIONS[i % len(VALID_LOG_CHECKIN_ACTIONS)], '')
+                               for i, (_, id) in enumerate(tasks[:4])])
+        self._db.checkin(tasks[4][1], TASK_STATES.SUCCEEDED)
+        self._assert_state_counts(self._db)
+
+        self._db.update(ids[10], state=TASK_STATES.FAILED)
+        self._db.update(ids[11], priority=10)
+        self._db.delete(ids[9], remove=False)
+        self._db.delete(ids[8], remove=True)
+        self._assert_state_counts(self._db)
+
+        self._db.cleanup()
+        self._assert_state_counts(self._db)
+
+        self._db.reset()
+        self._assert_state_counts(self._db)
+
+        stat = self._db.status(as_dict=True)
+        self.assertTrue(stat['name'] == 'test.db')
+        self.assertTrue(stat['state'] == TASKDB_STATES.PAUSED)
+        self.assertTrue(stat['clients'] == 1)
+        self.assertTrue(stat['tasks'] == 10)
+        self.assertTrue(stat['states'][TASK_STATES.QUEUED_NO_DEP] == 10)
+
+    def test_timing(self):
+        id = self._db.add('echo "0"')
+        self._db.checkout()
+        res = self._db.query("select start_time, end_time, num_attempts, runtime from tasks")[0]
+        self.assertTrue(res[0] is not None)
+        self.assertTrue(res[1] is None)
+        self.assertTrue(res[2] == 1)
+        self.assertTrue(res[3] is None)
+
+        time.sleep(0.1)
+        self._db.checkin(id, TASK_STATES.CHECKPOINTED)
+        stime = res[0]
+        res = self._db.query("select start_time, end_time, num_attempts, runtime from tasks")[0]
+        self.assertTrue(res[0] == stime)
+        self.assertTrue(abs(res[3] - (res[1] - res[0])) < 1e-6)
+        self.assertTrue(res[3] >= 0.1)
+
+        # running from a checkpoint keeps the start time of the first run
+        self._db.checkout(state=TASK_STATES.CHECKPOINTED)
+        self._db.checkin(id, TASK_STATES.SUCCEEDED)
+        res = self._db.query("select start_time, end_time, num_attempts, runtime from tasks")[0]
+        self.assertTrue(res[0] == stime)
+        self.assertTrue(res[2] == 2)
+        self.assertTrue(res[3] >= 0.1)
+
+        stats = self._db.runtime(as_dict=True)
+        self.assertTrue(stats['tasks'] == 1)
+        self.assertTrue(stats['total'] == res[3])
+        self.assertTrue(stats['min_task'] == id)
+        self.assertTrue(stats['max_task'] == id)
+
+        self._db.reset()
+        res = self._db.query("select start_time, end_time, num_attempts, runtime from tasks")[0]
+        self.assertTrue(res == (None, None, 0, None))
+        self.assertTrue(self._db.runtime(as_dict=True)['tasks'] == 0)
+
+    def test_runtime_stats(self):
+        ids = [self._db.add('echo "%d"' % i) for i in range(4)]
+        for id in ids:
+            self._db.checkout()
+        for i, id in enumerate(ids):
+            self._db.checkin(id, TASK_STATES.SUCCEEDED if i < 3 else TASK_STATES.FAILED)
+            time.sleep(0.05)
+
+        rtimes = dict(self._db.query("select task_id, runtime from tasks where state = 'SUCCEEDED'"))
+        stats = self._db.runtime(as_dict=True)
+        self.assertTrue(stats['tasks'] == 3)
+        self.assertTrue(abs(stats['total'] - sum(rtimes.values())) < 1e-6)
+        self.assertTrue(abs(stats['avg'] - sum(rtimes.values()) / 3) < 1e-6)
+        self.assertTrue(stats['min_task'] == ids[0])
+        self.assertTrue(stats['max_task'] == ids[2])
+        self.assertTrue(stats['max'] == max(rtimes.values()))
+
+        # the max is read off of the end of the runtimes of the succeeded tasks
+        plan = self._db.query("EXPLAIN QUERY PLAN SELECT TASK_ID, MAX(RUNTIME)\n"
+                              "FROM TASKDATA INDEXED BY TASKDATA_RUNTIME WHERE STATE = %d AND RUNTIME IS NOT NULL"
+                              % self._db._state_codes[TASK_STATES.SUCCEEDED])
+        self.assertTrue(any(row[-1].startswith('SEARCH TASKDATA USING INDEX TASKDATA_RUNTIME') for row in plan))
+
+    def test_archive(self):
+        ids = [self._db.add('echo "%d"' % i) for i in range(6)]
+        self._db.checkout_many(3)
+        for id in ids[:2]:
+            self._db.checkin(id, TASK_STATES.SUCCEEDED)
+        self._db.checkin(ids[2], TASK_STATES.FAILED)
+        self._db.delete(ids[3])
+        rtimes = self._db.runtime(as_dict=True)
+
+        for compress in [True, False]:
+            self.assertTrue(self._db.archive(compress=compress) == (3 if compress else 0))
+
+        res = self._db.query("select task_id, state, num_attempts from archive order by task_id")
+        self.assertTrue(sorted(ids[:2] + ids[3:4]) == [r[0] for r in res])
+        res = self._db.query("select count(*) from tasks where task_id in ('%s')" % "', '".join(ids[:2] + ids[3:4]))
+        self.assertTrue(res[0][0] == 0)
+        res = self._db.query("select count(*) from logs where task_id in ('%s')" % "', '".join(ids[:2] + ids[3:4]))
+        self.assertTrue(res[0][0] == 0)
+
+        stat = self._db.status(as_dict=True)
+        self.assertTrue(stat['archived'] == 3)
+        self.assertTrue(stat['tasks'] == 3)
+        self.assertTrue(stat['states'][TASK_STATES.SUCCEEDED] == 0)
+
+        self.assertTrue(self._db.runtime(as_dict=True) == rtimes)
+        self._db.log(ids[0])
+
+        # archived IDs cannot be reused
+        try:
+            self._db.add('echo "0"', id=ids[0])
+            failed = False
+        except Exception as e:
+            failed = True
+        self.assertTrue(failed)
+
+    def test_archive_logs(self):
+        id = self._db.add('echo "0"')
+        self._db.checkout()
+        self._db.checkin(id, TASK_STATES.SUCCEEDED, info='done')
+        logs = self._db.query("select action, time, info from logs where task_id = '%s' order by log_id" % id)
+        self._db.archive()
+
+        blob = self._db.query("select logs from archive where task_id = '%s'" % id)[0][0]
+        self.assertTrue([tuple(log) for log in self._db._decode_logs(blob)] == logs)
+        self.assertTrue(self._db.query('PRAGMA auto_vacuum')[0][0] == 2)
+
+    def test_query_params(self):
+        id = self._db.add("echo 'quoted'", id="it's")
+        res = self._db.query("select cmd from tasks where task_id = ?", (id,))
+        self.assertTrue(res[0][0] == "echo 'quoted'")
+
+        self._db.update(id, task="echo 'requoted'", priority=2.5)
+        res = self._db.query("select cmd, priority from tasks where task_id = ?", (id,))
+        self.assertTrue(res[0] == ("echo 'requoted'", 2.5))
+
+        self._db.checkout()
+        self._db.checkin(id, TASK_STATES.SUCCEEDED)
+        self._db.log(id)
+        self._db.delete(id)
+        res = self._db.query("select state from tasks where task_id = ?", (id,))
+        self.assertTrue(res[0][0] == TASK_STATES.DELETED)
+
+    def _lease_db(self, **conf):
+        tconf = {}
+        tconf.update(self._conf)
+        tconf.update({'lease_time': 0.5, 'task_checkout_num_tries': 1, 'task_checkout_delay': 0.0})
+        tconf.update(conf)
+        return SQLiteTaskDB(**tconf)
+
+    def test_lease_reclaim(self):
+        ids = self._db.add_multiple(['echo "%d"' % i for i in range(3)], priority=[2, 1, 0])
+
+        # a worker that dies without renewing its leases
+        dead = self._lease_db(heartbeat_interval=100.0)
+        self.assertTrue(len(dead.checkout_many(2)) == 2)
+        res = self._db.query("select lease_expiry, client from taskdata where task_id = ?", (ids[0],))[0]
+        self.assertTrue(res[0] is not None and res[1] == dead._client_id)
+
+        live = self._lease_db()
+        self.assertTrue(live.checkout() == ('echo "2"', ids[2]))
+        self.assertTrue(live.checkout() == (None, None))
+
+        time.sleep(0.6)
+        tasks = live.checkout_many(5)
+        self.assertTrue(sorted(id for _, id in tasks) == sorted(ids[:2]))
+        for id in ids[:2]:
+            res = self._db.query("select action, info from logs where task_id = ? order by log_id", (id,))
+            self.assertTrue(res[-2] == (TASK_LOG_ACTIONS.EXPIRED, 'lease expired'))
+            self.assertTrue(res[-1][0] == TASK_LOG_ACTIONS.RAN)
+
+        # the heartbeat of the live worker keeps its own leases
+        time.sleep(0.6)
+        self.assertTrue(live.cleanup(expired_only=True) == 0)
+        res = self._db.query("select count(*) from taskdata where state = ? and client = ?",
+                             (self._db._state_codes[TASK_STATES.RUNNING], live._client_id))
+        self.assertTrue(res[0][0] == 3)
+        res = self._db.query("select client_id from clients where client_id = ?", (dead._client_id,))
+        self.assertTrue(len(res) == 0)
+
+        live.checkin_many([(id, TASK_STATES.SUCCEEDED, '') for id in ids])
+        res = self._db.query("select count(*) from taskdata where lease_expiry is not null or client is not null")
+        self.assertTrue(res[0][0] == 0)
+        self._assert_state_counts(self._db)
+
+        live.close()
+        dead._stop_heartbeat()
+        dead._conn.close()
+
+    def test_lease_stale_checkin(self):
+        id = self._db.add('echo "0"')
+
+        # a worker stalls past its lease and another one takes over the task
+        slow = self._lease_db(heartbeat_interval=100.0)
+        self.assertTrue(slow.checkout() == ('echo "0"', id))
+        time.sleep(0.6)
+        fast = self._lease_db()
+        self.assertTrue(fast.checkout() == ('echo "0"', id))
+
+        # the late checkin of the stalled worker is dropped, with or without others in the batch
+        slow.checkin(id, TASK_STATES.FAILED)
+        slow.checkin_many([(id, TASK_STATES.FAILED, '')])
+        res = self._db.query("select state, client from taskdata where task_id = ?", (id,))[0]
+        self.assertTrue(res == (self._db._state_codes[TASK_STATES.RUNNING], fast._client_id))
+
+        fast.checkin(id, TASK_STATES.SUCCEEDED)
+        res = self._db.query("select action from logs where task_id = ? order by log_id", (id,))
+        self.assertTrue([r[0] for r in res] == [TASK_LOG_ACTIONS.ADDED, TASK_LOG_ACTIONS.RAN, TASK_LOG_ACTIONS.EXPIRED,
+                                                TASK_LOG_ACTIONS.RAN, TASK_LOG_ACTIONS.SUCCEEDED])
+        res = self._db.query("select state, num_attempts from tasks where task_id = ?", (id,))
+        self.assertTrue(res[0] == (TASK_STATES.SUCCEEDED, 2))
+
+        # nor can it end the task once it is done
+        slow.checkin(id, TASK_STATES.FAILED)
+        res = self._db.query("select state from tasks where task_id = ?", (id,))
+        self.assertTrue(res[0][0] == TASK_STATES.SUCCEEDED)
+        self._assert_state_counts(self._db)
+
+        fast.close()
+        slow._stop_heartbeat()
+        slow._conn.close()
+
+    def test_cleanup_expired(self):
+        id = self._db.add('echo "0"')
+        db = self._lease_db(heartbeat_interval=100.0)
+        db.checkout()
+        self.assertTrue(self._db.cleanup(expired_only=True) == 0)
+
+        time.sleep(0.6)
+        self.assertTrue(self._lease_db(intent='examine').cleanup(expired_only=True) == 1)
+        res = self._db.query("select state from tasks where task_id = ?", (id,))
+        self.assertTrue(res[0][0] == TASK_STATES.KILLED)
+
+        # the reclaim query only reads the leases of running tasks
+        plan = self._db.query("EXPLAIN QUERY PLAN SELECT ID FROM TASKDATA INDEXED BY TASKDATA_LEASE_EXPIRY\n"
+                              "WHERE STATE = %d AND LEASE_EXPIRY < ?"
+                              % self._db._state_codes[TASK_STATES.RUNNING], (0,))
+        self.assertTrue(any('TASKDATA_LEASE_EXPIRY (LEASE_EXPIRY<?)' in row[-1] for row in plan))
+        db.close()
+
+    def test_migrate_v2(self):
+        id = self._db.add('echo "0"')
+        self._db.close()
+
+        # strip the DB back to schema version 2
+        conn = sqlite3.connect('test.db', isolation_level=None)
+        conn.executescript("""\
+DROP INDEX TASKDATA_LEASE_EXPIRY;
+DROP INDEX TASKDATA_STATE_GROUP;
+CREATE INDEX TASKDATA_STATE_PRIORITY ON TASKDATA(STATE, PRIORITY DESC);
+ALTER TABLE TASKDATA DROP COLUMN GRP;
+ALTER TABLE TASKDATA DROP COLUMN ADD_TIME;
+ALTER TABLE TASKDATA DROP COLUMN SORT_KEY;
+ALTER TABLE INFO DROP COLUMN VIRTUAL_TIME;
+DROP TABLE GROUPS;
+ALTER TABLE TASKDATA DROP COLUMN LEASE_EXPIRY;
+ALTER TABLE TASKDATA DROP COLUMN CLIENT;
+ALTER TABLE TASKDATA DROP COLUMN NUM_DEPS_LEFT;
+ALTER TABLE CLIENTS DROP COLUMN HEARTBEAT;
+DROP TABLE DEPENDENCIES;
+UPDATE INFO SET VERSION = 2;""")
+        conn.close()
+
+        try:
+            SQLiteTaskDB(**self._conf)
+            failed = False
+        except ValueError as e:
+            failed = True
+            self.assertTrue('cake migrate' in str(e))
+        self.assertTrue(failed)
+
+        conf = {}
+        conf.update(self._conf)
+        conf['intent'] = 'migrate'
+        self._db = SQLiteTaskDB(**conf)
+        self.assertTrue(self._db.query("select version from info")[0][0] == 5)
+        self.assertTrue(self._db.checkout() == ('echo "0"', id))
+        res = self._db.query("select client from taskdata where task_id = ?", (id,))
+        self.assertTrue(res[0][0] == self._db._client_id)
+        id2 = self._db.add('echo "1"', depends_on=[id])
+        self._db.checkin(id, TASK_STATES.SUCCEEDED)
+        self.assertTrue(self._db.checkout() == ('echo "1"', id2))
+        res = self._db.query("select grp, sort_key, add_time is not null from taskdata where task_id = ?", (id,))
+        self.assertTrue(res[0] == (0, 0.0, 1))
+        res = self._db.query("select name from sqlite_master where name = 'TASKDATA_STATE_PRIORITY'")
+        self.assertTrue(len(res) == 0)
+
+    def _task_states(self, ids):
+        return [self._db.query("select state from tasks where task_id = ?", (id,))[0][0] for id in ids]
+
+    def test_dependencies(self):
+        # a diamond, a -> (b, c) -> d
+        a = self._db.add('echo "a"')
+        b = self._db.add('echo "b"', depends_on=[a], priority=2)
+        c = self._db.add('echo "c"', depends_on=[a], priority=1)
+        d = self._db.add('echo "d"', depends_on=[b, c])
+        self.assertTrue(self._task_states([a, b, c, d]) == [TASK_STATES.QUEUED_NO_DEP] +
+                        [TASK_STATES.QUEUED_WITH_DEP] * 3)
+        self._assert_state_counts(self._db)
+
+        self.assertTrue(self._db.checkout() == ('echo "a"', a))
+        self.assertTrue(self._db.checkout() == (None, None))
+        self._db.checkin(a, TASK_STATES.FAILED)
+        self.assertTrue(self._task_states([b, c]) == [TASK_STATES.QUEUED_WITH_DEP] * 2)
+
+        self.assertTrue(self._db.checkout(state=TASK_STATES.FAILED) == ('echo "a"', a))
+        self._db.checkin(a, TASK_STATES.SUCCEEDED)
+        self.assertTrue(self._task_states([b, c, d]) == [TASK_STATES.QUEUED_NO_DEP] * 2 +
+                        [TASK_STATES.QUEUED_WITH_DEP])
+
+        self.assertTrue(self._db.checkout_many(5) == [('echo "b"', b), ('echo "c"', c)])
+        self._db.checkin_many([(b, TASK_STATES.SUCCEEDED, ''), (b, TASK_STATES.SUCCEEDED, '')])
+        self.assertTrue(self._task_states([d]) == [TASK_STATES.QUEUED_WITH_DEP])
+        self._db.checkin(c, TASK_STATES.SUCCEEDED)
+        self.assertTrue(self._task_states([d]) == [TASK_STATES.QUEUED_NO_DEP])
+        self._assert_state_counts(self._db)
+
+        # undoing a dependency holds its queued dependents back again
+        self._db.update(c, state=TASK_STATES.QUEUED_NO_DEP)
+        self.assertTrue(self._task_states([d]) == [TASK_STATES.QUEUED_WITH_DEP])
+        self._db.update(c, state=TASK_STATES.SUCCEEDED)
+        self.assertTrue(self._task_states([d]) == [TASK_STATES.QUEUED_NO_DEP])
+
+        # reset waits on all of the dependencies again
+        self._db.reset()
+        self.assertTrue(self._task_states([a, b, c, d]) == [TASK_STATES.QUEUED_NO_DEP] +
+                        [TASK_STATES.QUEUED_WITH_DEP] * 3)
+        self._assert_state_counts(self._db)
+
+        for id in [a, b, c]:
+            self._db.update(id, state=TASK_STATES.SUCCEEDED)
+        self._db.archive()
+
+        # archived tasks count as done
+        self.assertTrue(self._task_states([d]) == [TASK_STATES.QUEUED_NO_DEP])
+        e = self._db.add('echo "e"', depends_on=[a, d])
+        self.assertTrue(self._db.query("select num_deps_left from taskdata where task_id = ?", (e,))[0][0] == 1)
+        self._db.reset()
+        self.assertTrue(self._task_states([d, e]) == [TASK_STATES.QUEUED_NO_DEP, TASK_STATES.QUEUED_WITH_DEP])
+
+        with self.assertRaises(ValueError):
+            self._db.add('echo', depends_on=['missing'])
+
+        self._db.add('echo', id='f', depends_on=[e])
+        self._db.delete('f')
+        with self.assertRaises(ValueError):
+            self._db.add('echo', id='g', depends_on=['f'])
+
+        # dependents are found with the index instead of a scan of the dependencies
+        plan = self._db.query("EXPLAIN QUERY PLAN SELECT TASK FROM DEPENDENCIES WHERE DEPENDS_ON = ?", (1,))
+        self.assertTrue(any('DEPENDENCIES_DEPENDS_ON' in row[-1] for row in plan))
+
+    def test_delete_dependencies(self):
+        # deleting a task deletes the tasks waiting on it, a -> b -> c
+        a = self._db.add('echo "a"')
+        b = self._db.add('echo "b"', depends_on=[a])
+        c = self._db.add('echo "c"', depends_on=[b])
+        self._db.delete(a)
+        self.assertTrue(self._task_states([a, b, c]) == [TASK_STATES.DELETED] * 3)
+        res = self._db.query("select info from logs where task_id = ? and action = ?", (c, TASK_LOG_ACTIONS.DELETED))
+        self.assertTrue(res == [('depends on deleted task %s' % b,)])
+        self._assert_state_counts(self._db)
+
+        # and so does removing it
+        d = self._db.add('echo "d"')
+        e = self._db.add('echo "e"', depends_on=[d])
+        self._db.delete(d, remove=True)
+        self.assertTrue(self._task_states([e]) == [TASK_STATES.DELETED])
+
+        # a task that SUCCEEDED still counts as done once deleted, also after a reset
+        f = self._db.add('echo "f"')
+        g = self._db.add('echo "g"', depends_on=[f])
+        self.assertTrue(self._db.checkout() == ('echo "f"', f))
+        self._db.checkin(f, TASK_STATES.SUCCEEDED)
+        self._db.delete(f)
+        self.assertTrue(self._task_states([g]) == [TASK_STATES.QUEUED_NO_DEP])
+        self._db.reset()
+        self.assertTrue(self._task_states([g]) == [TASK_STATES.QUEUED_NO_DEP])
+        self._assert_state_counts(self._db)
+
+    def test_add_multiple_dependencies(self):
+        ids = self._db.add_multiple([{'cmd': 'echo "0"', 'id': 'x'},
+                                     {'cmd': 'echo "1"', 'id': 'y', 'depends_on': ['x']},
+                                     {'cmd': 'echo "2"', 'id': 'z', 'depends_on': ['x', 'y']}], chunksize=2)
+        self.assertTrue(self._task_states(ids) == [TASK_STATES.QUEUED_NO_DEP] + [TASK_STATES.QUEUED_WITH_DEP] * 2)
+        for id in ids:
+            self.assertTrue(self._db.checkout() == ('echo "%s"' % ids.index(id), id))
+            self._db.checkin(id, TASK_STATES.SUCCEEDED)
+
+        # tasks cannot depend on tasks added after them
+        try:
+            self._db.add_multiple([{'cmd': 'echo', 'id': 'u', 'depends_on': ['v']},
+                                   {'cmd': 'echo', 'id': 'v', 'depends_on': ['u']}])
+            failed = False
+        except ValueError as e:
+            failed = True
+        self.assertTrue(failed)
+        self.assertTrue(self._db.query("select count(*) from tasks")[0][0] == 3)
+
+    def test_groups(self):
+        # a big high priority batch does not hold back the other groups
+        big = self._db.add_multiple(['echo "big %d"' % i for i in range(20)], priority=10, group='big')
+        small = self._db.add_multiple(['echo "small %d"' % i for i in range(4)], group='small')
+        default = self._db.add('echo "default"', priority=-1)
+
+        ids = [id for _, id in self._db.checkout_many(6)]
+        self.assertTrue(ids == [default, big[0], small[0], big[1], small[1], big[2]])
+
+        # weights set the shares of the groups
+        self._db.set_group('big', weight=3)
+        ids = [self._db.checkout()[1] for i in range(8)]
+        self.assertTrue(sum(1 for id in ids if id in big) == 6)
+        self.assertTrue(sum(1 for id in ids if id in small) == 2)
+
+        # a group that was idle gets no more than its share when it comes back
+        self._db.set_group('big', weight=1)
+        late = self._db.add_multiple(['echo "late %d"' % i for i in range(10)], group='late')
+        ids = [self._db.checkout()[1] for i in range(6)]
+        self.assertTrue(sum(1 for id in ids if id in late) == 3)
+
+        try:
+            self._db.set_group('big', weight=0)
+            failed = False
+        except ValueError as e:
+            failed = True
+        self.assertTrue(failed)
+
+    def test_group_aging(self):
+        old = self._db.add('echo "old"', priority=0, group='aged')
+        self._db.query("update taskdata set add_time = add_time - 3600000, sort_key = 0 where task_id = ?", (old,))
+        new = self._db.add('echo "new"', priority=1, group='aged')
+        self.assertTrue(self._db.checkout_many(2) == [('echo "new"', new), ('echo "old"', old)])
+
+        # the old task has waited an hour longer, which is worth 2 in priority with this aging
+        self._db.reset()
+        self._db.set_group('aged', aging=2.0)
+        self.assertTrue(self._db.checkout_many(2) == [('echo "old"', old), ('echo "new"', new)])
+
+        # updated priorities keep the aging
+        self._db.reset()
+        self._db.update(new, priority=1.5)
+        self.assertTrue(self._db.checkout() == ('echo "old"', old))
+        self._db.update(new, priority=3.5)
+        self._db.reset()
+        self.assertTrue(self._db.checkout() == ('echo "new"', new))
+
+    def _make_v1_db(self, num_add):
+        """make a task DB with schema version 1 as written by older versions of cake"""
+        self._db.close()
+        for name in ['test.db', 'test.db-wal', 'test.db-shm']:
+            try:
+                os.remove(name)
+            except Exception as e:
+                pass
+
+        conn = sqlite3.connect('test.db', isolation_level=None)
+        conn.executescript("""\
+CREATE TABLE TASKS(TASK_ID TEXT PRIMARY KEY NOT NULL, CMD TEXT DEFAULT '', STATE TEXT DEFAULT 'QUEUED_NO_DEP',
+PRIORITY REAL DEFAULT 0);
+CREATE TABLE LOGS(LOG_ID INTEGER PRIMARY KEY AUTOINCREMENT, ACTION TEXT DEFAULT 'ADDED', INFO TEXT DEFAULT '',
+TIME TIMESTAMP DEFAULT(strftime('%Y-%m-%d %H:%M:%f','NOW')), TASK_ID TEXT,
+FOREIGN KEY(TASK_ID) REFERENCES TASKS(TASK_ID));
+CREATE TABLE INFO(STATE TEXT DEFAULT 'PAUSED', CONFIG TEXT);
+CREATE TABLE CLIENTS(CLIENT_ID TEXT PRIMARY KEY NOT NULL);""")
+        conn.execute("INSERT INTO INFO (STATE, CONFIG) VALUES ('PAUSED', ?)", ("{name: test.db}",))
+        for i in range(num_add):
+            id = 'task%d' % i
+            conn.execute("INSERT INTO TASKS (TASK_ID, CMD, STATE, PRIORITY) VALUES (?, ?, ?, ?)",
+                         (id, 'echo "%d"' % i, TASK_STATES.SUCCEEDED if i % 2 == 0 else TASK_STATES.FAILED, i))
+            conn.executemany("INSERT INTO LOGS (ACTION, TASK_ID, TIME, INFO) VALUES (?, ?, ?, ?)",
+                             [(TASK_LOG_ACTIONS.ADDED, id, '2018-01-01 00:00:00.000', ''),
+                              (TASK_LOG_ACTIONS.RAN, id, '2018-01-01 00:00:01.000', ''),
+                              (TASK_STATES.SUCCEEDED if i % 2 == 0 else TASK_STATES.FAILED, id,
+                               '2018-01-01 00:00:0%d.500' % (i % 8 + 2), 'info %d' % i)])
+
+        # a removed task with logs left behind
+        conn.execute("INSERT INTO LOGS (ACTION, TASK_ID) VALUES (?, ?)", (TASK_LOG_ACTIONS.DELETED, 'removed'))
+
+        conn.close()
+
+    def _assert_v1_migrated(self, db, num_add):
+        res = db.query("select task_id, cmd, state, priority, num_attempts, runtime from tasks order by priority")
+        self.assertTrue(len(res) == num_add)
+        for i, (id, cmd, state, priority, num_attempts, rtime) in enumerate(res):
+            self.assertTrue(id == 'task%d' % i)
+            self.assertTrue(cmd == 'echo "%d"' % i)
+            self.assertTrue(state == (TASK_STATES.SUCCEEDED if i % 2 == 0 else TASK_STATES.FAILED))
+            self.assertTrue(num_attempts == 1)
+            self.assertAlmostEqual(rtime, 1.5 + i % 8)
+
+            logs = db.query("select action, time, info from logs where task_id = ? order by log_id", (id,))
+            self.assertTrue([log[0] for log in logs] == [TASK_LOG_ACTIONS.ADDED, TASK_LOG_ACTIONS.RAN, state])
+            self.assertTrue(logs[1][1] == '2018-01-01 00:00:01.000')
+            self.assertTrue(logs[2][1] == '2018-01-01 00:00:0%d.500' % (i % 8 + 2))
+            self.assertTrue(logs[2][2] == 'info %d' % i)
+
+        self._assert_state_counts(db)
+        self.assertTrue(db.query("select version from info")[0][0] == 5)
+        self.assertTrue(db.query("select count(*) from logdata")[0][0] == 3 * num_add + 1)
+        res = db.query("select action from logs where task_id = 'removed'")
+        self.assertTrue(res == [(TASK_LOG_ACTIONS.DELETED,)])
+        self.assertTrue(db.query('PRAGMA auto_vacuum')[0][0] == 2)
+
+    def test_migrate(self):
+        self._make_v1_db(10)
+
+        # version 1 DBs have to be migrated before they can be used
+        for intent in ['examine', 'read']:
+            conf = {}
+            conf.update(self._conf)
+            conf['intent'] = intent
+            with self.assertRaises(ValueError) as cm:
+                SQLiteTaskDB(**conf)
+            self.assertTrue('cake migrate' in str(cm.exception))
+
+        conf = {}
+        conf.update(self._conf)
+        conf['intent'] = 'migrate'
+        self._db = SQLiteTaskDB(**conf)
+        self._assert_v1_migrated(self._db, 10)
+        self.assertTrue(self._db.runtime(as_dict=True)['tasks'] == 5)
+
+        # migrated DBs work as usual
+        self._db.reset()
+        id = self._db.add('echo "new"', priority=100)
+        self.assertTrue(self._db.checkout() == ('echo "new"', id))
+        self._db.checkin(id, TASK_STATES.SUCCEEDED)
+        self._db.close()
+
+        self._db = SQLiteTaskDB(**self._conf)
+        self._assert_state_counts(self._db)
@@ -1,24 +1,28 @@
 import os
+import json
 import time
+import shutil
 import subprocess
 
 import pytest
 
-from cake import SQLiteTaskDB
+from cake import SQLiteTaskDB, pycall
 
 
 @pytest.fixture(params=[SQLiteTaskDB])
 def taskdb(request):
     name = 'test.db'
-    try:
-        os.remove(name)
-    except Exception as e:
-        pass
+    for fname in [name, name + '-wal', name + '-shm']:
+        try:
+            os.remove(fname)
+        except Exception as e:
+            pass
     yield (name, request.param)
-    try:
-        os.remove(name)
-    except Exception as e:
-        pass
+    for fname in [name, name + '-wal', name + '-shm']:
+        try:
+            os.remove(fname)
+        except Exception as e:
+            pass
 
 
 @pytest.fixture()
@@ -41,7 +45,22 @@ def test_status(taskdb):
                             shell=True,
                             check=True,
                             stdout=subprocess.PIPE).stdout.decode('utf-8')
-    assert 'QUEUED_NO_DEP: 16' in output, "Status of tasks was not reported correctly!"
+    assert 'QUEUED_NO_DEP:   16' in output, "Status of tasks was not reported correctly!"
+
+
+def test_status_json(taskdb):
+    """test that status can be read as JSON"""
+    with taskdb[1](name=taskdb[0]) as db:
+        for i in range(16):
+            db.add('echo %d' % i)
+
+    output = subprocess.run('cake status --json %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    stat = json.loads(output)
+    assert stat['tasks'] == 16, "Status of tasks was not reported correctly!"
+    assert stat['states']['QUEUED_NO_DEP'] == 16, "Status of tasks was not reported correctly!"
 
 
 def test_add_pipe(taskdb):
@@ -54,7 +73,7 @@ def test_add_pipe(taskdb):
                             shell=True,
                             check=True,
                             stdout=subprocess.PIPE).stdout.decode('utf-8')
-    assert 'QUEUED_NO_DEP: 16' in output, "Tasks did not get added correctly!"
+    assert 'QUEUED_NO_DEP:   16' in output, "Tasks did not get added correctly!"
 
 
 def test_add_stdin(taskdb, tasks):
@@ -70,7 +89,7 @@ def test_add_stdin(taskdb, tasks):
                             shell=True,
                             check=True,
                             stdout=subprocess.PIPE).stdout.decode('utf-8')
-    assert 'QUEUED_NO_DEP: 16' in output, "Tasks did not get added correctly!"
+    assert 'QUEUED_NO_DEP:   16' in output, "Tasks did not get added correctly!"
 
 
 def test_add_file(taskdb, tasks):
@@ -86,10 +105,53 @@ def test_add_file(taskdb, tasks):
                             shell=True,
                             check=True,
                             stdout=subprocess.PIPE).stdout.decode('utf-8')
-    assert 'QUEUED_NO_DEP: 16' in output, "Tasks did not get added correctly!"
+    assert 'QUEUED_NO_DEP:   16' in output, "Tasks did not get added correctly!"
+
 
+def test_add_arg(taskdb):
+    """test adding a task as arguments"""
 
-@pytest.mark.parametrize("arg", ["", "-n 4"])
+    taskid = subprocess.run('cake add %s echo 234' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
+    with taskdb[1](name=taskdb[0]) as db:
+        assert db.query("select cmd from tasks where task_id = '%s'" % taskid)[0][0] == 'echo 234', \
+            "Task did not get added correctly!"
+
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl"])
+def test_add_format(taskdb, tasks, fmt):
+    """test adding structured tasks in chunks"""
+
+    with open(tasks, 'w') as fp:
+        if fmt == 'csv':
+            fp.write('id,priority,cmd\n')
+            for i in range(16):
+                fp.write('task%d,%d,"echo %d, %d"\n' % (i, i, i, i))
+        else:
+            for i in range(16):
+                fp.write(json.dumps({'id': 'task%d' % i, 'priority': i, 'cmd': 'echo %d, %d' % (i, i)}) + '\n')
+
+    proc = subprocess.run('cake add --format %s --chunksize 5 --progress --no-atomic %s < %s'
+                          % (fmt, taskdb[0], tasks),
+                          shell=True,
+                          check=True,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+    assert proc.stdout.decode('utf-8').split() == ['task%d' % i for i in range(16)], \
+        "Task ids were not reported correctly!"
+    assert proc.stderr.decode('utf-8').count('tasks/s') == 4, "Progress was not reported correctly!"
+
+    with taskdb[1](name=taskdb[0]) as db:
+        res = db.query("select task_id, priority, cmd from tasks")
+    assert sorted(res) == sorted(('task%d' % i, i, 'echo %d, %d' % (i, i)) for i in range(16)), \
+        "Tasks did not get added correctly!"
+
+
+@pytest.mark.parametrize("arg", ["", "-n 4", "-n 4 --checkin-batch 4 --checkin-interval 1",
+                                 "--memory", "-n 4 --memory", "--async -n 4",
+                                 "--async -n 4 --checkin-batch 4 --checkin-interval 1"])
 def test_run(taskdb, arg):
     """make sure basic running works"""
 
@@ -104,10 +166,235 @@ def test_run(taskdb, arg):
                             shell=True,
                             check=True,
                             stdout=subprocess.PIPE).stdout.decode('utf-8')
-    assert 'SUCCEEDED:     16' in output, "Tasks did not run correctly!"
+    assert 'SUCCEEDED:       16' in output, "Tasks did not run correctly!"
+
+
+# fails if SIGINT, SIGPIPE or SIGXFSZ is ignored in the task, as they are in the worker or the fork server
+SIGNALS_NOT_IGNORED = 'test $(( 0x$(awk \'/^SigIgn/ {print $2}\' /proc/self/status) & 0x1001002 )) -eq 0'
+
+
+@pytest.mark.parametrize("arg", ["--launcher shell", "--launcher forkserver", "-n 4 --launcher spawn",
+                                 "-n 4 --launcher forkserver", "--async -n 4 --launcher spawn"])
+def test_run_launcher(taskdb, arg):
+    """make sure commands with and without shell syntax run the same with every launcher"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        for tsk in ['true', 'echo "a b"', 'test 1 -eq 1', 'x=1 && test $x -eq 1', 'cd / && ls > /dev/null',
+                    'false', 'exit 3', 'no_such_program_for_cake', 'test "$(echo a)" = b', SIGNALS_NOT_IGNORED]:
+            db.add(tsk)
+
+    subprocess.run('cake run %s %s' % (arg, taskdb[0]),
+                   shell=True,
+                   check=True)
+    output = subprocess.run('cake status %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'SUCCEEDED:       6' in output, "Tasks did not run correctly!"
+    assert 'FAILED:          4' in output, "Tasks did not fail correctly!"
+
+
+@pytest.mark.parametrize("arg", ["--bundle 4", "-n 2 --bundle 3", "-n 4 --bundle 100 --checkin-batch 5"])
+def test_run_bundle(taskdb, arg):
+    """make sure the tasks of a bundle run and are checked in on their own"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        for tsk in ['echo 0', 'exit 3', 'cd / && test "$(pwd)" = /', 'test "$(pwd)" != /', 'x=1; test $x -eq 1',
+                    'test -z "$x"', 'echo ) unbalanced', 'echo 7', 'false', 'sleep 0.1 && true',
+                    SIGNALS_NOT_IGNORED]:
+            db.add(tsk)
+
+    subprocess.run('cake run %s %s' % (arg, taskdb[0]),
+                   shell=True,
+                   check=True)
+    output = subprocess.run('cake status %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'SUCCEEDED:       8' in output, "Tasks did not run correctly!"
+    assert 'FAILED:          3' in output, "Tasks did not fail correctly!"
+
+
+def record_pid(name):
+    """used by pycall tasks to record the process they ran in"""
+    with open(name, 'a') as fp:
+        fp.write('%d\n' % os.getpid())
+
+
+@pytest.mark.parametrize("arg", ["", "-n 2", "-n 2 --max-tasks-per-child 1", "--async -n 2", "--bundle 3",
+                                 "-n 2 --bundle 3"])
+def test_run_pycall(taskdb, arg):
+    """make sure tasks calling python functions run"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        db.add(pycall('os.path:isdir', '/'))
+        db.add(pycall(os.path.join, 'a', 'b'))
+        db.add(pycall('sys:exit', 0))
+        db.add('pycall:json:loads {"args": ["[1, 2]"]}')
+        db.add('pycall:json:loads {"args": ["{"]}')
+        db.add(pycall('sys:exit', 3))
+        db.add('pycall:no_such_module_for_cake:f')
+        db.add('pycall:json:loads ["not", "an", "object"]')
+
+    subprocess.run('cake run %s %s' % (arg, taskdb[0]),
+                   shell=True,
+                   check=True)
+    output = subprocess.run('cake status %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'SUCCEEDED:       4' in output, "Tasks did not run correctly!"
+    assert 'FAILED:          4' in output, "Tasks did not fail correctly!"
+
+
+@pytest.mark.parametrize("arg,min_procs,max_procs", [("-n 2", 1, 2), ("-n 2 --max-tasks-per-child 1", 8, 8)])
+def test_run_pycall_processes(taskdb, tasks, arg, min_procs, max_procs):
+    """make sure python functions are called in the pool processes and those are replaced"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        for i in range(8):
+            db.add(pycall(record_pid, os.path.abspath(tasks)))
+
+    subprocess.run('cake run %s %s' % (arg, taskdb[0]),
+                   shell=True,
+                   check=True)
+    with open(tasks, 'r') as fp:
+        pids = [int(line) for line in fp]
+    assert len(pids) == 8, "Tasks did not run correctly!"
+    assert min_procs <= len(set(pids)) <= max_procs, "Tasks did not run in the right processes!"
+
+
+def test_run_dependencies(taskdb, tasks):
+    """make sure tasks only run after the tasks they depend on"""
+
+    with open(tasks, 'w') as fp:
+        fp.write(json.dumps({'cmd': 'echo a', 'id': 'a', 'priority': 0}) + '\n')
+        fp.write(json.dumps({'cmd': 'echo b', 'id': 'b', 'priority': 1, 'depends_on': ['a']}) + '\n')
+        fp.write(json.dumps({'cmd': 'echo c', 'id': 'c', 'priority': 2, 'depends_on': ['a', 'b']}) + '\n')
+
+    subprocess.run('cake add %s --format jsonl --file %s' % (taskdb[0], tasks),
+                   shell=True,
+                   check=True)
+    output = subprocess.run('cake status %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'QUEUED_WITH_DEP: 2' in output, "Dependencies did not get added correctly!"
+
+    subprocess.run('cake run %s' % taskdb[0],
+                   shell=True,
+                   check=True)
+    with taskdb[1](name=taskdb[0]) as db:
+        res = db.query("select task_id from logs where action = 'SUCCEEDED' order by log_id")
+    assert [r[0] for r in res] == ['a', 'b', 'c'], "Tasks did not run in the order of their dependencies!"
+
+
+def test_run_sharded(tasks):
+    """make sure tasks run from a sharded task DB"""
+    name = 'test_shards'
+    shutil.rmtree(name, ignore_errors=True)
+
+    with open(tasks, 'w') as fp:
+        for i in range(16):
+            fp.write('echo %d\n' % i)
+
+    try:
+        subprocess.run('cake add %s --shards 4 --file %s' % (name, tasks),
+                       shell=True,
+                       check=True)
+        subprocess.run('cake run -n 2 %s' % name,
+                       shell=True,
+                       check=True)
+        output = subprocess.run('cake status %s' % name,
+                                shell=True,
+                                check=True,
+                                stdout=subprocess.PIPE).stdout.decode('utf-8')
+        assert 'SUCCEEDED:       16' in output, "Tasks did not run correctly!"
+    finally:
+        shutil.rmtree(name, ignore_errors=True)
+
+
+def test_run_broker(taskdb):
+    """make sure workers run tasks through a broker"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        for i in range(16):
+            db.add('echo %d' % i)
+
+    sock = os.path.abspath('test_broker.sock')
+    server = subprocess.Popen('exec cake serve %s --address %s' % (taskdb[0], sock), shell=True)
+    try:
+        subprocess.run('cake run --connect %s -n 4' % sock,
+                       shell=True,
+                       check=True,
+                       timeout=120)
+        output = subprocess.run('cake status %s' % taskdb[0],
+                                shell=True,
+                                check=True,
+                                stdout=subprocess.PIPE).stdout.decode('utf-8')
+        assert 'SUCCEEDED:       16' in output, "Tasks did not run correctly!"
+    finally:
+        server.terminate()
+        server.wait()
+    assert not os.path.exists(sock), "Broker did not clean up its socket!"
+
+
+def test_compact(taskdb):
+    """make sure finished tasks get archived"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        for i in range(16):
+            db.add('echo %d' % i)
+
+    subprocess.run('cake run %s' % taskdb[0],
+                   shell=True,
+                   check=True)
+    subprocess.run('cake compact %s' % taskdb[0],
+                   shell=True,
+                   check=True)
+    output = subprocess.run('cake status %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'SUCCEEDED:       0' in output, "Tasks did not get archived!"
+    assert '# of archived:   16' in output, "Tasks did not get archived!"
+
+    output = subprocess.run('cake runtime %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert '# of tasks SUCCEEDED: 16' in output, "Archived tasks are missing from the runtime!"
+
+
+def test_cleanup_expired(taskdb):
+    """make sure the tasks of a dead worker get reclaimed"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        for i in range(4):
+            db.add('echo %d' % i)
+
+    # a worker that never renews its leases
+    db = taskdb[1](name=taskdb[0], lease_time=0.2, heartbeat_interval=100.0)
+    db.checkout_many(2)
+    time.sleep(0.5)
+
+    output = subprocess.run('cake cleanup --expired %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'reclaimed 2 tasks' in output, "Expired tasks were not reclaimed!"
+
+    output = subprocess.run('cake status %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'KILLED:          2' in output, "Expired tasks were not marked as killed!"
+    db.close()
 
 
-@pytest.mark.parametrize("arg,num_tasks", [("", 1), ("-n 4", 4)])
+@pytest.mark.parametrize("arg,num_tasks", [("", 1), ("-n 4", 4), ("--async -n 4", 4),
+                                            ("--launcher forkserver", 1), ("-n 4 --launcher forkserver", 4),
+                                            ("--bundle 2", 2), ("-n 2 --bundle 2", 4)])
 def test_killed(taskdb, arg, num_tasks):
     """test to make sure tasks get marked as killed if interupted"""
 
@@ -115,8 +402,7 @@ def test_killed(taskdb, arg, num_tasks):
         for i in range(num_tasks):
             db.add('echo %d && sleep 10' % i)
 
-    proc = subprocess.Popen(['cake', 'run', '--stoptime', '0'] +
-                            ([arg, taskdb[0]] if len(arg) > 0 else [taskdb[0]]))
+    proc = subprocess.Popen(['cake', 'run', '--stoptime', '0'] + arg.split() + [taskdb[0]])
     time.sleep(2)
     proc.terminate()
     proc.wait()
@@ -124,10 +410,10 @@ def test_killed(taskdb, arg, num_tasks):
                             shell=True,
                             check=True,
                             stdout=subprocess.PIPE).stdout.decode('utf-8')
-    assert 'KILLED:        %d' % num_tasks in output, "Tasks were not killed correctly!"
+    assert 'KILLED:          %d' % num_tasks in output, "Tasks were not killed correctly!"
 
 
-@pytest.mark.parametrize("arg,num_tasks", [("", 1), ("-n 4", 4)])
+@pytest.mark.parametrize("arg,num_tasks", [("", 1), ("-n 4", 4), ("--async -n 4", 4)])
 def test_pause(taskdb, arg, num_tasks):
     """test pausing"""
 
@@ -143,4 +429,4 @@ def test_pause(taskdb, arg, num_tasks):
                             shell=True,
                             check=True,
                             stdout=subprocess.PIPE).stdout.decode('utf-8')
-    assert 'SUCCEEDED:     %d' % num_tasks in output, "Tasks were not paused correctly!"
+    assert 'SUCCEEDED:       %d' % num_tasks in output, "Tasks were not paused correctly!"
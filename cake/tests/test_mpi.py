@@ -3,21 +3,23 @@ import time
 import subprocess
 import pytest
 
-from cake import SQLiteTaskDB
+from cake import SQLiteTaskDB, pycall
 
 
 @pytest.fixture(params=[SQLiteTaskDB])
 def taskdb(request):
     name = 'test.db'
-    try:
-        os.remove(name)
-    except Exception as e:
-        pass
+    for fname in [name, name + '-wal', name + '-shm']:
+        try:
+            os.remove(fname)
+        except Exception as e:
+            pass
     yield (name, request.param)
-    try:
-        os.remove(name)
-    except Exception as e:
-        pass
+    for fname in [name, name + '-wal', name + '-shm']:
+        try:
+            os.remove(fname)
+        except Exception as e:
+            pass
 
 
 def test_run_mpi(taskdb):
@@ -32,7 +34,62 @@ def test_run_mpi(taskdb):
                             shell=True,
                             check=True,
                             stdout=subprocess.PIPE).stdout.decode('utf-8')
-    assert 'SUCCEEDED:     16' in output, "Tasks did not run correctly!"
+    assert 'SUCCEEDED:       16' in output, "Tasks did not run correctly!"
+
+
+@pytest.mark.parametrize("arg", [["--sub-masters"], ["--group-size", "2"],
+                                 ["--group-size", "3", "--checkin-batch", "4"]])
+def test_run_mpi_sub_masters(taskdb, arg):
+    """make sure running through sub-masters works"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        for i in range(32):
+            db.add('echo %d' % i)
+        db.add('exit 3')
+
+    subprocess.run(['mpirun', '-np', '6', 'cake', 'run', '--mpi'] + arg + [taskdb[0]], check=True)
+    output = subprocess.run('cake status %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'SUCCEEDED:       32' in output, "Tasks did not run correctly!"
+    assert 'FAILED:          1' in output, "Tasks did not fail correctly!"
+
+
+@pytest.mark.parametrize("arg", [["--worker-prefetch", "0"], ["--worker-prefetch", "4"],
+                                 ["--worker-prefetch", "4", "--group-size", "2"]])
+def test_run_mpi_worker_prefetch(taskdb, arg):
+    """make sure running with tasks queued on the workers works"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        for i in range(32):
+            db.add('echo %d' % i)
+        db.add('exit 3')
+
+    subprocess.run(['mpirun', '-np', '5', 'cake', 'run', '--mpi'] + arg + [taskdb[0]], check=True)
+    output = subprocess.run('cake status %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'SUCCEEDED:       32' in output, "Tasks did not run correctly!"
+    assert 'FAILED:          1' in output, "Tasks did not fail correctly!"
+
+
+def test_run_mpi_pycall(taskdb):
+    """make sure tasks calling python functions run on the MPI workers"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        for i in range(8):
+            db.add(pycall('os.path:isdir', '/'))
+        db.add(pycall('sys:exit', 3))
+
+    subprocess.run(['mpirun', '-np', '4', 'cake', 'run', '--mpi', taskdb[0]], check=True)
+    output = subprocess.run('cake status %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'SUCCEEDED:       8' in output, "Tasks did not run correctly!"
+    assert 'FAILED:          1' in output, "Tasks did not fail correctly!"
 
 
 @pytest.mark.xfail
@@ -51,7 +108,7 @@ def test_killed(taskdb):
                             shell=True,
                             check=True,
                             stdout=subprocess.PIPE).stdout.decode('utf-8')
-    assert 'KILLED:        1' in output, "Tasks were not killed correctly!"
+    assert 'KILLED:          1' in output, "Tasks were not killed correctly!"
 
 
 def test_pause(taskdb):
@@ -69,4 +126,46 @@ def test_pause(taskdb):
                             shell=True,
                             check=True,
                             stdout=subprocess.PIPE).stdout.decode('utf-8')
-    assert 'SUCCEEDED:     4' in output, "Tasks were not paused correctly!"
+    assert 'SUCCEEDED:       4' in output, "Tasks were not paused correctly!"
+
+
+def test_pause_sub_masters(taskdb):
+    """test pausing with sub-masters"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        for i in range(8):
+            db.add('echo %d && sleep 5' % i)
+
+    # two sub-masters with one worker each, which each hold one more task than they run
+    proc = subprocess.Popen(['mpirun', '-np', '5', 'cake', 'run', '--mpi', '--group-size', '2', '--stoptime', '10',
+                             taskdb[0]])
+    time.sleep(2)
+    subprocess.run('cake pause %s' % taskdb[0], shell=True, check=True)
+    proc.wait()
+    output = subprocess.run('cake status %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'SUCCEEDED:       2' in output, "Tasks were not paused correctly!"
+    assert 'RUNNING:         0' in output, "Tasks were not paused correctly!"
+
+
+def test_pause_worker_prefetch(taskdb):
+    """test pausing with tasks queued on the workers"""
+
+    with taskdb[1](name=taskdb[0]) as db:
+        for i in range(8):
+            db.add('echo %d && sleep 5' % i)
+
+    # two workers, which each hold two more tasks than they run
+    proc = subprocess.Popen(['mpirun', '-np', '3', 'cake', 'run', '--mpi', '--worker-prefetch', '2', '--stoptime', '10',
+                             taskdb[0]])
+    time.sleep(2)
+    subprocess.run('cake pause %s' % taskdb[0], shell=True, check=True)
+    proc.wait()
+    output = subprocess.run('cake status %s' % taskdb[0],
+                            shell=True,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert 'SUCCEEDED:       2' in output, "Tasks were not paused correctly!"
+    assert 'RUNNING:         0' in output, "Tasks were not paused correctly!"
@@ -1,4 +1,7 @@
+import os
 import sys
+import csv
+import json
 import time
 import datetime
 
@@ -11,6 +14,76 @@ def diff_timestamps(start_time, end_time):
     return tdiff
 
 
+def filesystem_type(path):
+    """get the type of the filesystem path is on from /proc/mounts (None if it cannot be found)"""
+    path = os.path.realpath(path)
+    if not os.path.isdir(path):
+        path = os.path.dirname(path)
+
+    fstype = None
+    mount = None
+    try:
+        with open('/proc/mounts', 'r') as fp:
+            for line in fp:
+                items = line.split()
+                if len(items) < 3:
+                    continue
+                mnt = items[1].replace('\\040', ' ')
+                if (path == mnt or path.startswith(mnt.rstrip('/') + '/')) and \
+                        (mount is None or len(mnt) > len(mount)):
+                    mount = mnt
+                    fstype = items[2]
+    except (IOError, OSError):
+        pass
+
+    return fstype
+
+
+def read_tasks(fp, fmt='lines'):
+    """generate the tasks in the file object fp one at a time
+
+    fmt is one of
+        'lines' - one command per line
+        'csv' - CSV with a header naming the columns 'cmd' and optionally 'id', 'priority',
+                'group' and 'depends_on' (the IDs of the tasks it depends on separated by spaces)
+        'jsonl' - one JSON object per line with the keys 'cmd' and optionally 'id', 'priority',
+                  'group' and 'depends_on' (a list of task IDs)
+
+    Tasks with an id, priority, group or dependencies are generated as dicts and others as
+    command strings. Blank lines are skipped."""
+
+    if fmt == 'lines':
+        for line in fp:
+            tsk = line.strip()
+            if len(tsk) > 0:
+                yield tsk
+    elif fmt == 'csv':
+        reader = csv.DictReader(fp)
+        if reader.fieldnames is None or 'cmd' not in reader.fieldnames:
+            raise ValueError("CSV tasks need a header with a 'cmd' column!")
+        for row in reader:
+            tsk = {'cmd': row['cmd']}
+            if row.get('id'):
+                tsk['id'] = row['id']
+            if row.get('priority'):
+                tsk['priority'] = float(row['priority'])
+            if row.get('group'):
+                tsk['group'] = row['group']
+            if row.get('depends_on'):
+                tsk['depends_on'] = row['depends_on'].split()
+            yield tsk
+    elif fmt == 'jsonl':
+        for i, line in enumerate(fp):
+            if len(line.strip()) == 0:
+                continue
+            tsk = json.loads(line)
+            if not isinstance(tsk, dict) or 'cmd' not in tsk:
+                raise ValueError("JSON task on line %d does not have a 'cmd'!" % (i + 1))
+            yield tsk
+    else:
+        raise ValueError("Task format '%s' not recognized!" % fmt)
+
+
 def print_start(id, stime):
     """print cake starting info"""
     sys.stderr.write('================================================================================'
@@ -34,3 +107,14 @@ CAKE: state %s
        etime - stime,
        state))
     sys.stderr.flush()
+
+
+def print_slot_usage(n, elapsed, idle):
+    """print how much of the time the n task slots of a worker were idle"""
+    total = n * elapsed
+    sys.stderr.write("""
+CAKE: slots %d
+CAKE: run   %gs
+CAKE: idle  %gs (%.1f%% of the slot time)
+""" % (n, elapsed, idle, 100.0 * idle / total if total > 0 else 0.0))
+    sys.stderr.flush()
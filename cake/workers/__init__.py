@@ -1,4 +1,5 @@
 # flake8: noqa
 from .serialworker import SerialWorker
 from .pmpworker import PMPWorker
+from .asyncworker import AsyncWorker
 from .base import BaseWorker
@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import signal
+import asyncio
+import functools
+import collections
+import concurrent.futures
+import numpy as np
+
+from .base import BaseWorker
+from ..defaults import TASKDB_STATES, TASK_STATES
+from ..launcher import split_command
+from ..pycall import command
+from ..utils import print_start, print_end
+
+
+def _watch_children(loop):
+    """wait on the task processes with pidfds where possible
+
+    Before python 3.12 asyncio waits on each child from a thread of its own by default,
+    which would cost a thread for every running task."""
+    if sys.version_info >= (3, 12) or not hasattr(asyncio, 'PidfdChildWatcher') or not hasattr(os, 'pidfd_open'):
+        return
+
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError as e:
+        return
+
+    watcher = asyncio.PidfdChildWatcher()
+    asyncio.set_child_watcher(watcher)
+    watcher.attach_loop(loop)
+
+
+class AsyncWorker(BaseWorker):
+    """run up to n tasks at once from a single process with asyncio
+
+    Each task is a shell run as an asyncio subprocess in its own process group, so no
+    python process is kept per task. The task DB is used from one background thread,
+    with the next tasks checked out and the results checked in while tasks run."""
+
+    def __init__(self, **conf):
+        assert 'taskdb_conf' in conf, "The TaskDB config must be given!"
+        assert 'taskdb_class' in conf, "The TaskDB class must be given!"
+        assert 'n' in conf, "The number of tasks to run at once must be given!"
+
+        # sqlite connections belong to the thread that makes them, so the DB is made,
+        # used and closed on the thread of the executor
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='cake-taskdb')
+        self._taskdb = self._executor.submit(
+            functools.partial(conf['taskdb_class'], **conf['taskdb_conf'])).result()
+
+        self._conf = {}
+        self._conf.update(conf)
+        self._set_defaults()
+
+    def _set_defaults(self):
+        self._conf['runtime'] = self._conf.get('runtime', np.inf)
+        self._conf['stoptime'] = self._conf.get('stoptime', 5.0*60.0)
+        self._conf['prefetch'] = self._conf.get('prefetch', max(self._conf['n'] // 8, 1))
+        self._conf['checkin_batch'] = self._conf.get('checkin_batch', 1)
+        self._conf['checkin_interval'] = self._conf.get('checkin_interval', 0.0)
+        self._conf['state_interval'] = self._conf.get('state_interval', 1.0)
+        self._conf['launcher'] = self._conf.get('launcher', 'spawn')
+        self._left_frac = 0.5
+
+    def close(self):
+        self._executor.submit(self._taskdb.close).result()
+        self._executor.shutdown()
+
+    def _db(self, func, *args, **kwargs):
+        """run func on the task DB thread, returning an asyncio future of the result"""
+        return asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _run_task(self, tsk, id, silent):
+        stime = time.time()
+        if not silent:
+            print_start(id, stime)
+
+        # commands without shell syntax are exec'ed directly unless the shell launcher is asked for
+        tsk = command(tsk)
+        proc = None
+        argv = split_command(tsk) if self._conf['launcher'] != 'shell' else None
+        if argv is not None:
+            try:
+                proc = await asyncio.create_subprocess_exec(*argv, start_new_session=True)
+            except OSError as e:
+                pass
+        if proc is None:
+            proc = await asyncio.create_subprocess_shell(tsk, start_new_session=True)
+        self._procs[id] = (proc, stime)
+        try:
+            err = await proc.wait()
+        finally:
+            del self._procs[id]
+        etime = time.time()
+
+        if err != 0:
+            checkin_state = TASK_STATES.FAILED
+            info = str(err)
+        else:
+            checkin_state = TASK_STATES.SUCCEEDED
+            info = ''
+
+        if not silent:
+            print_end(id, stime, etime, checkin_state)
+
+        return id, checkin_state, info
+
+    def _kill_tasks(self, silent):
+        """kill the running tasks, returning their results"""
+        results = []
+        for id, (proc, stime) in list(self._procs.items()):
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError as e:
+                pass
+            if not silent:
+                print_end(id, stime, time.time(), TASK_STATES.KILLED)
+            results.append((id, TASK_STATES.KILLED, ''))
+        return results
+
+    def run(self, state=None, silent=False):
+        """run a task db"""
+        asyncio.run(self._run(state=state, silent=silent))
+
+    async def _run(self, state=None, silent=False):
+        loop = asyncio.get_running_loop()
+        _watch_children(loop)
+
+        interrupted = asyncio.Event()
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            loop.add_signal_handler(signum, interrupted.set)
+        interrupt = asyncio.ensure_future(interrupted.wait())
+
+        await self._db(self._taskdb.run)
+
+        self._procs = {}
+        self._start_time = time.time()
+        running = set()
+        prefetched = collections.deque()
+        results = []
+        results_time = None
+        checkout = None
+        checkins = []
+        state_check = None
+        state_time = time.time()
+        exhausted = False
+        paused = False
+
+        while not interrupted.is_set():
+            elapsed = time.time() - self._start_time
+            stopping = paused or elapsed >= self._conf['runtime'] - self._conf['stoptime']
+
+            if elapsed >= self._conf['runtime'] - self._conf['stoptime'] * self._left_frac:
+                break
+
+            # start tasks in every free slot
+            while not stopping and len(running) < self._conf['n'] and len(prefetched) > 0:
+                tsk, id = prefetched.popleft()
+                running.add(asyncio.ensure_future(self._run_task(tsk, id, silent)))
+
+            # keep enough tasks checked out to fill the slots freed while the next checkout runs
+            num = self._conf['n'] - len(running) + self._conf['prefetch'] - len(prefetched)
+            if not stopping and not exhausted and checkout is None and num > 0:
+                checkout = self._db(self._taskdb.checkout_many, num, state=state)
+
+            if state_check is None and time.time() - state_time >= self._conf['state_interval']:
+                state_check = self._db(self._taskdb.state)
+
+            # write the results back once the batch is full or old enough, or when nothing else is running
+            if len(results) > 0 and (len(results) >= self._conf['checkin_batch'] or len(running) == 0 or
+                                     time.time() - results_time >= self._conf['checkin_interval']):
+                checkins.append(self._db(self._taskdb.checkin_many, results))
+                results = []
+
+            if len(running) == 0 and checkout is None and len(checkins) == 0 and \
+                    (stopping or (exhausted and len(prefetched) == 0)):
+                break
+
+            waiting = running | set(checkins) | set(f for f in [checkout, state_check, interrupt] if f is not None)
+            if len(results) > 0:
+                timeout = max(self._conf['checkin_interval'] - (time.time() - results_time), 0.0)
+            else:
+                timeout = self._conf['state_interval']
+            done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for fut in done:
+                if fut in running:
+                    running.remove(fut)
+                    if len(results) == 0:
+                        results_time = time.time()
+                    results.append(fut.result())
+                elif fut is checkout:
+                    tasks = checkout.result()
+                    checkout = None
+                    prefetched.extend(tasks)
+                    if len(tasks) == 0:
+                        exhausted = True
+                elif fut is state_check:
+                    paused = state_check.result() == TASKDB_STATES.PAUSED
+                    state_check = None
+                    state_time = time.time()
+                elif fut in checkins:
+                    checkins.remove(fut)
+                    fut.result()
+                    # the tasks that depend on the tasks checked in may be ready to run now
+                    exhausted = False
+
+        # everything not finished by now is handed back to the DB as KILLED
+        interrupt.cancel()
+        if checkout is not None:
+            prefetched.extend(await checkout)
+        results.extend(self._kill_tasks(silent))
+        for fut in running:
+            fut.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        results.extend((id, TASK_STATES.KILLED, '') for _, id in prefetched)
+        for fut in checkins:
+            await fut
+        if state_check is not None:
+            await state_check
+        if len(results) > 0:
+            await self._db(self._taskdb.checkin_many, results)
@@ -0,0 +1,55 @@
+import time
+
+
+class CheckinBuffer(object):
+    """write-behind buffer for checking in task results
+
+    Results are sent to the task DB with a single `checkin_many` call once `size`
+    results are buffered or `interval` seconds have passed since the oldest buffered
+    result. The defaults check in every result as soon as it is added."""
+
+    def __init__(self, taskdb, size=1, interval=0.0):
+        self._taskdb = taskdb
+        self._size = max(size, 1)
+        self._interval = interval
+        self._results = []
+        self._start_time = None
+
+    def __len__(self):
+        return len(self._results)
+
+    def add(self, task_id, state, info=''):
+        """buffer the result of a task, flushing the buffer if it is full or stale"""
+        if len(self._results) == 0:
+            self._start_time = time.time()
+        self._results.append((task_id, state, info))
+        self.poll()
+
+    def time_left(self):
+        """seconds until the buffer goes stale (None if it is empty)"""
+        if len(self._results) == 0:
+            return None
+        return max(self._interval - (time.time() - self._start_time), 0.0)
+
+    def add_many(self, results):
+        """buffer the (task_id, state, info) results of several tasks, flushing the buffer if it is full or stale"""
+        if len(results) == 0:
+            return
+        if len(self._results) == 0:
+            self._start_time = time.time()
+        self._results.extend(results)
+        self.poll()
+
+    def poll(self):
+        """flush the buffer if it is full or stale"""
+        if len(self._results) > 0 and (len(self._results) >= self._size or
+                                       time.time() - self._start_time >= self._interval):
+            self.flush()
+
+    def flush(self):
+        """checkin all buffered results"""
+        if len(self._results) > 0:
+            # results are only dropped once the DB has them so that an interrupted
+            # flush can be redone from a signal handler
+            self._taskdb.checkin_many(self._results)
+            self._results = []
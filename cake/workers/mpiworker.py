@@ -2,16 +2,22 @@ import sys
 import signal
 import numpy as np
 import time
-import subprocess
+import collections
 from mpi4py import MPI
 
 from .base import BaseWorker
+from .buffer import CheckinBuffer
 from ..defaults import TASKDB_STATES, TASK_STATES
+from ..launcher import get_launcher
+from ..pycall import is_pycall, run_pycall
 from ..utils import print_start, print_end
 
 _comm = None
-_task_infos = []
+# the tasks given out by the master by id, with their start times and whether they are silent
+_task_infos = {}
+_prefetched = []
 _taskdb = None
+_checkin_buffer = None
 
 # tags
 STOP_WORK = 10
@@ -29,16 +35,39 @@ def _worker_signal_handler(signal, frame):
 
 def _master_signal_handler(signal, frame):
     if _taskdb is not None:
-        for _task_info in _task_infos:
-            print(_task_info, flush=True)
-            if not _task_info[2]:
+        if _checkin_buffer is not None:
+            _checkin_buffer.flush()
+
+        results = []
+        for id, (stime, silent) in _task_infos.items():
+            if not silent:
                 etime = time.time()
-                print_end(_task_info[0], _task_info[1], etime, TASK_STATES.KILLED)
-            _taskdb.checkin(_task_info[0], TASK_STATES.KILLED)
+                print_end(id, stime, etime, TASK_STATES.KILLED)
+            results.append((id, TASK_STATES.KILLED, ''))
+
+        # tasks that were prefetched but never sent to a worker
+        for _, id in _prefetched:
+            results.append((id, TASK_STATES.KILLED, ''))
+
+        _taskdb.checkin_many(results)
     sys.exit(0)
 
 
 class MPIWorker(BaseWorker):
+    """run tasks on a set of MPI ranks, with rank 0 handing them out from the task DB
+
+    Each rank keeps up to worker_prefetch tasks queued besides the one it runs. It asks
+    for more before starting a task once half of its queue is used, sending the results
+    of its tasks so far with the request, so that the next tasks arrive while it runs.
+    An empty batch of tasks means there are no more. Every rank gets exactly one STOP_WORK,
+    the last message sent to it, either to stop right away or once it has sent its last
+    results, and it carries the number of batches sent before it so that all are taken in.
+
+    With sub_masters set, the other ranks are split into groups, one per node or of
+    group_size ranks each. The first rank of each group is a sub-master that gets tasks
+    from rank 0 in batches, hands them to the other ranks of its group and sends their
+    results back with its next request, so rank 0 only talks to the sub-masters."""
+
     def __init__(self, **conf):
         self._conf = {}
         self._conf.update(conf)
@@ -49,6 +78,13 @@ class MPIWorker(BaseWorker):
         else:
             self._init_mpi_worker()
 
+        if self._conf['sub_masters']:
+            self._init_mpi_groups()
+
+        # buffer one task for each worker rank by default
+        if self._conf['prefetch'] is None:
+            self._conf['prefetch'] = max(self._size - 1, 1)
+
         if self._rank == 0:
             assert 'taskdb_conf' in conf, "The TaskDB config must be given to MPI worker!"
             assert 'taskdb_class' in conf, "The TaskDB class must be given to MPI worker!"
@@ -59,8 +95,27 @@ class MPIWorker(BaseWorker):
         self._conf['spawn_master'] = self._conf.get('spawn_master', False)
         self._conf['master'] = self._conf.get('master', False)
         self._conf['stoptime'] = self._conf.get('stoptime', 5.0 * 60.0)
+        self._conf['prefetch'] = self._conf.get('prefetch', None)
+        self._conf['checkin_batch'] = self._conf.get('checkin_batch', 1)
+        self._conf['checkin_interval'] = self._conf.get('checkin_interval', 0.0)
+        self._conf['launcher'] = self._conf.get('launcher', 'spawn')
+        self._conf['sub_masters'] = self._conf.get('sub_masters', False)
+        self._conf['group_size'] = self._conf.get('group_size', None)
+        self._conf['state_interval'] = self._conf.get('state_interval', 1.0)
+        self._conf['worker_prefetch'] = self._conf.get('worker_prefetch', 1)
+        self._conf['poll_interval'] = self._conf.get('poll_interval', 0.001)
         self._left_frac = 0.5
 
+    def _next_tasks(self, num, state=None):
+        """get up to num tasks, refilling the prefetch buffer from the DB as needed"""
+        if len(_prefetched) < num:
+            _prefetched.extend(self._taskdb.checkout_many(max(num - len(_prefetched), self._conf['prefetch']),
+                                                          state=state))
+
+        tasks = _prefetched[:num]
+        del _prefetched[:num]
+        return tasks
+
     def close(self):
         for comm in self._comms:
             comm.Disconnect()
@@ -103,118 +158,343 @@ class MPIWorker(BaseWorker):
         self._rank = self._comm.Get_rank()
         self._size = self._comm.Get_size()
 
+    def _init_mpi_groups(self):
+        # the ranks other than the master are split into groups, whose first ranks are the
+        # sub-masters and make up the communicator of the master with them
+        rest = self._comm.Split(0 if self._rank == 0 else 1, self._rank)
+        if self._rank == 0:
+            self._group = None
+        elif self._conf['group_size'] is not None:
+            self._group = rest.Split(rest.Get_rank() // self._conf['group_size'], rest.Get_rank())
+        else:
+            self._group = rest.Split_type(MPI.COMM_TYPE_SHARED, key=rest.Get_rank())
+
+        sub_master = self._rank == 0 or self._group.Get_rank() == 0
+        self._top = self._comm.Split(0 if sub_master else MPI.UNDEFINED, self._rank)
+
+        # workers talk to their sub-master and sub-masters to the master
+        global _comm
+        if self._rank != 0:
+            _comm = self._top if self._group.Get_rank() == 0 else self._group
+
     def run(self, state=None, silent=False):
         """run a task db"""
         if self._rank == 0:
-            self._run_master(state=state, silent=silent)
+            self._run_master(self._top if self._conf['sub_masters'] else self._comm, state=state, silent=silent)
+        elif self._conf['sub_masters'] and self._group.Get_rank() == 0:
+            self._run_sub_master()
         else:
             self._run_worker(silent=silent)
 
+    def _reply(self, comm, tasks, dest):
+        """send tasks without waiting on dest, which may be running a task before it reads them"""
+        self._sends = [req for req in self._sends if not req.Test()]
+        self._sends.append(comm.isend(tasks, dest=dest, tag=RECV_WORK))
+        self._num_sent[dest] += 1
+
+    def _stop(self, comm, dest):
+        """send dest its STOP_WORK, unless it has had it already"""
+        if dest in self._stopped:
+            return
+        self._stopped.add(dest)
+        self._sends.append(comm.Isend([np.array([self._num_sent[dest]], dtype=np.int64), MPI.INT64_T],
+                                      dest=dest, tag=STOP_WORK))
+
+    def _post_stop(self, comm):
+        """post the receive of the STOP_WORK from rank 0 of comm, returning it and its buffer"""
+        # a posted receive is tested reliably, while a probe may miss a message that arrived during a long task
+        buf = np.zeros(1, dtype=np.int64)
+        return comm.Irecv([buf, MPI.INT64_T], source=0, tag=STOP_WORK), buf
+
+    def _recv_rest(self, comm, num_sent, num_recv):
+        """take in the batches of tasks sent before the STOP_WORK and not received yet"""
+        tasks = []
+        for i in range(num_recv, num_sent):
+            tasks.extend(comm.recv(source=0, tag=RECV_WORK))
+        return tasks
+
+    def _probe(self, comms, status, timeout=np.inf, stop=None):
+        """wait up to timeout seconds for a message on any of comms or for the request stop,
+        returning that comm or request or None
+
+        The sleeps between probes grow up to poll_interval, so that a rank waiting on its
+        ranks does not keep a core busy."""
+        delay = 0.0
+        end_time = time.time() + timeout
+        while True:
+            if stop is not None and stop.Test():
+                return stop
+            for comm in comms:
+                if comm.Iprobe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status):
+                    return comm
+            if time.time() >= end_time:
+                return None
+            time.sleep(delay)
+            delay = min(2.0 * delay + 1e-5, self._conf['poll_interval'])
+
     def _run_worker(self, silent=False):
         signal.signal(signal.SIGTERM, _worker_signal_handler)
         signal.signal(signal.SIGINT, _worker_signal_handler)
 
+        comm = self._group if self._conf['sub_masters'] else self._comm
+        launcher = get_launcher(self._conf['launcher'])
+        depth = self._conf['worker_prefetch']
+        tasks = collections.deque()
+        results = []
+        unstarted = []
+        asked = False
+        finished = False
+        stop_now = False
         status = MPI.Status()
-        while True:
-            self._comm.send(-1, dest=0, tag=READY_WORKER)
-            res = self._comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
-            tag = status.Get_tag()
+        stop, stop_buf = self._post_stop(comm)
+        num_recv = 0
+
+        def _ask(num):
+            comm.send((num, results[:]), dest=0, tag=READY_WORKER)
+            results.clear()
+            return True
 
-            if tag == STOP_WORK:
+        while True:
+            # take the tasks asked for and any order to stop, only waiting once there is nothing else to run
+            got = self._probe([comm], status, timeout=np.inf if asked and len(tasks) == 0 else 0.0, stop=stop)
+            if got is stop:
+                # stop right away, handing back the tasks not started yet
+                finished = stop_now = True
+                tasks.extend(self._recv_rest(comm, stop_buf[0], num_recv))
+                unstarted.extend(id for _, id in tasks)
+                tasks.clear()
                 break
-            elif tag == RECV_WORK:
-                tsk, id = res
+            elif got is not None:
+                res = comm.recv(source=0, tag=RECV_WORK)
+                num_recv += 1
+                asked = False
+                finished = finished or len(res) == 0
+                tasks.extend(res)
+                continue
+
+            # an idle rank asks for one task to start on, so that the first tasks are spread over all of the ranks
+            if len(tasks) == 0:
+                if finished:
+                    break
+                asked = _ask(1)
+                continue
+
+            # ask for the next tasks before running this one, so that they arrive while it runs
+            tsk, id = tasks.popleft()
+            if not asked and not finished and depth > 0 and len(tasks) <= depth // 2:
+                asked = _ask(depth - len(tasks))
 
-                if not silent:
-                    stime = time.time()
-                    print_start(id, stime)
+            if not silent:
+                stime = time.time()
+                print_start(id, stime)
 
-                err = subprocess.call(tsk, shell=True)
+            # python functions are called right here so that their modules stay imported
+            if is_pycall(tsk):
+                err = run_pycall(tsk)
+            else:
+                err = launcher(tsk)
 
-                if not silent:
-                    etime = time.time()
-                    if err != 0:
-                        print_end(id, stime, etime, TASK_STATES.FAILED)
-                    else:
-                        print_end(id, stime, etime, TASK_STATES.SUCCEEDED)
+            if not silent:
+                etime = time.time()
+                if err != 0:
+                    print_end(id, stime, etime, TASK_STATES.FAILED)
+                else:
+                    print_end(id, stime, etime, TASK_STATES.SUCCEEDED)
 
-                self._comm.send((err, id), dest=0, tag=RESULTS_WORKER)
+            results.append((err, id))
 
-    def _run_master(self, state=None, silent=False):
+            # with no more tasks to ask for, the results go back on their own
+            if finished and len(tasks) > 0:
+                _ask(0)
+
+        launcher.close()
+        comm.send((results, unstarted), dest=0, tag=RESULTS_WORKER)
+        if not stop_now:
+            stop.Wait()
+
+    def _kill_rest(self):
+        """check in the tasks given out and not finished, and those never given out, as KILLED"""
+        for id, (stime, silent) in _task_infos.items():
+            if not silent:
+                etime = time.time()
+                print_end(id, stime, etime, TASK_STATES.KILLED)
+            _checkin_buffer.add(id, TASK_STATES.KILLED)
+        _task_infos.clear()
+
+        # tasks that were prefetched but never sent to a worker
+        while len(_prefetched) > 0:
+            _, id = _prefetched.pop(0)
+            _checkin_buffer.add(id, TASK_STATES.KILLED)
+
+        _checkin_buffer.flush()
+
+    def _checkin_results(self, results):
+        checkins = []
+        for err, id in results:
+            del _task_infos[id]
+            if err != 0:
+                checkins.append((id, TASK_STATES.FAILED, str(err)))
+            else:
+                checkins.append((id, TASK_STATES.SUCCEEDED, ''))
+        _checkin_buffer.add_many(checkins)
+
+    def _run_master(self, comm, state=None, silent=False):
+        """hand out tasks to the other ranks of comm, which are workers or sub-masters"""
         signal.signal(signal.SIGTERM, _master_signal_handler)
         signal.signal(signal.SIGINT, _master_signal_handler)
 
         global _taskdb
+        global _checkin_buffer
         _taskdb = self._taskdb
+        _checkin_buffer = CheckinBuffer(self._taskdb,
+                                        size=self._conf['checkin_batch'],
+                                        interval=self._conf['checkin_interval'])
 
-        # init db, time, etc.
         self._taskdb.run()
-        global _task_infos
         self._start_time = time.time()
         status = MPI.Status()
-
-        # do work
-        while time.time() - self._start_time < self._conf['runtime'] - self._conf['stoptime']:
-            if self._taskdb.state() == TASKDB_STATES.PAUSED:
-                break
-
-            res = self._comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+        self._sends = []
+        self._num_sent = collections.Counter()
+        self._stopped = set()
+
+        ranks = set(range(1, comm.Get_size()))
+        done = set()
+        stopping = False
+        state_time = None
+        while (len(done) < len(ranks) and
+               time.time() - self._start_time < self._conf['runtime'] - self._conf['stoptime'] * self._left_frac):
+            if not stopping:
+                if time.time() - self._start_time >= self._conf['runtime'] - self._conf['stoptime']:
+                    stopping = True
+                elif state_time is None or time.time() - state_time >= self._conf['state_interval']:
+                    state_time = time.time()
+                    stopping = self._taskdb.state() == TASKDB_STATES.PAUSED
+
+                # tell the ranks right away, before they start the tasks queued on them
+                if stopping:
+                    for rank in ranks - done:
+                        self._stop(comm, rank)
+
+            if self._probe([comm], status, timeout=self._conf['state_interval']) is None:
+                continue
+            res = comm.recv(source=status.Get_source(), tag=status.Get_tag(), status=status)
             tag = status.Get_tag()
-            worker = status.Get_source()
+            rank = status.Get_source()
 
             if tag == READY_WORKER:
-                tsk, id = self._taskdb.checkout(state=state)
-                if tsk is None:
-                    break
-
-                _task_infos.append((id, time.time(), silent))
-                self._comm.send((tsk, id), dest=worker, tag=RECV_WORK)
+                # a rank asking for num tasks (or none), with the results of its tasks so far
+                num, results = res
+                self._checkin_results(results)
+
+                # the STOP_WORK a stopped rank got answers its request
+                if num > 0 and rank not in self._stopped:
+                    # no tasks tells the rank to finish the ones it has
+                    tasks = self._next_tasks(num, state=state)
+                    for _, id in tasks:
+                        _task_infos[id] = (time.time(), silent)
+                    self._reply(comm, tasks, rank)
             elif tag == RESULTS_WORKER:
-                err, id = res
-                for _i in range(len(_task_infos)):
-                    if _task_infos[_i][0] == id:
-                        break
-                del _task_infos[_i]
-
-                if err != 0:
-                    checkin_state = TASK_STATES.FAILED
-                    info = str(err)
-                else:
-                    checkin_state = TASK_STATES.SUCCEEDED
-                    info = ''
-
-                self._taskdb.checkin(id, checkin_state, info=info)
+                # the last results of a rank and the ids of the tasks it did not start
+                results, unstarted = res
+                self._checkin_results(results)
+                for id in unstarted:
+                    del _task_infos[id]
+                    _checkin_buffer.add(id, TASK_STATES.KILLED)
+                done.add(rank)
+                self._stop(comm, rank)
+            elif tag == KILLED_WORKER:
+                done.add(rank)
+                self._stopped.add(rank)
+
+            _checkin_buffer.poll()
+
+        # the ranks were not told to stop if the runtime was up before the first look at it
+        for rank in ranks:
+            self._stop(comm, rank)
+
+        _checkin_buffer.flush()
+        self._kill_rest()
+        MPI.Request.Waitall(self._sends)
+
+    def _run_sub_master(self):
+        signal.signal(signal.SIGTERM, _worker_signal_handler)
+        signal.signal(signal.SIGINT, _worker_signal_handler)
 
-        # get rest of results
-        while (len(_task_infos) > 0 and
-               time.time() - self._start_time < self._conf['runtime'] - self._conf['stoptime'] * self._left_frac):
-            res = self._comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+        workers = set(range(1, self._group.Get_size()))
+        size = len(workers) * (self._conf['worker_prefetch'] + 1)
+        tasks = collections.deque()
+        unstarted = []
+        results = []
+        waiting = collections.OrderedDict()
+        done = set()
+        asked = False
+        finished = len(workers) == 0
+        stop_now = False
+        status = MPI.Status()
+        stop, stop_buf = self._post_stop(self._top)
+        num_recv = 0
+        self._sends = []
+        self._num_sent = collections.Counter()
+        self._stopped = set()
+
+        while len(done) < len(workers):
+            # ask for more tasks once half of the queue is handed out, sending the results so far
+            if not asked and not finished and len(tasks) <= size // 2:
+                self._top.send((size - len(tasks), results), dest=0, tag=READY_WORKER)
+                results = []
+                asked = True
+            elif len(results) >= len(workers) or (finished and len(results) > 0):
+                self._top.send((0, results), dest=0, tag=READY_WORKER)
+                results = []
+
+            # hand out the tasks to the workers waiting on them, or tell them there are none left
+            for worker in list(waiting):
+                if len(tasks) > 0:
+                    num = min(waiting.pop(worker), len(tasks))
+                    self._reply(self._group, [tasks.popleft() for _ in range(num)], worker)
+                elif finished:
+                    del waiting[worker]
+                    self._reply(self._group, [], worker)
+
+            comm = self._probe([self._group, self._top], status, stop=None if stop_now else stop)
+            if comm is stop:
+                # stop the workers right away, handing back the tasks not handed out
+                finished = stop_now = True
+                asked = False
+                tasks.extend(self._recv_rest(self._top, stop_buf[0], num_recv))
+                unstarted.extend(id for _, id in tasks)
+                tasks.clear()
+                waiting.clear()
+                for worker in workers - done:
+                    self._stop(self._group, worker)
+                continue
+
+            res = comm.recv(source=status.Get_source(), tag=status.Get_tag(), status=status)
             tag = status.Get_tag()
-            worker = status.Get_source()
-
-            if tag == RESULTS_WORKER:
-                err, id = res
-                for _i in range(len(_task_infos)):
-                    if _task_infos[_i][0] == id:
-                        break
-                del _task_infos[_i]
-
-                if err != 0:
-                    checkin_state = TASK_STATES.FAILED
-                    info = str(err)
-                else:
-                    checkin_state = TASK_STATES.SUCCEEDED
-                    info = ''
-
-                self._taskdb.checkin(id, checkin_state, info=info)
-
-        # stop workers
-        for worker in range(1, self._size):
-            self._comm.send(-1, dest=worker, tag=STOP_WORK)
-
-        # mark rest as failed
-        for _task_info in _task_infos:
-            if not _task_info[2]:
-                etime = time.time()
-                print_end(_task_info[0], _task_info[1], etime, TASK_STATES.KILLED)
-            _taskdb.checkin(_task_info[0], TASK_STATES.KILLED)
+            if comm is self._top:
+                num_recv += 1
+                asked = False
+                finished = finished or len(res) == 0
+                tasks.extend(res)
+            elif tag == READY_WORKER:
+                num, worker_results = res
+                results.extend(worker_results)
+                if num > 0 and status.Get_source() not in self._stopped:
+                    waiting[status.Get_source()] = num
+            elif tag == RESULTS_WORKER:
+                worker_results, worker_unstarted = res
+                results.extend(worker_results)
+                unstarted.extend(worker_unstarted)
+                done.add(status.Get_source())
+                self._stop(self._group, status.Get_source())
+            elif tag == KILLED_WORKER:
+                done.add(status.Get_source())
+                self._stopped.add(status.Get_source())
+
+        unstarted.extend(id for _, id in tasks)
+        self._top.send((results, unstarted), dest=0, tag=RESULTS_WORKER)
+        if not stop_now:
+            stop.Wait()
+            # only left if all of the workers were killed while the sub-master was waiting on tasks
+            self._recv_rest(self._top, stop_buf[0], num_recv)
+        MPI.Request.Waitall(self._sends)
@@ -1,17 +1,25 @@
 import sys
+import queue
 import signal
 import numpy as np
 import time
-import subprocess
+import functools
 import multiprocessing
 
 from .base import BaseWorker
+from .buffer import CheckinBuffer
 from ..defaults import TASKDB_STATES, TASK_STATES
-from ..utils import print_start, print_end
+from ..launcher import get_launcher, run_bundle
+from ..pycall import command, is_pycall, run_pycall
+from ..utils import print_start, print_end, print_slot_usage
 
-_task_infos = []
+# the tasks running in the pool by id, with their start times and whether they are silent
+_task_infos = {}
+_prefetched = []
 _taskdb = None
 _pool = None
+_checkin_buffer = None
+_launcher = None
 
 
 def _signal_handler(signal, frame):
@@ -20,33 +28,82 @@ def _signal_handler(signal, frame):
         _pool.join()
 
     if _taskdb is not None:
-        for _task_info in _task_infos:
-            if not _task_info[2]:
+        if _checkin_buffer is not None:
+            _checkin_buffer.flush()
+
+        results = []
+        for id, (stime, silent) in _task_infos.items():
+            if not silent:
                 etime = time.time()
-                print_end(_task_info[0], _task_info[1], etime, TASK_STATES.KILLED)
-            _taskdb.checkin(_task_info[0], TASK_STATES.KILLED)
+                print_end(id, stime, etime, TASK_STATES.KILLED)
+            results.append((id, TASK_STATES.KILLED, ''))
+
+        # tasks that were prefetched but never started
+        for _, id in _prefetched:
+            results.append((id, TASK_STATES.KILLED, ''))
+
+        _taskdb.checkin_many(results)
 
     sys.exit(0)
 
 
-def _run_work(tsk, id, silent):
+def _init_pool_process(launcher):
+    # pool processes are forked after the master installs _signal_handler, so undo it
+    # here and leave all of the cleanup to the master
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    global _launcher
+    _launcher = launcher
+
+
+def _print_end(id, stime, etime, err):
+    if err != 0:
+        print_end(id, stime, etime, TASK_STATES.FAILED)
+    else:
+        print_end(id, stime, etime, TASK_STATES.SUCCEEDED)
+
+
+def _run_work(tasks, silent):
+    """run the (tsk, id) tasks, in one shell session if there are more than one"""
+    if len(tasks) > 1:
+        ids = [id for _, id in tasks]
+        tsks = [command(tsk) for tsk, _ in tasks]
+        if silent:
+            results = run_bundle(tsks)
+        else:
+            results = run_bundle(tsks,
+                                 started=lambda i, stime: print_start(ids[i], stime),
+                                 ended=lambda i, err, stime, etime: _print_end(ids[i], stime, etime, err))
+        return [(id, err) for id, (err, _, _) in zip(ids, results)]
+
+    tsk, id = tasks[0]
     stime = time.time()
     if not silent:
         print_start(id, stime)
 
-    err = subprocess.run(tsk, shell=True).returncode
+    # python functions are called right here so that their modules stay imported
+    if is_pycall(tsk):
+        err = run_pycall(tsk)
+    else:
+        err = _launcher(tsk)
     etime = time.time()
 
     if not silent:
-        if err != 0:
-            print_end(id, stime, etime, TASK_STATES.FAILED)
-        else:
-            print_end(id, stime, etime, TASK_STATES.SUCCEEDED)
+        _print_end(id, stime, etime, err)
 
-    return id, err
+    return [(id, err)]
 
 
 class PMPWorker(BaseWorker):
+    """run up to n tasks at once in a multiprocessing pool
+
+    The pool reports each finished task through a callback, so its slot is refilled as
+    soon as it is free. The time the slots spend idle is kept in idle_time. With bundle
+    set above 1, each slot runs that many tasks at a time in one shell session. Python
+    function tasks run in the pool processes, which are replaced after max_tasks_per_child
+    tasks (or bundles) if it is set."""
+
     def __init__(self, **conf):
         super().__init__(**conf)
         assert 'n' in conf, "The number pool members must be given!"
@@ -54,8 +111,80 @@ class PMPWorker(BaseWorker):
     def _set_defaults(self):
         self._conf['runtime'] = self._conf.get('runtime', np.inf)
         self._conf['stoptime'] = self._conf.get('stoptime', 5.0*60.0)
+        self._conf['bundle'] = self._conf.get('bundle', 1)
+        self._conf['prefetch'] = self._conf.get('prefetch', self._conf.get('n', 1) * self._conf['bundle'])
+        self._conf['checkin_batch'] = self._conf.get('checkin_batch', 1)
+        self._conf['checkin_interval'] = self._conf.get('checkin_interval', 0.0)
+        self._conf['state_interval'] = self._conf.get('state_interval', 1.0)
+        self._conf['launcher'] = self._conf.get('launcher', 'spawn')
+        self._conf['max_tasks_per_child'] = self._conf.get('max_tasks_per_child', None)
         self._left_frac = 0.5
 
+    def _next_task(self, state=None):
+        """get the next task, refilling the prefetch buffer from the DB as needed"""
+        if len(_prefetched) == 0:
+            _prefetched.extend(self._taskdb.checkout_many(self._conf['prefetch'], state=state))
+
+        if len(_prefetched) == 0:
+            return None, None
+        else:
+            return _prefetched.pop(0)
+
+    def _count_idle(self):
+        """add the time the free slots have been idle since the last count"""
+        now = time.time()
+        self.idle_time += (self._conf['n'] - self._num_running) * (now - self._idle_mark)
+        self._idle_mark = now
+
+    def _start_tasks(self, tasks, silent):
+        self._count_idle()
+        self._num_running += 1
+        for _, id in tasks:
+            _task_infos[id] = (time.time(), silent)
+        _pool.apply_async(_run_work, (tasks, silent),
+                          callback=self._results.put,
+                          error_callback=functools.partial(self._fail, [id for _, id in tasks]))
+
+    def _fail(self, ids, e):
+        self._results.put([(id, e) for id in ids])
+
+    def _wait(self, end_time, state_time):
+        """wait for tasks to finish until end_time or the next state check, checking them in"""
+        timeouts = [end_time - time.time(), self._conf['state_interval']]
+        if state_time is not None:
+            timeouts.append(state_time + self._conf['state_interval'] - time.time())
+        if _checkin_buffer.time_left() is not None:
+            timeouts.append(_checkin_buffer.time_left())
+        timeout = max(min(timeouts), 0.0)
+
+        # each item is the list of (id, err) results of the tasks run by one pool job
+        try:
+            done = [self._results.get(timeout=timeout)]
+        except queue.Empty:
+            done = []
+        while True:
+            try:
+                done.append(self._results.get_nowait())
+            except queue.Empty:
+                break
+        self._count_idle()
+        self._num_running -= len(done)
+
+        # the results of a bundle (and of tasks that finished together) are checked in at once
+        checkins = []
+        for id, err in [result for results in done for result in results]:
+            del _task_infos[id]
+            if isinstance(err, BaseException):
+                raise err
+
+            if err != 0:
+                checkins.append((id, TASK_STATES.FAILED, str(err)))
+            else:
+                checkins.append((id, TASK_STATES.SUCCEEDED, ''))
+
+        _checkin_buffer.add_many(checkins)
+        _checkin_buffer.poll()
+
     def run(self, state=None, silent=False):
         """run a task db"""
 
@@ -67,92 +196,79 @@ class PMPWorker(BaseWorker):
 
         self._taskdb.run()
 
-        global _task_infos
         global _pool
+        global _checkin_buffer
 
-        self._start_time = time.time()
-
-        _pool = multiprocessing.Pool(processes=self._conf['n'])
-        pool_res = [None for i in range(self._conf['n'])]
-
-        finished = False
-
-        while time.time() - self._start_time < self._conf['runtime'] - self._conf['stoptime']:
-            if self._taskdb.state() == TASKDB_STATES.PAUSED:
-                break
-
-            for i in range(self._conf['n']):
-                if pool_res[i] is None:
-                    tsk, id = self._taskdb.checkout(state=state)
+        _checkin_buffer = CheckinBuffer(self._taskdb,
+                                        size=self._conf['checkin_batch'],
+                                        interval=self._conf['checkin_interval'])
 
+        # the pool threads put the results of finished tasks here
+        self._results = queue.Queue()
+        self._start_time = time.time()
+        self.idle_time = 0.0
+        self._idle_mark = self._start_time
+        self._num_running = 0
+
+        # a fork server is started before the pool so that the pool processes share it
+        launcher = get_launcher(self._conf['launcher'])
+        _pool = multiprocessing.Pool(processes=self._conf['n'], initializer=_init_pool_process,
+                                     initargs=(launcher,), maxtasksperchild=self._conf['max_tasks_per_child'])
+
+        end_time = self._start_time + self._conf['runtime'] - self._conf['stoptime']
+        state_time = None
+        while time.time() < end_time:
+            if state_time is None or time.time() - state_time >= self._conf['state_interval']:
+                state_time = time.time()
+                if self._taskdb.state() == TASKDB_STATES.PAUSED:
+                    break
+
+            finished = False
+            while self._num_running < self._conf['n']:
+                tasks = []
+                while len(tasks) < self._conf['bundle']:
+                    tsk, id = self._next_task(state=state)
                     if tsk is None:
                         finished = True
                         break
+                    tasks.append((tsk, id))
 
-                    pool_res[i] = _pool.apply_async(_run_work, (tsk, id, silent))
-                    _task_infos.append((id, time.time(), silent))
-                else:
-                    try:
-                        id, err = pool_res[i].get(0.1)
-                        pool_res[i] = None
-                        got_result = True
-                    except multiprocessing.TimeoutError:
-                        got_result = False
-                        pass
-
-                    if got_result:
-                        for _i in range(len(_task_infos)):
-                            if _task_infos[_i][0] == id:
-                                break
-                        del _task_infos[_i]
-
-                        if err != 0:
-                            checkin_state = TASK_STATES.FAILED
-                            info = str(err)
-                        else:
-                            checkin_state = TASK_STATES.SUCCEEDED
-                            info = ''
-
-                        self._taskdb.checkin(id, checkin_state, info=info)
+                if len(tasks) > 0:
+                    self._start_tasks(tasks, silent)
+                if finished:
+                    break
 
             if finished:
                 break
 
+            self._wait(end_time, state_time)
+
         _pool.close()
 
-        while (len(_task_infos) > 0 and
-               time.time() - self._start_time < self._conf['runtime'] - self._conf['stoptime']*self._left_frac):
-
-            for i in range(self._conf['n']):
-                if pool_res[i] is not None:
-                    try:
-                        id, err = pool_res[i].get(0.1)
-                        pool_res[i] = None
-                        got_result = True
-                    except multiprocessing.TimeoutError:
-                        got_result = False
-                        pass
-
-                    if got_result:
-                        for _i in range(len(_task_infos)):
-                            if _task_infos[_i][0] == id:
-                                break
-                        del _task_infos[_i]
-
-                        if err != 0:
-                            checkin_state = TASK_STATES.FAILED
-                            info = str(err)
-                        else:
-                            checkin_state = TASK_STATES.SUCCEEDED
-                            info = ''
-
-                        self._taskdb.checkin(id, checkin_state, info=info)
+        end_time = self._start_time + self._conf['runtime'] - self._conf['stoptime']*self._left_frac
+        while len(_task_infos) > 0 and time.time() < end_time:
+            self._wait(end_time, None)
 
+        self._count_idle()
         _pool.terminate()
         _pool.join()
+        launcher.close()
 
-        for _task_info in _task_infos:
-            if not _task_info[2]:
+        _checkin_buffer.flush()
+
+        for id, (stime, _silent) in _task_infos.items():
+            if not _silent:
                 etime = time.time()
-                print_end(_task_info[0], _task_info[1], etime, TASK_STATES.KILLED)
-            _taskdb.checkin(_task_info[0], TASK_STATES.KILLED)
+                print_end(id, stime, etime, TASK_STATES.KILLED)
+            _checkin_buffer.add(id, TASK_STATES.KILLED)
+        _task_infos.clear()
+
+        # tasks that were prefetched but never started
+        while len(_prefetched) > 0:
+            _, id = _prefetched.pop(0)
+            _checkin_buffer.add(id, TASK_STATES.KILLED)
+
+        _checkin_buffer.flush()
+
+        if not silent:
+            print_slot_usage(self._conf['n'], time.time() - self._start_time, self.idle_time)
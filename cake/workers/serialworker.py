@@ -1,29 +1,77 @@
 import sys
 import numpy as np
 import time
-import subprocess
 import signal
 
 from .base import BaseWorker
+from .buffer import CheckinBuffer
 from ..defaults import TASK_STATES, TASKDB_STATES
+from ..launcher import get_launcher, run_bundle
+from ..pycall import command
 from ..utils import print_start, print_end
 
 _task_info = None
+# the tasks of the running bundle by id, with their start times, results and whether they are silent
+_bundle = None
 _taskdb = None
+_checkin_buffer = None
 
 
 def _signal_handler(signal, frame):
+    if _taskdb is not None and _checkin_buffer is not None:
+        _checkin_buffer.flush()
+
     if _taskdb is not None and _task_info is not None:
         if not _task_info[2]:
             etime = time.time()
             print_end(_task_info[0], _task_info[1], etime, TASK_STATES.KILLED)
         _taskdb.checkin(_task_info[0], TASK_STATES.KILLED)
+
+    # tasks of the bundle that finished keep their results
+    if _taskdb is not None and _bundle is not None:
+        results = []
+        for id, (stime, result, silent) in _bundle.items():
+            if result is None:
+                if stime is not None and not silent:
+                    etime = time.time()
+                    print_end(id, stime, etime, TASK_STATES.KILLED)
+                result = (id, TASK_STATES.KILLED, '')
+            results.append(result)
+        _taskdb.checkin_many(results)
     sys.exit(0)
 
 
 class SerialWorker(BaseWorker):
     def _set_defaults(self):
         self._conf['runtime'] = self._conf.get('runtime', np.inf)
+        self._conf['checkin_batch'] = self._conf.get('checkin_batch', 1)
+        self._conf['checkin_interval'] = self._conf.get('checkin_interval', 0.0)
+        self._conf['launcher'] = self._conf.get('launcher', 'spawn')
+        self._conf['bundle'] = self._conf.get('bundle', 1)
+
+    def _run_bundle(self, tasks, silent):
+        """run the tasks one after the other in one shell session and check them in together"""
+        global _bundle
+        ids = [id for _, id in tasks]
+        _bundle = dict((id, [None, None, silent]) for id in ids)
+
+        def _started(i, stime):
+            _bundle[ids[i]][0] = stime
+            if not silent:
+                print_start(ids[i], stime)
+
+        def _ended(i, err, stime, etime):
+            if err != 0:
+                result = (ids[i], TASK_STATES.FAILED, str(err))
+            else:
+                result = (ids[i], TASK_STATES.SUCCEEDED, '')
+            _bundle[ids[i]][1] = result
+            if not silent:
+                print_end(ids[i], stime, etime, result[1])
+
+        run_bundle([command(tsk) for tsk, _ in tasks], started=_started, ended=_ended)
+        _checkin_buffer.add_many([_bundle[id][1] for id in ids])
+        _bundle = None
 
     def run(self, state=None, silent=False):
         """run a task db"""
@@ -37,13 +85,26 @@ class SerialWorker(BaseWorker):
         self._taskdb.run()
 
         global _task_info
+        global _checkin_buffer
+
+        _checkin_buffer = CheckinBuffer(self._taskdb,
+                                        size=self._conf['checkin_batch'],
+                                        interval=self._conf['checkin_interval'])
 
+        launcher = get_launcher(self._conf['launcher'])
         self._start_time = time.time()
 
         while time.time() - self._start_time < self._conf['runtime']:
             if self._taskdb.state() == TASKDB_STATES.PAUSED:
                 break
 
+            if self._conf['bundle'] > 1:
+                tasks = self._taskdb.checkout_many(self._conf['bundle'], state=state)
+                if len(tasks) == 0:
+                    break
+                self._run_bundle(tasks, silent)
+                continue
+
             tsk, id = self._taskdb.checkout(state=state)
 
             if tsk is None:
@@ -55,7 +116,7 @@ class SerialWorker(BaseWorker):
 
             _task_info = (id, stime, silent)
 
-            err = subprocess.run(tsk, shell=True).returncode
+            err = launcher(command(tsk))
             etime = time.time()
 
             if err != 0:
@@ -65,7 +126,11 @@ class SerialWorker(BaseWorker):
                 checkin_state = TASK_STATES.SUCCEEDED
                 info = ''
 
-            self._taskdb.checkin(id, checkin_state, info=info)
+            _checkin_buffer.add(id, checkin_state, info=info)
+            _task_info = None
 
             if not silent:
                 print_end(id, stime, etime, checkin_state)
+
+        _checkin_buffer.flush()
+        launcher.close()